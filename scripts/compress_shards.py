@@ -0,0 +1,71 @@
+"""
+Compress the jsonl shards of a tokenized VLA dataset, they are read back with streaming decompression (src/vla_compression.py)
+
+python scripts/compress_shards.py --data_root <root> --output_root <output_root> --splits train test --num_workers 16
+
+each <root>/<split>/<name>.jsonl (or an already compressed shard) is written to <output_root>/<split>/<name>.jsonl.zst,
+or <name>.jsonl.gz with --compression gz, and checked to hold the same number of lines.
+Point data_root / data_roots to <output_root> to train on the compressed shards (shard_format: jsonl).
+.zst requires the zstandard package
+"""
+
+import argparse
+import glob
+import os
+import sys
+from multiprocessing import Pool
+
+sys.path.append('.')
+from src.vla_compression import JSONL_SHARD_SUFFIXES, compress_jsonl_shard, jsonl_shard_name, open_jsonl_shard
+
+
+def compress(job):
+    jsonl_path, output_path, level, overwrite = job
+    if os.path.exists(output_path) and not overwrite:
+        return jsonl_path, 0, 0, 0, True
+    num_lines = compress_jsonl_shard(jsonl_path, output_path, level=level)
+    with open_jsonl_shard(output_path) as f:
+        num_read = sum(1 for _ in f)
+    if num_read != num_lines:
+        os.remove(output_path)
+        raise RuntimeError(f'{output_path} holds {num_read} lines instead of {num_lines}, removed')
+    return jsonl_path, num_lines, os.path.getsize(jsonl_path), os.path.getsize(output_path), False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, required=True)
+    parser.add_argument('--output_root', type=str, required=True)
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'test'])
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--compression', type=str, default='zst', choices=['zst', 'gz'])
+    parser.add_argument('--level', type=int, default=None, help='defaults to 10 for zst and 6 for gz')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    jobs = []
+    for split in args.splits:
+        os.makedirs(os.path.join(args.output_root, split), exist_ok=True)
+        jsonl_paths = [path for suffix in JSONL_SHARD_SUFFIXES for path in glob.glob(os.path.join(args.data_root, split, '*' + suffix))]
+        for jsonl_path in sorted(jsonl_paths):
+            output_path = os.path.join(args.output_root, split, f'{jsonl_shard_name(jsonl_path)}.jsonl.{args.compression}')
+            if os.path.abspath(output_path) == os.path.abspath(jsonl_path):
+                continue
+            jobs.append((jsonl_path, output_path, args.level, args.overwrite))
+
+    total_lines, total_size, total_compressed = 0, 0, 0
+    with Pool(args.num_workers) as pool:
+        for jsonl_path, num_lines, size, compressed_size, existed in pool.imap_unordered(compress, jobs):
+            if existed:
+                print(f'{jsonl_path}: already compressed, skipped')
+                continue
+            print(f'{jsonl_path}: {num_lines} lines, {size / 1024 ** 2:.1f} MB -> {compressed_size / 1024 ** 2:.1f} MB')
+            total_lines += num_lines
+            total_size += size
+            total_compressed += compressed_size
+    ratio = total_size / total_compressed if total_compressed > 0 else 0
+    print(f'compressed {len(jobs)} shards, {total_lines} lines, {total_size / 1024 ** 3:.2f} GB -> {total_compressed / 1024 ** 3:.2f} GB ({ratio:.1f}x)')
+
+
+if __name__ == "__main__":
+    main()
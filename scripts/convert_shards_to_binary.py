@@ -0,0 +1,66 @@
+"""
+Convert the jsonl shards of a tokenized VLA dataset into memory-mappable binary shards
+
+python scripts/convert_shards_to_binary.py --data_root <root> --output_root <output_root> --splits train test --num_workers 16
+
+each <root>/<split>/<name>.jsonl (or .jsonl.zst / .jsonl.gz) is converted into <output_root>/<split>/<name>.vla,
+set shard_format: binary and point data_root / data_roots to <output_root> to train on the converted shards
+with --format trajectory, it is converted into a trajectory store <name>.vlt instead (shard_format: trajectory)
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import sys
+from multiprocessing import Pool
+
+sys.path.append('.')
+from src.vla_compression import JSONL_SHARD_SUFFIXES, jsonl_shard_name
+from src.vla_shards import BINARY_SHARD_SUFFIX, TRAJECTORY_STORE_SUFFIX, convert_jsonl_shard
+
+
+def convert(job):
+    jsonl_path, binary_path, overwrite = job
+    if os.path.exists(binary_path):
+        if not overwrite:
+            return jsonl_path, 0, 0, True
+        shutil.rmtree(binary_path)
+    num_rows, num_skipped = convert_jsonl_shard(jsonl_path, binary_path)
+    return jsonl_path, num_rows, num_skipped, False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, required=True)
+    parser.add_argument('--output_root', type=str, required=True)
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'test'])
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--format', type=str, default='binary', choices=['binary', 'trajectory'])
+    args = parser.parse_args()
+    suffix = TRAJECTORY_STORE_SUFFIX if args.format == 'trajectory' else BINARY_SHARD_SUFFIX
+
+    jobs = []
+    for split in args.splits:
+        os.makedirs(os.path.join(args.output_root, split), exist_ok=True)
+        jsonl_paths = [path for suffix in JSONL_SHARD_SUFFIXES for path in glob.glob(os.path.join(args.data_root, split, '*' + suffix))]
+        for jsonl_path in sorted(jsonl_paths):
+            name = jsonl_shard_name(jsonl_path)
+            binary_path = os.path.join(args.output_root, split, name + suffix)
+            jobs.append((jsonl_path, binary_path, args.overwrite))
+
+    total_rows, total_skipped = 0, 0
+    with Pool(args.num_workers) as pool:
+        for jsonl_path, num_rows, num_skipped, existed in pool.imap_unordered(convert, jobs):
+            if existed:
+                print(f'{jsonl_path}: already converted, skipped')
+                continue
+            print(f'{jsonl_path}: {num_rows} rows, {num_skipped} lines skipped')
+            total_rows += num_rows
+            total_skipped += num_skipped
+    print(f'converted {len(jobs)} shards, {total_rows} rows, {total_skipped} lines skipped')
+
+
+if __name__ == "__main__":
+    main()
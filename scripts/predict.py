@@ -9,17 +9,164 @@ import datasets
 import torch
 import transformers
 from transformers import AutoModelForCausalLM, set_seed, MistralModel, PhiModel
-from transformers import TrainerCallback, TextStreamer
+from transformers import DynamicCache, LogitsProcessorList, TrainerCallback, TextStreamer
 from time import sleep
 
 sys.path.append('.')
 from src import DataArguments, H4ArgumentParser, ModelArguments, SFTConfig, get_checkpoint, get_datasets
-from src import get_VLA_dataset
+from src import get_VLA_dataset, VLAEncoder, VLAIndexedDataset, VLAPrefixCache, generate_fast_forward, output_grammar
+from src import free_max_new_tokens, output_stop_token_id
 
 import os
 import json
 import time
 
+SORT_WINDOW_BATCHES = 32
+
+
+def prompt_ids(sample, tokenizer, encoder):
+    if encoder is None:
+        input_text = sample['text'] if 'text' in sample else sample['input']
+        return input_text, tokenizer(input_text).input_ids
+    return None, list(sample['input_ids'][:sample['prompt_length']])
+
+
+def generate_batch(model, prompts, pad_token_id, eos_token_id, device, max_new_tokens, layout=None, decoding='free', prefix_cache=None):
+    '''
+    greedy generation of a batch of prompts (lists of ids), left-padded to the longest one, with at most max_new_tokens
+    new tokens (layout.max_length when the decoding enforces the layout, free_max_new_tokens otherwise)
+    decoding: 'free', 'constrained' to the output layout, or 'fast_forward' (constrained, forced tokens fed without a decode step)
+    layout: the VLAOutputGrammar of the constrained decodings, None for free decoding
+    prefix_cache: a VLAPrefixCache, the shared prompt prefixes are read from it instead of prefilled
+    returns the generated ids of every prompt, up to its eos (eos_token_id, <eoa_o> with action_only_decoding)
+    '''
+    past_key_values = None
+    if prefix_cache is not None:
+        input_ids, attention_mask, past_key_values = prefix_cache.prepare(model, prompts, pad_token_id, device)
+    else:
+        width = max(len(prompt) for prompt in prompts)
+        input_ids = torch.full((len(prompts), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), width), dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            input_ids[i, width - len(prompt):] = torch.tensor(prompt, dtype=torch.long)
+            attention_mask[i, width - len(prompt):] = 1
+        input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+    width = input_ids.shape[1]
+    if decoding == 'fast_forward':
+        generated, num_forward = generate_fast_forward(model, input_ids, attention_mask, layout, pad_token_id,
+                                                       max_new_tokens=max_new_tokens, past_key_values=past_key_values)
+        print('forward passes', num_forward, 'generated tokens', max(len(row) for row in generated))
+        return generated
+    with torch.no_grad():
+        logits_processor = LogitsProcessorList([layout.logits_processor()]) if decoding == 'constrained' else None
+        if past_key_values is not None:
+            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+        output = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens, num_beams=1,
+                                pad_token_id=pad_token_id, eos_token_id=eos_token_id, logits_processor=logits_processor,
+                                past_key_values=past_key_values)
+    generated = []
+    for row in output[:, width:].tolist():
+        # the finished rows are padded until the whole batch is done
+        if eos_token_id in row:
+            row = row[:row.index(eos_token_id) + 1]
+        generated.append(row)
+    return generated
+
+
+def predict_window(samples, model, tokenizer, encoder, batch_size, pad_token_id, eos_token_id, device, f, max_new_tokens, layout, decoding,
+                   prefix_cache=None):
+    '''
+    the samples are batched from the shortest prompt to the longest and the results are written in the order of the
+    samples: after every batch, the finished samples that follow the last written one are written out, the others wait
+    for the samples before them
+    '''
+    prompts = [prompt_ids(sample, tokenizer, encoder) for sample in samples]
+    order = sorted(range(len(samples)), key=lambda i: len(prompts[i][1]))
+    generated = [None] * len(samples)
+    written = 0
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        start_time = time.time()
+        for i, ids in zip(batch, generate_batch(model, [prompts[i][1] for i in batch], pad_token_id, eos_token_id, device,
+                                               max_new_tokens, layout, decoding, prefix_cache)):
+            generated[i] = ids
+        print('generate time', time.time() - start_time, 'batch size', len(batch))
+        while written < len(samples) and generated[written] is not None:
+            input_text, input_ids = prompts[written]
+            f.write(json.dumps(format_prediction(samples[written], tokenizer, encoder, input_text, input_ids, generated[written])) + '\n')
+            generated[written] = None # written, the ids are not kept
+            written += 1
+        f.flush()
+
+
+def format_prediction(sample, tokenizer, encoder, input_text, input_ids, output_ids):
+    '''
+    the results.jsonl record of a sample from its prompt and generated ids
+    '''
+    if encoder is None:
+        output_text = tokenizer.decode(input_ids + output_ids, skip_special_tokens=False)
+        # save the output_text
+        ret = {}
+        ret['task_description'] = input_text.split('<eott_i>')[0].split('<bott_i>')[-1]
+        ret['scene_description'] = input_text.split('<eots_i>')[0].split('<bots_i>')[-1]
+        # ret['task_scene_description'] = input_text.split('<eots_i>')[0].split('<bots_i>')[-1]
+        ret['input_clip_description'] = input_text.split('<eotp_i>')[0].split('<botp_i>')[-1]
+
+        ret['output_clip_description_pred'] = output_text.split('<eotp_o>')[0].split('<botp_o>')[-1]
+        ret['output_clip_description_gt'] = sample['output'].split('<eotp_o>')[0].split('<botp_o>')[-1]
+
+
+        ret['trajectory_id'] = sample['trajectory_id']
+        ret['view'] = sample['view']
+
+        ret['identical_token_ratio_video'], ret['identical_token_ratio_action'] = 0, 0
+
+        ret['input_video_tokens'] = [int(x[:-1]) for x in input_text.split('<eov_i>')[0].split('<bov_i>')[-1].split('<va') if x != '']
+        # action_only_decoding may stop before the output video
+        ret['output_video_tokens_pred'] = [int(x[:-1]) for x in output_text.split('<eov_o>')[0].split('<bov_o>')[-1].split('<va') if x != ''] \
+            if '<bov_o>' in output_text else []
+        ret['output_video_tokens_gt'] = [int(x[:-1]) for x in sample['output'].split('<eov_o>')[0].split('<bov_o>')[-1].split('<va') if x != '']
+
+        ret['input_action_tokens'] = [int(x[:-1]) for x in input_text.split('<eoa_i>')[0].split('<boa_i>')[-1].split('<va') if x != '']
+        ret['output_action_tokens_pred'] = [int(x[:-1]) for x in output_text.split('<eoa_o>')[0].split('<boa_o>')[-1].split('<va') if x != '']
+        ret['output_action_tokens_gt'] = [int(x[:-1]) for x in sample['output'].split('<eoa_o>')[0].split('<boa_o>')[-1].split('<va') if x != '']
+    else:
+        output_tokens = encoder.decode_output(output_ids)
+        ret = {}
+        for k in ['task_description', 'scene_description', 'input_clip_description']:
+            ret[k] = sample[k]
+        ret['output_clip_description_pred'] = output_tokens['output_clip_description']
+        ret['output_clip_description_gt'] = sample['output_clip_description']
+
+        ret['trajectory_id'] = sample['trajectory_id']
+        ret['view'] = sample['view']
+
+        ret['identical_token_ratio_video'], ret['identical_token_ratio_action'] = 0, 0
+
+        ret['input_video_tokens'] = sample['input_video_tokens']
+        ret['output_video_tokens_pred'] = output_tokens['output_video_tokens']
+        ret['output_video_tokens_gt'] = sample['output_video_tokens']
+
+        ret['input_action_tokens'] = sample['input_action_tokens']
+        ret['output_action_tokens_pred'] = output_tokens['output_action_tokens']
+        ret['output_action_tokens_gt'] = sample['output_action_tokens']
+
+    ret['output_action_value_gt'] = sample['gt_actions']
+
+    # print the ratio of identical tokens
+    num_identical_tokens = 0
+    for token_pred, token_gt in zip(ret['output_video_tokens_pred'], ret['output_video_tokens_gt']):
+        if token_pred == token_gt:
+            num_identical_tokens += 1
+    ret['identical_token_ratio_video'] = num_identical_tokens / len(ret['output_video_tokens_gt'])
+    num_identical_tokens = 0
+    for token_pred, token_gt in zip(ret['output_action_tokens_pred'], ret['output_action_tokens_gt']):
+        if token_pred == token_gt:
+            num_identical_tokens += 1
+    ret['identical_token_ratio_action'] = num_identical_tokens / len(ret['output_action_tokens_gt'])
+    return ret
+
+
 def main():
 
     parser = H4ArgumentParser((ModelArguments, DataArguments))
@@ -40,20 +187,28 @@ def main():
     # Load and pre-process the dataset
     #######################
 
-    eval_dataset = get_VLA_dataset(data_args, tokenizer.eos_token, split='test_with_gt_action', return_info=True)
+    # with tokenizer_free, the prompt ids are assembled from the token integers and the outputs are parsed from the ids
+    encoder = VLAEncoder(tokenizer, data_args) if data_args.tokenizer_free else None
+    eval_dataset = get_VLA_dataset(data_args, tokenizer.eos_token, split='test_with_gt_action', return_info=True, encoder=encoder)
 
     def preprocess_func(example):
         example['text'] = example['input']
         return example
 
-    eval_dataset = eval_dataset.map(
-        preprocess_func,
-        num_proc=data_args.preprocessing_num_workers,
-        remove_columns=['input'], # keep the output column
-        desc="Preprocessing testing dataset",
-    )
+    if isinstance(eval_dataset, VLAIndexedDataset):
+        # each predict worker claims a disjoint range of [start_idx, end_idx), nothing is read until it is accessed
+        rank, world_size = int(os.getenv("RANK", "0")), int(os.getenv("WORLD_SIZE", "1"))
+        eval_dataset = eval_dataset.shard_range(rank, world_size)
+        print(f'rank {rank} predicts {len(eval_dataset)} samples from index {eval_dataset.start_idx}')
+    elif encoder is None:
+        eval_dataset = eval_dataset.map(
+            preprocess_func,
+            num_proc=data_args.preprocessing_num_workers,
+            remove_columns=['input'], # keep the output column
+            desc="Preprocessing testing dataset",
+        )
 
-    index = random.randint(0, len(eval_dataset))
+    index = random.randrange(len(eval_dataset))
     print(f"Sample {index} from the training set:\n\n{eval_dataset[index]}")
 
     #######################
@@ -83,61 +238,36 @@ def main():
     ###############
     os.makedirs(os.path.join(model_args.model_name_or_path, 'predictions'), exist_ok=True)
     f = open(os.path.join(model_args.model_name_or_path, 'predictions', 'results.jsonl'), 'a')
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    batch_size = data_args.predict_batch_size
+    decoding = 'fast_forward' if data_args.fast_forward_decoding else 'constrained' if data_args.constrained_decoding else 'free'
+    if decoding == 'free':
+        layout = None
+        eos_token_id, max_new_tokens = output_stop_token_id(tokenizer, data_args), free_max_new_tokens(data_args)
+    else:
+        # the grammar of the constrained decoding, which gives the exact max_new_tokens of the outputs it enforces
+        layout = output_grammar(tokenizer, data_args, encoder)
+        eos_token_id, max_new_tokens = layout.stop_token_id, layout.max_length
+    print('decoding', decoding, 'max_new_tokens', max_new_tokens, 'action_only', data_args.action_only_decoding)
+    prefix_cache = None
+    if data_args.prefix_cache_mb > 0:
+        prefix_cache = VLAPrefixCache(tokenizer.convert_tokens_to_ids('<eott_i>' if data_args.wo_text else '<eots_i>'),
+                                      data_args.prefix_cache_mb * 1024 ** 2)
+    # the prompts of a window of batches are generated from the shortest to the longest, and written back in order
+    window = []
     for sample in eval_dataset:
-        input_text = sample['text']
-        # print('input_text', input_text)
-        input_ids = tokenizer(input_text, return_tensors='pt').input_ids
-        input_ids = input_ids.to(device)
-        start_time = time.time()
-        with torch.no_grad():
-            # output = model.generate(input_ids, max_length=2048, num_beams=5, early_stopping=True, output_scores=True)
-            output = model.generate(input_ids, max_new_tokens=1000, num_beams=1, 
-                                    pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
-                                    # streamer=streamer
-                                    )
-        print('generate time', time.time() - start_time)
-        output_text = tokenizer.decode(output[0], skip_special_tokens=False)
-        # save the output_text
-        ret = {}
-        ret['task_description'] = input_text.split('<eott_i>')[0].split('<bott_i>')[-1]
-        ret['scene_description'] = input_text.split('<eots_i>')[0].split('<bots_i>')[-1]
-        # ret['task_scene_description'] = input_text.split('<eots_i>')[0].split('<bots_i>')[-1]
-        ret['input_clip_description'] = input_text.split('<eotp_i>')[0].split('<botp_i>')[-1]
-
-        ret['output_clip_description_pred'] = output_text.split('<eotp_o>')[0].split('<botp_o>')[-1]
-        ret['output_clip_description_gt'] = sample['output'].split('<eotp_o>')[0].split('<botp_o>')[-1]
-        
-
-        ret['trajectory_id'] = sample['trajectory_id']
-        ret['view'] = sample['view']
-
-        ret['identical_token_ratio_video'], ret['identical_token_ratio_action'] = 0, 0
-
-        ret['input_video_tokens'] = [int(x[:-1]) for x in input_text.split('<eov_i>')[0].split('<bov_i>')[-1].split('<va') if x != '']
-        ret['output_video_tokens_pred'] = [int(x[:-1]) for x in output_text.split('<eov_o>')[0].split('<bov_o>')[-1].split('<va') if x != '']
-        ret['output_video_tokens_gt'] = [int(x[:-1]) for x in sample['output'].split('<eov_o>')[0].split('<bov_o>')[-1].split('<va') if x != '']
-
-        ret['input_action_tokens'] = [int(x[:-1]) for x in input_text.split('<eoa_i>')[0].split('<boa_i>')[-1].split('<va') if x != '']
-        ret['output_action_tokens_pred'] = [int(x[:-1]) for x in output_text.split('<eoa_o>')[0].split('<boa_o>')[-1].split('<va') if x != '']
-        ret['output_action_tokens_gt'] = [int(x[:-1]) for x in sample['output'].split('<eoa_o>')[0].split('<boa_o>')[-1].split('<va') if x != '']
-
-        ret['output_action_value_gt'] = sample['gt_actions']
-
-        # print the ratio of identical tokens
-        num_identical_tokens = 0
-        for token_pred, token_gt in zip(ret['output_video_tokens_pred'], ret['output_video_tokens_gt']):
-            if token_pred == token_gt:
-                num_identical_tokens += 1
-        ret['identical_token_ratio_video'] = num_identical_tokens / len(ret['output_video_tokens_gt'])
-        num_identical_tokens = 0
-        for token_pred, token_gt in zip(ret['output_action_tokens_pred'], ret['output_action_tokens_gt']):
-            if token_pred == token_gt:
-                num_identical_tokens += 1
-        ret['identical_token_ratio_action'] = num_identical_tokens / len(ret['output_action_tokens_gt'])
-
-        # print('output_text', output_text)
-        # save as jsonl file
-        f.write(json.dumps(ret) + '\n')
+        window.append(sample)
+        if len(window) == batch_size * SORT_WINDOW_BATCHES:
+            predict_window(window, model, tokenizer, encoder, batch_size, pad_token_id, eos_token_id, device, f, max_new_tokens, layout,
+                           decoding, prefix_cache)
+            window = []
+    if window:
+        predict_window(window, model, tokenizer, encoder, batch_size, pad_token_id, eos_token_id, device, f, max_new_tokens, layout,
+                       decoding, prefix_cache)
+    if encoder is not None:
+        print('description token cache', encoder.description_cache.stats())
+    if prefix_cache is not None:
+        print('prefix cache', prefix_cache.stats())
 
 if __name__ == "__main__":
     main()
@@ -8,7 +8,7 @@ import sys
 import transformers
 
 sys.path.append('.')
-from src import DataArguments, H4ArgumentParser, ModelArguments, get_VLA_dataset
+from src import DataArguments, H4ArgumentParser, ModelArguments, free_max_new_tokens, get_VLA_dataset
 
 import os
 import json
@@ -52,7 +52,7 @@ def main():
         
         start_time = time.time()
         
-        output = pipe([input_text], max_new_tokens=1024)
+        output = pipe([input_text], max_new_tokens=free_max_new_tokens(data_args))
         output_text = output[0].generated_text
         # print('output_text', output_text)
 
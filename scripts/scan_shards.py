@@ -0,0 +1,107 @@
+"""
+Scan the shards of a VLA dataset: clip / trajectory / view counts, sequence length distributions, out-of-range token ids,
+empty descriptions, parse failures and the smallest max_seq_length that truncates nothing
+
+python scripts/scan_shards.py --data_roots <root1> <root2> --splits train test --num_workers 32 --tokenizer <model_or_tokenizer_path>
+
+the summary of every shard is cached (see src/vla_stats.py), re-running only scans the new or modified shards.
+Without --tokenizer the descriptions are not counted in the sequence lengths
+"""
+
+import argparse
+import functools
+import json
+import sys
+from multiprocessing import Pool
+
+sys.path.append('.')
+from src.load_dataset_VLA import get_VLA_shards
+from src.vla_decode import set_json_backend
+from src.vla_encoder import DescriptionTokenCache
+from src.vla_stats import (LAYOUT_VARIANTS, VLALengthCounter, length_percentiles, load_or_scan_VLA_shard, merge_VLA_stats,
+                           recommended_max_seq_length, scan_VLA_shard)
+
+
+def scan(shard, args):
+    tokenize = None
+    num_bos = 1
+    if args.tokenizer is not None:
+        tokenizer = get_tokenizer(args.tokenizer)
+        tokenize = DescriptionTokenCache(lambda text: tokenizer(text, add_special_tokens=False).input_ids)
+        num_bos = int(getattr(tokenizer, 'add_bos_token', False) and tokenizer.bos_token_id is not None)
+    length_counter = VLALengthCounter(tokenize, args.static_video_description, num_bos=num_bos)
+    options = {'num_visual_action_tokens': args.num_visual_action_tokens, 'tokenizer': args.tokenizer,
+               'static_video_description': args.static_video_description}
+    summary, cached = load_or_scan_VLA_shard(
+        shard, options, functools.partial(scan_VLA_shard, num_visual_action_tokens=args.num_visual_action_tokens,
+                                          length_counter=length_counter), cache_dir=args.cache_dir)
+    return shard, summary, cached
+
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer(name):
+    # loaded once per worker process
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name)
+
+
+def report(split, merged, args):
+    print(f'== {split}: {merged["shards"]} shards, {merged["clips"]} clips, {merged["trajectories"]} trajectories, {merged["views"]} views '
+          f'({merged["view_names"]} view names, {merged["views_per_trajectory"]:.2f} views per trajectory)')
+    print(f'   parse failures: {merged["malformed"]} malformed lines, {merged["skipped"]} lines with missing / invalid fields')
+    print(f'   largest token id: {merged["max_token_id"]} (num_visual_action_tokens={args.num_visual_action_tokens})')
+    if merged['out_of_range']:
+        print(f'   out-of-range token ids: {dict(merged["out_of_range"])}')
+    if merged['empty_descriptions']:
+        print(f'   empty descriptions: {dict(merged["empty_descriptions"])}')
+    for variant in LAYOUT_VARIANTS:
+        counts = merged['lengths'][variant]
+        percentiles = ', '.join(f'p{p}={v}' for p, v in length_percentiles(counts).items())
+        print(f'   {variant:>18}: length {percentiles}, recommended max_seq_length {recommended_max_seq_length(counts, args.multiple_of)}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, default=None)
+    parser.add_argument('--data_roots', type=str, nargs='+', default=None)
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'test'])
+    parser.add_argument('--shard_format', type=str, default='jsonl', choices=['jsonl', 'binary', 'trajectory'])
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--cache_dir', type=str, default=None, help='where the per-shard summaries are saved, defaults to next to the shards')
+    parser.add_argument('--tokenizer', type=str, default=None, help='the tokenizer counting the description tokens')
+    parser.add_argument('--num_visual_action_tokens', type=int, default=2048)
+    parser.add_argument('--static_video_description', type=str, nargs='+', default=[''])
+    parser.add_argument('--multiple_of', type=int, default=8, help='round the recommended max_seq_length up to a multiple of this')
+    parser.add_argument('--json_backend', type=str, default='auto', choices=['auto', 'json', 'orjson'])
+    parser.add_argument('--output', type=str, default=None, help='also write the merged statistics to this json file')
+    args = parser.parse_args()
+    set_json_backend(args.json_backend)
+
+    results = {}
+    with Pool(args.num_workers) as pool:
+        for split in args.splits:
+            shards = get_VLA_shards(args, split)
+            summaries = []
+            num_cached = 0
+            for shard, summary, cached in pool.imap_unordered(functools.partial(scan, args=args), shards):
+                summaries.append(summary)
+                num_cached += int(cached)
+                if summary['malformed'] or summary['skipped']:
+                    print(f'{shard}: {summary["malformed"]} malformed, {summary["skipped"]} skipped lines')
+            print(f'{split}: scanned {len(shards) - num_cached} shards, {num_cached} from the cache')
+            results[split] = merge_VLA_stats(summaries)
+            report(split, results[split], args)
+
+    if args.output is not None:
+        for merged in results.values():
+            merged['lengths'] = {variant: {str(k): v for k, v in sorted(counts.items())} for variant, counts in merged['lengths'].items()}
+            merged['length_percentiles'] = {variant: length_percentiles({int(k): v for k, v in counts.items()})
+                                            for variant, counts in merged['lengths'].items()}
+            merged['recommended_max_seq_length'] = {variant: recommended_max_seq_length({int(k): v for k, v in counts.items()}, args.multiple_of)
+                                                    for variant, counts in merged['lengths'].items()}
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
+import dataclasses
+import itertools
 import logging
 import random
 import sys
 
 import datasets
+from datasets.distributed import split_dataset_by_node
 import torch
 import transformers
 from transformers import AutoModelForCausalLM, set_seed, MistralModel, PhiModel
@@ -12,9 +15,13 @@ from transformers import MistralConfig, MistralForCausalLM
 
 sys.path.append('.')
 from src import DataArguments, H4ArgumentParser, ModelArguments, SFTConfig, get_checkpoint, get_datasets
-from src import get_VLA_dataset
+from src import get_VLA_dataset, VLAEncoder, VLACompletionCollator, VLAPackingCollator, VLAStreamingCursorCallback, VLAStreamingDataset
+from src import prompt_end_token
+from src import TokenBudgetBatchSampler, TokenBudgetEpochCallback, VLATokenBudgetStream, get_VLA_lengths
 
-from trl import SFTTrainer, DataCollatorForCompletionOnlyLM
+from trl import SFTTrainer
+from transformers.trainer_utils import has_length
+from torch.utils.data import DataLoader
 import os
 
 logger = logging.getLogger(__name__)
@@ -95,8 +102,12 @@ def main():
     # Load and pre-process the dataset
     #######################
 
-    train_dataset = get_VLA_dataset(data_args, tokenizer.eos_token, split='train')
-    eval_dataset = get_VLA_dataset(data_args, tokenizer.eos_token, split='test')
+    # with tokenizer_free, the dataset yields input_ids / labels directly and SFTTrainer skips its tokenization
+    encoder = VLAEncoder(tokenizer, data_args, max_seq_length=training_args.max_seq_length) if data_args.tokenizer_free else None
+
+    train_dataset = get_VLA_dataset(data_args, tokenizer.eos_token, split='train', encoder=encoder)
+    # the rank-aware stream cycles forever, evaluation reads the whole test split on every rank
+    eval_dataset = get_VLA_dataset(dataclasses.replace(data_args, streaming_shard_by_rank=False), tokenizer.eos_token, split='test', encoder=encoder)
 
     def preprocess_func(example):
         example_new = {}
@@ -109,29 +120,36 @@ def main():
         train_dataset = train_dataset.select(range(2000))
         eval_dataset = eval_dataset.select(range(100))
 
-    train_dataset = eval_dataset.map(
-        preprocess_func,
-        num_proc=data_args.preprocessing_num_workers,
-        desc="Preprocessing testing dataset",
-    )
-    eval_dataset = eval_dataset.map(
-        preprocess_func,
-        num_proc=data_args.preprocessing_num_workers,
-        desc="Preprocessing testing dataset",
-    )
+    if encoder is None:
+        train_dataset = eval_dataset.map(
+            preprocess_func,
+            num_proc=data_args.preprocessing_num_workers,
+            desc="Preprocessing testing dataset",
+        )
+        eval_dataset = eval_dataset.map(
+            preprocess_func,
+            num_proc=data_args.preprocessing_num_workers,
+            desc="Preprocessing testing dataset",
+        )
 
     with training_args.main_process_first(desc="Log a few random samples from the processed training set"):
         # take a sample from the dataset (iteratable)
         if type(train_dataset) == datasets.IterableDataset:
             for i, example in enumerate(train_dataset.take(3)):
-                logger.info(f"Sample {i}: {example['text']}")
+                logger.info(f"Sample {i}: {example['text'] if encoder is None else tokenizer.decode(example['input_ids'])}")
+        elif isinstance(train_dataset, VLAStreamingDataset):
+            for i, example in enumerate(itertools.islice(train_dataset, 3)):
+                logger.info(f"Sample {i}: {tokenizer.decode(example['input_ids'])}")
         else:
             for i in range(3):
                 logger.info(f"Sample {i}: {train_dataset[i]}")
     
-    # input always ends by <eoa_i>, use <eoa_i> as the response template
-    response_template_id = tokenizer.convert_tokens_to_ids(['<eoa_i>'])
-    data_collator = DataCollatorForCompletionOnlyLM(response_template_id, tokenizer=tokenizer)
+    if data_args.pack_sequences and model_args.use_flash_attention_2:
+        # neither the 4D block mask nor the reset position_ids separate the packed samples in its varlen kernels
+        raise ValueError('pack_sequences cannot keep the packed samples apart with flash attention 2, '
+                         'use the sdpa / eager attention with packing_attention=block')
+    if encoder is not None:
+        training_args.dataset_kwargs = {**(training_args.dataset_kwargs or {}), "skip_prepare_dataset": True}
 
     #######################
     # Load pretrained model
@@ -162,6 +180,23 @@ def main():
         )
     model.resize_token_embeddings(len(tokenizer), pad_to_multiple_of=128) # pad to multiple of 128 to improve performance
 
+    # the input ends by <eoa_i>, or by <eov_i> with action_before_vision, the response starts right after it
+    prompt_end_token_id = tokenizer.convert_tokens_to_ids(prompt_end_token(data_args.action_before_vision))
+    if data_args.pack_sequences:
+        if data_args.packing_attention == 'position_ids':
+            logger.warning('packing_attention=position_ids only restarts the positions, the packed samples attend to each other')
+        # the encoder labels are kept as they are, the text path masks each sample up to the end of its own prompt
+        data_collator = VLAPackingCollator(tokenizer.pad_token_id, training_args.max_seq_length,
+                                           response_template=[prompt_end_token_id] if encoder is None else None,
+                                           attention=data_args.packing_attention,
+                                           mask_dtype=torch_dtype,
+                                           # the eager and sdpa attention read the 4D block mask in different forms
+                                           attn_implementation=model.config._attn_implementation)
+    else:
+        # masks the prompt by position, the labels of the encoder (tokenizer_free) are only padded
+        data_collator = VLACompletionCollator(tokenizer.pad_token_id, prompt_end_token_id, padding_side=tokenizer.padding_side,
+                                              pin_memory=training_args.dataloader_pin_memory)
+
     ########################
     # Initialize the Trainer
     ########################
@@ -171,7 +206,53 @@ def main():
             # print whether this process should save the checkpoint
             print(f'Process {args.local_rank} should save checkpoint: {args.should_save}')
 
-    trainer = SFTTrainer(
+    class VLASFTTrainer(SFTTrainer):
+        def _get_token_budget_dataloader(self):
+            collate_fn = self._get_collator_with_removed_columns(self.data_collator, description="training")
+            if has_length(self.train_dataset):
+                train_dataset = self.train_dataset
+                if isinstance(train_dataset, datasets.Dataset):
+                    train_dataset = self._remove_unused_columns(train_dataset, description="training")
+                # the batches are split over the ranks by the sampler, not by accelerate
+                batch_sampler = TokenBudgetBatchSampler(get_VLA_lengths(train_dataset, num_proc=data_args.preprocessing_num_workers),
+                                                        data_args.max_tokens_per_batch, bucket_size=data_args.length_bucket_size,
+                                                        seed=self.args.seed, num_replicas=self.args.world_size, rank=self.args.process_index)
+                self.add_callback(TokenBudgetEpochCallback(batch_sampler))
+                return DataLoader(train_dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                                  num_workers=self.args.dataloader_num_workers, pin_memory=self.args.dataloader_pin_memory)
+            train_dataset = self.train_dataset
+            if isinstance(train_dataset, datasets.IterableDataset):
+                train_dataset = split_dataset_by_node(train_dataset, rank=self.args.process_index, world_size=self.args.world_size)
+            # VLAStreamingDataset is already split by rank. The streams hold different numbers of batches on different
+            # ranks, every rank yields the batches of the max_steps steps so that they stay in step
+            if self.args.max_steps <= 0:
+                raise ValueError('max_tokens_per_batch with a streaming dataset requires max_steps')
+            num_batches = self.args.max_steps * self.args.gradient_accumulation_steps
+            return DataLoader(VLATokenBudgetStream(train_dataset, data_args.max_tokens_per_batch, bucket_size=data_args.length_bucket_size,
+                                                   seed=self.args.seed, num_batches=num_batches),
+                              batch_size=None, collate_fn=collate_fn, num_workers=self.args.dataloader_num_workers,
+                              pin_memory=self.args.dataloader_pin_memory)
+
+        def get_train_dataloader(self):
+            if data_args.max_tokens_per_batch is not None:
+                return self._get_token_budget_dataloader()
+            if not isinstance(self.train_dataset, VLAStreamingDataset):
+                return super().get_train_dataloader()
+            # the stream is already split by rank, do not let accelerate dispatch or re-shard the batches
+            return DataLoader(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self._get_collator_with_removed_columns(self.data_collator, description="training"),
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+
+    callbacks = [PrintCallback()] if training_args.debug else []
+    if isinstance(train_dataset, VLAStreamingDataset):
+        callbacks.append(VLAStreamingCursorCallback(train_dataset, training_args.dataloader_num_workers,
+                                                    training_args.per_device_train_batch_size))
+
+    trainer = VLASFTTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
@@ -179,7 +260,7 @@ def main():
         tokenizer=tokenizer,
         dataset_text_field="text",
         data_collator=data_collator,
-        callbacks=[PrintCallback()] if training_args.debug else None,
+        callbacks=callbacks,
         max_seq_length=training_args.max_seq_length,
         dataset_kwargs=training_args.dataset_kwargs,
     )
@@ -199,9 +280,17 @@ def main():
         checkpoint = training_args.resume_from_checkpoint
     elif last_checkpoint is not None:
         checkpoint = last_checkpoint
+    if checkpoint is not None and isinstance(train_dataset, VLAStreamingDataset):
+        # continue the stream from the data cursor instead of replaying the consumed batches
+        if data_args.max_tokens_per_batch is not None:
+            logger.warning('The data cursor counts per_device_train_batch_size samples per batch, '
+                           'with max_tokens_per_batch the resumed stream position is approximate')
+        if train_dataset.load_cursor(checkpoint, training_args.per_device_train_batch_size, training_args.gradient_accumulation_steps):
+            trainer.args.ignore_data_skip = True
     train_result = trainer.train(resume_from_checkpoint=checkpoint)
     metrics = train_result.metrics
-    metrics["train_samples"] = len(train_dataset)
+    if hasattr(train_dataset, "__len__"):
+        metrics["train_samples"] = len(train_dataset)
     trainer.log_metrics("train", metrics)
     trainer.save_metrics("train", metrics)
     trainer.save_state()
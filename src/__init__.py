@@ -10,4 +10,13 @@ from .model_utils import (
     is_adapter_model,
 )
 from .load_dataset_VLA import get_VLA_dataset
+from .vla_index import VLAIndexedDataset
 from .load_dataset_VLA_debug import get_VLA_dataset as get_VLA_dataset_debug
+from .vla_encoder import DescriptionTokenCache, VLAEncoder
+from .vla_decode import VLA_SHARD_STATS, log_shard_stats
+from .vla_constraints import VLAOutputGrammar, free_max_new_tokens, generate_fast_forward, output_grammar, output_stop_token_id
+from .vla_collator import VLACompletionCollator, prompt_end_token
+from .vla_packing import VLAPackingCollator
+from .vla_prefix_cache import VLAPrefixCache
+from .vla_sampler import TokenBudgetBatchSampler, TokenBudgetEpochCallback, VLATokenBudgetStream, get_VLA_lengths
+from .vla_streaming import VLAStreamingCursorCallback, VLAStreamingDataset
@@ -211,13 +211,84 @@ class DataArguments:
     """
     dataset_type: str = field(
         default='dataset',
-        metadata={"help": "The type of dataset to use for training.",
-                  "choices": ['dataset', 'iterable_dataset']}
+        metadata={"help": "The type of dataset to use for training, indexed_dataset is a random-access view over the jsonl shards.",
+                  "choices": ['dataset', 'iterable_dataset', 'indexed_dataset']}
     )
     preprocessing_num_workers: Optional[int] = field(
         default=None,
         metadata={"help": ("The number of processes to use for data preprocessing.")},
     )
+    dataset_num_proc: Optional[int] = field(
+        default=None,
+        metadata={"help": ("The number of processes that generate the dataset from the shards, "
+                           "each process handles a contiguous slice of the sorted shard list so the order is preserved.")},
+    )
+    dataset_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": ("Directory of the persistent cache of built datasets (dataset_type=dataset only), "
+                           "keyed by the shards and the data options. Should be node-local.")},
+    )
+    dataset_cache_max_gb: Optional[float] = field(
+        default=None,
+        metadata={"help": "Size budget of dataset_cache_dir, least recently used entries are evicted beyond it."},
+    )
+    dataset_share_on_node: bool = field(
+        default=False,
+        metadata={"help": ("dataset_type=dataset without dataset_cache_dir: one local rank builds the dataset and publishes it in "
+                           "dataset_share_dir, the other ranks of the node memory-map it read-only instead of building their own copy. "
+                           "A dataset_cache_dir is shared the same way.")},
+    )
+    dataset_share_dir: str = field(
+        default='/dev/shm/vla_datasets',
+        metadata={"help": ("Node-local directory (tmpfs) of dataset_share_on_node, a shared dataset is removed when the last "
+                           "process using it exits.")},
+    )
+    dataset_share_keep: bool = field(
+        default=False,
+        metadata={"help": "dataset_share_on_node: keep the shared datasets in dataset_share_dir after exit, for relaunches on the node."},
+    )
+    streaming_shard_by_rank: bool = field(
+        default=False,
+        metadata={"help": ("With dataset_type=iterable_dataset, give every rank and dataloader worker disjoint shards "
+                           "and save a data cursor in the checkpoints to resume the stream. Requires tokenizer_free.")},
+    )
+    shuffle_open_shards: int = field(
+        default=1,
+        metadata={"help": "Streaming: the number of shards read at once, samples are drawn from them at random."},
+    )
+    shuffle_buffer_size: int = field(
+        default=0,
+        metadata={"help": "Streaming: the size of the shuffle buffer, 0 disables it."},
+    )
+    shuffle_seed: int = field(
+        default=42,
+        metadata={"help": "Streaming: the shuffle seed, combined with the epoch."},
+    )
+    prefetch_shards: int = field(
+        default=0,
+        metadata={"help": ("The number of upcoming jsonl shards read into memory by background threads while the current one is parsed, "
+                           "for shards on network storage. 0 disables the prefetch.")},
+    )
+    prefetch_max_mb: int = field(
+        default=1024,
+        metadata={"help": "The memory cap of the prefetched shard bytes, per dataset process / dataloader worker."},
+    )
+    data_root_weights: Optional[List[float]] = field(
+        default=None,
+        metadata={"help": ("Sampling weight of each entry of data_roots, the streamed samples are drawn from the roots with these weights "
+                           "instead of reading the roots one after the other. Not used by indexed_dataset.")},
+    )
+    mixture_exhaustion: str = field(
+        default='stop',
+        metadata={"help": ("What the weighted mixture does when a data root runs out: 'stop' ends the epoch, "
+                           "'cycle' restarts that root until every root has been read through at least once."),
+                  "choices": ["stop", "cycle"]},
+    )
+    json_backend: str = field(
+        default='auto',
+        metadata={"help": ("The json library decoding the jsonl shards, 'auto' uses orjson when it is installed and the standard json module otherwise."),
+                  "choices": ["auto", "json", "orjson"]},
+    )
     data_root: Optional[str] = field(
         default=None,
         metadata={"help": "The root directory of the data."}
@@ -226,6 +297,17 @@ class DataArguments:
         default=None,
         metadata={"help": "The root directories of the data."}
     )
+    shard_index_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Where the line-offset indexes of the shards are saved, defaults to next to the shards."}
+    )
+    shard_format: str = field(
+        default='jsonl',
+        metadata={"help": ("The format of the data shards, jsonl shards may be compressed (.jsonl.zst / .jsonl.gz, scripts/compress_shards.py), "
+                           "binary shards and trajectory stores (one copy of every token block "
+                           "of the overlapping clips) are converted by scripts/convert_shards_to_binary.py."),
+                  "choices": ['jsonl', 'binary', 'trajectory']}
+    )
     padding_side: Optional[str] = field(
         default='right', metadata={
             "help": "Truncation side to use for the tokenizer.",
@@ -266,11 +348,79 @@ class DataArguments:
         default=None,
         metadata={"help": "The path to save the predictions."}
     )
+    predict_batch_size: int = field(
+        default=1,
+        metadata={"help": ("The number of prompts generated together by scripts/predict.py, left-padded, "
+                           "the prompts are sorted by length within windows of batches.")},
+    )
+    constrained_decoding: bool = field(
+        default=False,
+        metadata={"help": "Predict: mask the vocabulary to the tokens legal in the output layout (see src/vla_constraints.py)."},
+    )
+    fast_forward_decoding: bool = field(
+        default=False,
+        metadata={"help": ("Predict: constrained greedy decoding that feeds the delimiters forced by the layout together with the "
+                           "previous token instead of spending a decode step on each of them.")},
+    )
+    action_only_decoding: bool = field(
+        default=False,
+        metadata={"help": ("Predict: stop the generation at <eoa_o> and only predict the output actions, for closed-loop control. "
+                           "Only action_before_vision layouts skip the output video.")},
+    )
+    free_text_slack_tokens: int = field(
+        default=128,
+        metadata={"help": ("Predict without constrained_decoding / fast_forward_decoding: the tokens allowed beyond max_output_text_tokens "
+                           "for the unconstrained output clip description, max_new_tokens is derived from the layout with them.")},
+    )
+    prefix_cache_mb: int = field(
+        default=0,
+        metadata={"help": ("Predict: the memory budget (MB) of the key / value states of the task / scene prompt prefixes shared by "
+                           "the clips of a trajectory, reused instead of prefilled again (see src/vla_prefix_cache.py). 0 disables the cache.")},
+    )
+    output_video_length: int = field(
+        default=768,
+        metadata={"help": "The number of <va*> tokens of the output video segment."},
+    )
+    output_action_length: int = field(
+        default=42,
+        metadata={"help": "The number of <va*> tokens of the output action segment."},
+    )
+    max_output_text_tokens: int = field(
+        default=128,
+        metadata={"help": ("constrained_decoding / fast_forward_decoding: the length limit of the generated output clip description, "
+                           "max_new_tokens is derived from it and the output segment lengths (plus free_text_slack_tokens for free decoding).")},
+    )
     action_before_vision: bool = field(default=False, metadata={"help": "Whether to use vision before action."})
-    start_idx: Optional[int] = field(default=0, metadata={"help": "The start index for the dataset."})
-    end_idx: Optional[int] = field(default=None, metadata={"help": "The end index for the dataset."})
+    start_idx: Optional[int] = field(default=0, metadata={"help": "The start index for the dataset (indexed_dataset)."})
+    end_idx: Optional[int] = field(default=None, metadata={"help": "The end index for the dataset (indexed_dataset)."})
     wo_text: bool = field(default=False, metadata={"help": "Whether to use text or not."})
     wo_vision: bool = field(default=False, metadata={"help": "Whether to predict output vision tokens or not."})
+    tokenizer_free: bool = field(default=False, metadata={"help": "Assemble input_ids directly from the token integers instead of tokenizing the formatted text."})
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": ("Form the training batches from samples of similar length under this budget of padded tokens "
+                           "instead of per_device_train_batch_size, should be at least max_seq_length.")},
+    )
+    length_bucket_size: int = field(
+        default=1024,
+        metadata={"help": "With max_tokens_per_batch, the number of samples sorted by length together before forming the batches."},
+    )
+    description_cache_size: int = field(
+        default=65536,
+        metadata={"help": "tokenizer_free: the number of task / scene descriptions whose token ids are cached, 0 disables the cache."},
+    )
+    pack_sequences: bool = field(
+        default=False,
+        metadata={"help": ("Pack the samples of a batch into rows of max_seq_length tokens, per_device_train_batch_size then counts samples. "
+                           "For the short wo_text / wo_vision / action_before_vision layouts.")},
+    )
+    packing_attention: str = field(
+        default='block',
+        metadata={"help": ("How packed samples are kept apart: 'block' uses a block-diagonal attention mask (eager / sdpa attention), "
+                           "'position_ids' only restarts the positions and lets the samples of a row attend to each other. "
+                           "Packing is not supported with flash attention 2."),
+                  "choices": ["block", "position_ids"]},
+    )
 
 
 @dataclass
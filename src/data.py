@@ -12,15 +12,24 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import logging
 import os
 from typing import List, Literal, Optional, Union
 
-from datasets import DatasetDict, concatenate_datasets, load_dataset, load_from_disk
+from datasets import DatasetDict, concatenate_datasets, interleave_datasets, load_dataset, load_from_disk
 from datasets.builder import DatasetGenerationError
 
 from .configs import DataArguments
 
 
+logger = logging.getLogger(__name__)
+
+# how mix_datasets combines the train subsets
+MIXING_MODES = ["concatenate", "interleave", "stream"]
+# mixture_exhaustion (see DataArguments) -> the stopping strategy of interleave_datasets
+STOPPING_STRATEGIES = {"stop": "first_exhausted", "cycle": "all_exhausted"}
+
+
 DEFAULT_CHAT_TEMPLATE = "{% for message in messages %}\n{% if message['role'] == 'user' %}\n{{ '<|user|>\n' + message['content'] + eos_token }}\n{% elif message['role'] == 'system' %}\n{{ '<|system|>\n' + message['content'] + eos_token }}\n{% elif message['role'] == 'assistant' %}\n{{ '<|assistant|>\n'  + message['content'] + eos_token }}\n{% endif %}\n{% if loop.last and add_generation_prompt %}\n{{ '<|assistant|>' }}\n{% endif %}\n{% endfor %}"
 
 
@@ -99,6 +108,11 @@ def get_datasets(
     configs: Optional[List[str]] = None,
     columns_to_keep: Optional[List[str]] = None,
     shuffle: bool = True,
+    mixing: str = "concatenate",
+    flatten_indices: bool = False,
+    mixture_exhaustion: str = "stop",
+    num_shards: int = 64,
+    seed: int = 42,
 ) -> DatasetDict:
     """
     Loads one or more datasets with varying training set proportions.
@@ -115,6 +129,8 @@ def get_datasets(
             and for cpt this should be (at least) the text column.
         shuffle (`bool`, *optional*, defaults to `True`):
             Whether to shuffle the training and testing/validation data.
+        mixing, flatten_indices, mixture_exhaustion, num_shards, seed:
+            How the datasets are combined, see `mix_datasets`.
 
     Returns
         [`DatasetDict`]: The dataset dictionary containing the loaded datasets.
@@ -138,7 +154,16 @@ def get_datasets(
         raise ValueError(f"Data config {data_config} not recognized.")
 
     raw_datasets = mix_datasets(
-        dataset_mixer, splits=splits, configs=configs, columns_to_keep=columns_to_keep, shuffle=shuffle
+        dataset_mixer,
+        splits=splits,
+        configs=configs,
+        columns_to_keep=columns_to_keep,
+        shuffle=shuffle,
+        mixing=mixing,
+        flatten_indices=flatten_indices,
+        mixture_exhaustion=mixture_exhaustion,
+        num_shards=num_shards,
+        seed=seed,
     )
     return raw_datasets
 
@@ -149,6 +174,11 @@ def mix_datasets(
     configs: Optional[List[str]] = None,
     columns_to_keep: Optional[List[str]] = None,
     shuffle=True,
+    mixing: str = "concatenate",
+    flatten_indices: bool = False,
+    mixture_exhaustion: str = "stop",
+    num_shards: int = 64,
+    seed: int = 42,
 ) -> DatasetDict:
     """
     Loads and mixes datasets according to proportions specified in `dataset_mixer`.
@@ -165,7 +195,34 @@ def mix_datasets(
             and for cpt this should be (at least) the text column.
         shuffle (`bool`, *optional*, defaults to `True`):
             Whether to shuffle the training and testing/validation data.
+        mixing (`str`, *optional*, defaults to `"concatenate"`):
+            How the train subsets are combined:
+            - `"concatenate"`: concatenated then shuffled, every read goes through the indices mapping of the shuffle.
+            - `"interleave"`: the samples are drawn from the subsets at random, in proportion to their sizes,
+              without a global shuffle. The mixture is written once to contiguous arrow files (`flatten_indices`).
+            - `"stream"`: as `"interleave"`, on `IterableDataset`s read shard by shard from the memory-mapped arrow
+              files (shard order and a buffer shuffled at every epoch with `set_epoch`), nothing is materialized.
+            The fractional subsets are contiguous prefixes of the datasets (whole shards in `"stream"` mode), so they
+            add no indices mapping. The test splits are concatenated and shuffled as in `"concatenate"` mode (by the
+            shard order and the buffer in `"stream"` mode). Text datasets can be mixed the same way for co-training.
+        flatten_indices (`bool`, *optional*, defaults to `False`):
+            Write the mixed (map-style) datasets once to contiguous arrow files, cached by fingerprint, so that
+            later reads and epochs are sequential instead of going through the indices mapping. Always done in
+            `"interleave"` mode, whose mixture is an indices mapping.
+        mixture_exhaustion (`str`, *optional*, defaults to `"stop"`):
+            `"interleave"` / `"stream"`: `"stop"` ends the mixture when a subset runs out, which drops the tails of the
+            other subsets (the number of dropped samples is logged in `"interleave"` mode), `"cycle"` restarts the
+            subsets until every one of them has been read through, which repeats samples of the smaller ones.
+        num_shards (`int`, *optional*, defaults to 64):
+            `"stream"`: the number of contiguous shards of every dataset, the unit of the fractional subsets and of the
+            shuffle of the shard order, should be a multiple of the number of dataloader workers.
+        seed (`int`, *optional*, defaults to 42):
+            The seed of the shuffles and of the interleaving.
     """
+    if mixing not in MIXING_MODES:
+        raise ValueError(f"Mixing mode {mixing} not recognized, expected one of {MIXING_MODES}.")
+    if mixture_exhaustion not in STOPPING_STRATEGIES:
+        raise ValueError(f"Mixture exhaustion {mixture_exhaustion} not recognized, expected one of {list(STOPPING_STRATEGIES)}.")
     splits = ["train", "test"] if splits is None else splits
     configs = [None] * len(dataset_mixer) if not configs else configs
     columns_to_keep = [] if columns_to_keep is None else columns_to_keep
@@ -199,21 +256,32 @@ def mix_datasets(
     if any(frac < 0 for frac in fracs):
         raise ValueError("Dataset fractions cannot be negative.")
 
-    if len(raw_train_datasets) > 0:
-        train_subsets = []
-        for dataset, frac in zip(raw_train_datasets, fracs):
-            train_subset = dataset.select(range(int(frac * len(dataset))))
-            train_subsets.append(train_subset)
-        if shuffle:
-            raw_datasets["train"] = concatenate_datasets(train_subsets).shuffle(seed=42)
-        else:
-            raw_datasets["train"] = concatenate_datasets(train_subsets)
-    # No subsampling for test datasets to enable fair comparison across models
-    if len(raw_val_datasets) > 0:
-        if shuffle:
-            raw_datasets["test"] = concatenate_datasets(raw_val_datasets).shuffle(seed=42)
-        else:
-            raw_datasets["test"] = concatenate_datasets(raw_val_datasets)
+    if mixing != "concatenate":
+        raw_datasets = _interleave_splits(
+            raw_train_datasets, raw_val_datasets, fracs, shuffle, mixing, mixture_exhaustion, num_shards, seed
+        )
+    else:
+        if len(raw_train_datasets) > 0:
+            train_subsets = []
+            for dataset, frac in zip(raw_train_datasets, fracs):
+                train_subset = dataset.select(range(int(frac * len(dataset))))
+                train_subsets.append(train_subset)
+            if shuffle:
+                raw_datasets["train"] = concatenate_datasets(train_subsets).shuffle(seed=seed)
+            else:
+                raw_datasets["train"] = concatenate_datasets(train_subsets)
+        # No subsampling for test datasets to enable fair comparison across models
+        if len(raw_val_datasets) > 0:
+            if shuffle:
+                raw_datasets["test"] = concatenate_datasets(raw_val_datasets).shuffle(seed=seed)
+            else:
+                raw_datasets["test"] = concatenate_datasets(raw_val_datasets)
+
+    if (flatten_indices or mixing == "interleave") and mixing != "stream":
+        # one sequential copy instead of an indirection on every read, reused from the cache on the next runs
+        for split in raw_datasets:
+            if raw_datasets[split]._indices is not None:
+                raw_datasets[split] = raw_datasets[split].flatten_indices()
 
     if len(raw_datasets) == 0:
         raise ValueError(
@@ -221,3 +289,68 @@ def mix_datasets(
         )
 
     return raw_datasets
+
+
+def _contiguous_subset(dataset, frac, num_shards=None):
+    """
+    The first `frac` of `dataset`, a contiguous range of rows (whole shards when `num_shards` is given),
+    selected without an indices mapping.
+    """
+    if frac > 1:
+        raise ValueError(f"Dataset fraction {frac} is larger than 1, use mixture_exhaustion='cycle' to oversample.")
+    if num_shards is None:
+        return dataset.select(range(int(frac * len(dataset))))
+    num_shards = min(num_shards, len(dataset))
+    kept = max(round(frac * num_shards), 1) if frac > 0 else 0
+    # the boundary of shard `kept` of dataset.shard(num_shards, contiguous=True)
+    div, mod = divmod(len(dataset), num_shards)
+    return dataset.select(range(kept * div + min(kept, mod)))
+
+
+def _interleave_splits(raw_train_datasets, raw_val_datasets, fracs, shuffle, mixing, mixture_exhaustion, num_shards, seed):
+    """
+    The `interleave` and `stream` modes of `mix_datasets`.
+    """
+    raw_datasets = DatasetDict()
+    stream = mixing == "stream"
+    stopping_strategy = STOPPING_STRATEGIES[mixture_exhaustion]
+
+    def to_stream(dataset):
+        dataset = dataset.to_iterable_dataset(num_shards=min(num_shards, len(dataset)))
+        return dataset.shuffle(seed=seed) if shuffle else dataset
+
+    if len(raw_train_datasets) > 0:
+        train_subsets = [
+            _contiguous_subset(dataset, frac, num_shards if stream else None)
+            for dataset, frac in zip(raw_train_datasets, fracs)
+        ]
+        train_subsets = [subset for subset in train_subsets if len(subset) > 0]
+        sizes = [len(subset) for subset in train_subsets]
+        probabilities = [size / sum(sizes) for size in sizes]
+        if stream:
+            train_subsets = [to_stream(subset) for subset in train_subsets]
+        if len(train_subsets) == 1:
+            raw_datasets["train"] = train_subsets[0]
+        else:
+            raw_datasets["train"] = interleave_datasets(
+                train_subsets, probabilities=probabilities, seed=seed, stopping_strategy=stopping_strategy
+            )
+            if not stream:
+                difference = len(raw_datasets["train"]) - sum(sizes)
+                if difference < 0:
+                    logger.warning(
+                        f"mixture_exhaustion='stop' drops {-difference} of the {sum(sizes)} train samples "
+                        "(the tails of the subsets that did not run out first)"
+                    )
+                elif difference > 0:
+                    logger.info(f"mixture_exhaustion='cycle' repeats {difference} train samples of the smaller subsets")
+            elif stopping_strategy == "first_exhausted":
+                logger.warning("mixture_exhaustion='stop' ends the train stream when a subset runs out, dropping the tails of the others")
+    # No subsampling for test datasets to enable fair comparison across models
+    if len(raw_val_datasets) > 0:
+        raw_datasets["test"] = concatenate_datasets(raw_val_datasets)
+        if stream:
+            raw_datasets["test"] = to_stream(raw_datasets["test"])
+        elif shuffle:
+            raw_datasets["test"] = raw_datasets["test"].shuffle(seed=seed)
+    return raw_datasets
@@ -5,6 +5,8 @@ from torch.utils.data import DataLoader
 import random
 import numpy as np
 
+from .vla_encoder import IGNORE_INDEX, DescriptionTokenCache
+
 '''
 data are stored in json files, each json file contains a "data" field which is a list of json objects
 with following fields: 'text', 'Visual', 'Action', "ID", "Frame_number"
@@ -69,6 +71,35 @@ def get_VLA_dataset(args, vocab_size, split='train'):
                                                         "num_input": args.num_input_frames, "num_output": args.num_output_frames})
     return ds
 
+def sliding_windows(array, window):
+    '''
+    all the windows of `window` consecutive rows of a 2D array, as a read-only (num_windows, window, row) view without copy
+    '''
+    num_windows = max(array.shape[0] - window + 1, 0)
+    return np.lib.stride_tricks.as_strided(array, shape=(num_windows, window) + array.shape[1:],
+                                           strides=(array.strides[0],) + array.strides, writeable=False)
+
+def load_trajectory(instance_info):
+    '''
+    the Visual / Action lists of a whole-trajectory record as contiguous (frames, tokens per frame) arrays, converted once
+    '''
+    visual = np.ascontiguousarray(instance_info['Visual'], dtype=np.int32)
+    action = np.ascontiguousarray(instance_info['Action'], dtype=np.int32)
+    return visual.reshape(len(visual), -1), action.reshape(len(action), -1)
+
+def iter_trajectory_windows(visual, action, num_input, num_output):
+    '''
+    the clips of every start frame of a trajectory as views into its arrays (O(T) instead of O(T * window) copies)
+    yields (start_frame, input_visual, output_visual, input_action, output_action), of shapes
+    (num_input, V), (num_output, V), (num_input - 1, A), (num_output, A)
+    '''
+    # the clip of start frame s reads the frames s .. s+num_input+num_output-1 and the actions s .. s+num_input+num_output-2
+    visual_windows = sliding_windows(visual, num_input + num_output)
+    action_windows = sliding_windows(action, num_input + num_output - 1)
+    for start_frame in range(min(len(visual_windows), len(action_windows))):
+        visual_window, action_window = visual_windows[start_frame], action_windows[start_frame]
+        yield start_frame, visual_window[:num_input], visual_window[num_input:], action_window[:num_input - 1], action_window[num_input - 1:]
+
 def gen_processed(shards, num_input, num_output, eos_token):
     for shard in shards:
         with open(shard, "r") as f:
@@ -77,28 +108,100 @@ def gen_processed(shards, num_input, num_output, eos_token):
                 num_frames = instance_info["Frame_number"]
                 if num_frames < num_input + num_output:
                     continue
+                visual, action = load_trajectory(instance_info)
+                # the <v{x}> / <a{x}> string of every frame is formatted once per trajectory, a clip joins its frames
+                visual_strings = [''.join([f'<v{x}>' for x in frame]) for frame in visual.tolist()]
+                action_strings = [''.join([f'<a{x}>' for x in frame]) for frame in action.tolist()]
                 for start_frame in range(0, num_frames - num_input - num_output + 1):
-                    ret = {}
-                    ret['input_visual'] = np.array(instance_info['Visual'][start_frame:start_frame+num_input], dtype=np.int32).flatten() 
-                    ret['output_visual'] = np.array(instance_info['Visual'][start_frame+num_input:start_frame+num_input+num_output], dtype=np.int32).flatten()
-                    ret['input_action'] = np.array(instance_info['Action'][start_frame:start_frame+num_input-1], dtype=np.int32).flatten()
-                    ret['output_action'] = np.array(instance_info['Action'][start_frame+num_input-1:start_frame+num_input+num_output-1], dtype=np.int32).flatten()
-                    ret['task_description'] = instance_info['Text']
-                    ret['input_plan_description'] = instance_info['Plan'][start_frame] if 'Plan' in instance_info else ''
-                    ret['output_plan_description'] = instance_info['Plan'][start_frame+num_input] if 'Plan' in instance_info else ''
-
-                    text = '<bot_i>' + ret['task_description'] + ret['input_plan_description'] + '<eot_i>' + \
-                            '<bov_i>' + ''.join([f'<v{str(x)}>' for x in ret['input_visual']]) + '<eov_i>' + \
-                            '<boa_i>' + ''.join([f'<a{str(x)}>' for x in ret['input_action']]) + '<eoa_i>' + \
-                            '<bot_o>' + ret['output_plan_description'] + '<eot_o>' + \
-                            '<bov_o>' + ''.join([f'<v{str(x)}>' for x in ret['output_visual']]) + '<eov_o>' + \
-                            '<boa_o>' + ''.join([f'<a{str(x)}>' for x in ret['output_action']]) + '<eoa_o>' + eos_token
+                    task_description = instance_info['Text']
+                    input_plan_description = instance_info['Plan'][start_frame] if 'Plan' in instance_info else ''
+                    output_plan_description = instance_info['Plan'][start_frame+num_input] if 'Plan' in instance_info else ''
+
+                    text = '<bot_i>' + task_description + input_plan_description + '<eot_i>' + \
+                            '<bov_i>' + ''.join(visual_strings[start_frame:start_frame+num_input]) + '<eov_i>' + \
+                            '<boa_i>' + ''.join(action_strings[start_frame:start_frame+num_input-1]) + '<eoa_i>' + \
+                            '<bot_o>' + output_plan_description + '<eot_o>' + \
+                            '<bov_o>' + ''.join(visual_strings[start_frame+num_input:start_frame+num_input+num_output]) + '<eov_o>' + \
+                            '<boa_o>' + ''.join(action_strings[start_frame+num_input-1:start_frame+num_input+num_output-1]) + '<eoa_o>' + eos_token
                     yield {'text': text}
 
-def get_VLA_dataset_processed(args, eos_token, split='train'):
+PROCESSED_SPECIAL_TOKENS = ['<bot_i>', '<eot_i>', '<bov_i>', '<eov_i>', '<boa_i>', '<eoa_i>',
+                            '<bot_o>', '<eot_o>', '<bov_o>', '<eov_o>', '<boa_o>', '<eoa_o>']
+
+class ProcessedIdAssembler:
+    '''
+    tokenizer-free input_ids for the layout of gen_processed, <v{x}> and <a{x}> must each be one contiguous block of ids,
+    only the descriptions are tokenized, memoized by the exact string tokenized (see DescriptionTokenCache)
+    '''
+    def __init__(self, tokenizer, num_visual_tokens, num_action_tokens):
+        self.tokenizer = tokenizer
+        self.v_base = tokenizer.convert_tokens_to_ids('<v0>')
+        self.a_base = tokenizer.convert_tokens_to_ids('<a0>')
+        if tokenizer.convert_tokens_to_ids(f'<v{num_visual_tokens - 1}>') - self.v_base != num_visual_tokens - 1 or \
+                tokenizer.convert_tokens_to_ids(f'<a{num_action_tokens - 1}>') - self.a_base != num_action_tokens - 1:
+            raise ValueError('The <v*> / <a*> tokens are not contiguous in the tokenizer vocabulary')
+        self.token_ids = {token: tokenizer.convert_tokens_to_ids(token) for token in PROCESSED_SPECIAL_TOKENS}
+        # every piece is an int64 array, an empty list would make the concatenation float64
+        use_bos = getattr(tokenizer, 'add_bos_token', False) and tokenizer.bos_token_id is not None
+        self.bos_ids = np.array([tokenizer.bos_token_id] if use_bos else [], dtype=np.int64)
+        self.eos_ids = np.array([tokenizer.eos_token_id], dtype=np.int64)
+        self.description_cache = DescriptionTokenCache(self._text)
+
+    def _text(self, text):
+        return np.array(self.tokenizer(text, add_special_tokens=False).input_ids, dtype=np.int64)
+
+    def _segment(self, name, ids):
+        return np.concatenate([np.array([self.token_ids[f'<bo{name}>']], dtype=np.int64), np.asarray(ids, dtype=np.int64),
+                               np.array([self.token_ids[f'<eo{name}>']], dtype=np.int64)])
+
+    def assemble(self, input_description, output_description, input_visual, output_visual, input_action, output_action):
+        '''
+        returns (prompt_ids, response_ids) as int64 arrays, the token arrays are the views of iter_trajectory_windows
+        input_description / output_description are the strings between <bot_i> <eot_i> / <bot_o> <eot_o> in gen_processed
+        '''
+        prompt_ids = np.concatenate([self.bos_ids,
+                                     self._segment('t_i', self.description_cache(input_description)),
+                                     self._segment('v_i', input_visual.reshape(-1) + self.v_base),
+                                     self._segment('a_i', input_action.reshape(-1) + self.a_base)])
+        response_ids = np.concatenate([self._segment('t_o', self.description_cache(output_description)),
+                                       self._segment('v_o', output_visual.reshape(-1) + self.v_base),
+                                       self._segment('a_o', output_action.reshape(-1) + self.a_base),
+                                       self.eos_ids])
+        return prompt_ids, response_ids
+
+def gen_processed_ids(shards, num_input, num_output, assembler, max_seq_length=None):
+    '''
+    the clips of gen_processed as input_ids / attention_mask / completion-only labels, assembled from the window views
+    '''
+    for shard in shards:
+        with open(shard, "r") as f:
+            for line in f:
+                instance_info = json.loads(line)
+                if instance_info["Frame_number"] < num_input + num_output:
+                    continue
+                visual, action = load_trajectory(instance_info)
+                for start_frame, input_visual, output_visual, input_action, output_action in \
+                        iter_trajectory_windows(visual, action, num_input, num_output):
+                    input_plan_description = instance_info['Plan'][start_frame] if 'Plan' in instance_info else ''
+                    output_plan_description = instance_info['Plan'][start_frame+num_input] if 'Plan' in instance_info else ''
+                    # the task and the input plan are tokenized together, as in the text of gen_processed
+                    prompt_ids, response_ids = assembler.assemble(instance_info['Text'] + input_plan_description, output_plan_description,
+                                                                  input_visual, output_visual, input_action, output_action)
+                    input_ids = np.concatenate([prompt_ids, response_ids])[:max_seq_length]
+                    labels = np.concatenate([np.full(len(prompt_ids), IGNORE_INDEX), response_ids])[:max_seq_length]
+                    yield {'input_ids': input_ids, 'attention_mask': np.ones_like(input_ids), 'labels': labels}
+
+def get_VLA_dataset_processed(args, eos_token, split='train', tokenizer=None, max_seq_length=None):
+    '''
+    with a tokenizer and args.tokenizer_free, the clips are yielded as input_ids (gen_processed_ids) instead of text
+    '''
     root = args.data_root
     file_format = 'data_bridge2_processed_{}.jsonl'
     shards = [os.path.join(root, split, file_format.format(i)) for i in range(len(os.listdir(os.path.join(root, split))))]
+    if tokenizer is not None and getattr(args, 'tokenizer_free', False):
+        assembler = ProcessedIdAssembler(tokenizer, args.num_visual_tokens, args.num_action_tokens)
+        return Dataset.from_generator(gen_processed_ids, gen_kwargs={"shards": shards, "assembler": assembler, "max_seq_length": max_seq_length,
+                                                                     "num_input": args.num_input_frames, "num_output": args.num_output_frames})
     ds = Dataset.from_generator(gen_processed, gen_kwargs={"shards": shards, "eos_token": eos_token,
                                                         "num_input": args.num_input_frames, "num_output": args.num_output_frames})
     return ds
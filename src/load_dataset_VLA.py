@@ -1,4 +1,7 @@
-import json
+import functools
+import itertools
+import logging
+import math
 import os
 from datasets import Dataset, DatasetDict, IterableDataset, Dataset
 from torch.utils.data import DataLoader
@@ -6,7 +9,72 @@ import random
 import numpy as np
 import glob
 
-def VLA_dataset_generator(shards, eos_token, static_video_description, return_info, action_before_vision, wo_text, wo_vision):
+from .vla_compression import JSONL_SHARD_SUFFIXES, open_jsonl_shard, shard_compression
+from .vla_cache import get_VLA_cache_key, load_or_build_VLA_dataset, share_VLA_dataset_on_node
+from .vla_decode import (RAW_INFO_FIELDS, VLA_required_fields, collect_shard_stats, decode_VLA_line, dump_shard_stats, get_shard_stats,
+                         log_shard_stats, set_json_backend)
+from .vla_index import VLAIndexedDataset
+from .vla_prefetch import VLAShardPrefetcher
+from .vla_shards import BINARY_SHARD_SUFFIX, TRAJECTORY_STORE_SUFFIX, is_array_shard, open_array_shard
+from .vla_streaming import VLAStreamingDataset, format_mixture, interleave_streams, weighted_interleave
+
+logger = logging.getLogger(__name__)
+
+def iter_VLA_instances(shard, start_line=0, offsets=None, skip_malformed=True, fields=None, stats=None, prefetcher=None):
+    '''
+    yield the json objects stored in a shard, a jsonl file (.jsonl, .jsonl.zst or .jsonl.gz, see vla_compression.py),
+    a binary shard or a trajectory store directory (see vla_shards.py)
+    lines that cannot be decoded are skipped, or yielded as None with skip_malformed=False to keep the line numbering
+    start_line: the first line to read, reached with a single seek when the line-offset index of the shard is given
+    fields: only keep these fields of each object (see VLA_required_fields)
+    stats: a VLAShardStats counting the decoded and malformed lines
+    prefetcher: a VLAShardPrefetcher reading the jsonl shards ahead in the background
+    '''
+    if is_array_shard(shard):
+        array_shard = open_array_shard(shard)
+        for idx in range(start_line, len(array_shard)):
+            if stats is not None:
+                stats.decoded += 1
+            yield array_shard.read(idx, fields)
+        return
+    seek = start_line > 0 and offsets is not None and shard_compression(shard) is None
+    if prefetcher is not None and seek:
+        prefetcher.cancel(shard)
+    # bytes are decoded by the json backend directly
+    with prefetcher.open(shard) if prefetcher is not None and not seek else open_jsonl_shard(shard) as f:
+        if seek:
+            f.seek(int(offsets[start_line]))
+        elif start_line > 0:
+            for _ in zip(range(start_line), f):
+                pass
+        for line in f:
+            try:
+                instance_data = decode_VLA_line(line, fields)
+            except ValueError:
+                if stats is not None:
+                    stats.malformed += 1
+                if not skip_malformed:
+                    yield None
+                continue
+            if stats is not None:
+                stats.decoded += 1
+            yield instance_data
+
+def iter_VLA_shard(shard, format_kwargs, prefetcher=None):
+    # seeded by the shard path so that the sampled static descriptions do not depend on the process layout
+    rng = random.Random(shard)
+    stats = get_shard_stats(shard)
+    for instance_data in iter_VLA_instances(shard, fields=VLA_required_fields(**format_kwargs), stats=stats, prefetcher=prefetcher):
+        example = format_VLA_instance(instance_data, rng, **format_kwargs)
+        if example is None:
+            stats.skipped += 1
+            continue
+        yield example
+    stats.log()
+
+def VLA_dataset_generator(shards, eos_token, static_video_description, return_info, action_before_vision, wo_text, wo_vision, encoder=None,
+                          num_open_shards=1, shuffle_seed=0, shard_roots=None, root_weights=None, root_names=None, mixture_exhaustion='stop',
+                          prefetch_shards=0, prefetch_max_mb=1024):
     '''
     each shard is a jsonl file, with each line containing a json object
     the json object contains the following fields:
@@ -40,77 +108,193 @@ def VLA_dataset_generator(shards, eos_token, static_video_description, return_in
             200 task description, scene description, input clip, output clip
             2 eos_token and bos_token (will be automatically added by the tokenizer)
             thus, 2048 sequence length is enough
+
+    if encoder (a VLAEncoder) is given, the text is not formatted and the generator yields
+    'input_ids', 'attention_mask', 'labels' and 'prompt_length' assembled directly from the token integers,
+    with return_info the raw description / token fields are yielded as well for the predict scripts
+
+    with num_open_shards > 1, that many shards are read at once and the samples are drawn from them at random
+
+    with root_weights, shard_roots gives the index of the data root of each shard and the samples are drawn from
+    the roots with these weights (see weighted_interleave), the realized mixture is logged at the end
+
+    the malformed / skipped lines of every shard are counted (see vla_decode.py) and logged at the end
+
+    with prefetch_shards > 0, the next prefetch_shards shards are read into memory (at most prefetch_max_mb) by background
+    threads while the current ones are parsed (see vla_prefetch.py), the stall time is logged at the end
     '''
+    format_kwargs = {"eos_token": eos_token, "static_video_description": static_video_description, "return_info": return_info,
+                     "action_before_vision": action_before_vision, "wo_text": wo_text, "wo_vision": wo_vision, "encoder": encoder}
+
+    def open_shards(group):
+        if num_open_shards > 1:
+            rng = random.Random(f'{shuffle_seed}:' + ','.join(group))
+            return interleave_streams([functools.partial(iter_VLA_shard, shard, format_kwargs, prefetcher) for shard in group], num_open_shards, rng)
+        return itertools.chain.from_iterable(iter_VLA_shard(shard, format_kwargs, prefetcher) for shard in group)
 
-    for shard in shards:
-        with open(shard, "r") as f:
-            for line in f:
-                try:
-                    instance_data = json.loads(line)
-                    if wo_text:
-                        text_input = '<bott_i>' + instance_data['task_description'] + '<eott_i>'
-                        text_output = ''
-                    else:
-                        if instance_data['input_clip_description'] == '': # sample a description for the input clip
-                            instance_data['input_clip_description'] = random.choice(static_video_description)
-                        text_input = '<bott_i>' + instance_data['task_description'] + '<eott_i>' + \
-                                '<bots_i>' + instance_data['scene_description'] + '<eots_i>' + \
-                                '<botp_i>' + instance_data['input_clip_description'] + '<eotp_i>'
-                        text_output = '<botp_o>' + instance_data['output_clip_description'] + '<eotp_o>'
-                        
-                    if action_before_vision:
-                        text_input += '<boa_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_action_tokens']]) + '<eoa_i>' + \
-                                '<bov_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_video_tokens']]) + '<eov_i>'
-                        text_output += '<boa_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_action_tokens']]) + '<eoa_o>'
-                        if not wo_vision:
-                            text_output += '<bov_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_video_tokens']]) + '<eov_o>'
-                    else:
-                        text_input += '<bov_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_video_tokens']]) + '<eov_i>' + \
-                                '<boa_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_action_tokens']]) + '<eoa_i>'
-                        if not wo_vision:
-                            text_output += '<bov_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_video_tokens']]) + '<eov_o>'
-                        text_output += '<boa_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_action_tokens']]) + '<eoa_o>'
-                    text_output += eos_token
-                except:
-                    continue
-
-                if return_info:
-                    yield {"input": text_input, "output": text_output, 
-                           "trajectory_id": instance_data['trajectory_id'], "view": instance_data['view'],
-                           "gt_actions": instance_data['gt_actions']}
-                else:
-                    yield {"input": text_input, "output": text_output}
-
-def get_VLA_dataset(args, eos_token, split='train', return_info=False):
+    # the shards of each root are read in order
+    groups = [shards]
+    if root_weights is not None:
+        # only the roots that have shards in this process / worker take part in the mixture
+        roots = sorted(set(shard_roots))
+        groups = [[shard for shard, root in zip(shards, shard_roots) if root == r] for r in roots]
+    prefetcher = VLAShardPrefetcher(groups, num_ahead=prefetch_shards, max_bytes=prefetch_max_mb * 1024 ** 2) if prefetch_shards > 0 else None
+    try:
+        if root_weights is None:
+            yield from open_shards(shards)
+        else:
+            realized = [0] * len(roots)
+            rng = random.Random(f'{shuffle_seed}:mixture:' + ','.join(shards))
+            yield from weighted_interleave([functools.partial(open_shards, group) for group in groups], [root_weights[r] for r in roots],
+                                           rng, exhaustion=mixture_exhaustion, realized=realized)
+            logger.info(f'Realized mixture over {len(shards)} shards: ' + format_mixture([root_names[r] for r in roots], realized))
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    log_shard_stats(shards)
+    dump_shard_stats(shards)
+    if prefetcher is not None:
+        logger.info(f'Shard prefetch: {prefetcher.stats()}')
+    if encoder is not None:
+        logger.info(f'Description token cache: {encoder.description_cache.stats()}')
+
+def format_VLA_instance(instance_data, rng, eos_token, static_video_description, return_info, action_before_vision, wo_text, wo_vision, encoder=None):
+    '''
+    format one json object of a shard into a sample of VLA_dataset_generator, returns None if the object is malformed
+    '''
+    if encoder is not None:
+        try:
+            example = encoder.encode(instance_data, rng=rng)
+        except (KeyError, TypeError, ValueError):
+            return None
+        if return_info:
+            example.update({k: np.asarray(instance_data[k]).tolist() if 'tokens' in k else instance_data[k] for k in RAW_INFO_FIELDS})
+            example.update({"trajectory_id": instance_data['trajectory_id'], "view": instance_data['view'],
+                            "gt_actions": np.asarray(instance_data['gt_actions']).tolist()})
+        return example
+
+    try:
+        if wo_text:
+            text_input = '<bott_i>' + instance_data['task_description'] + '<eott_i>'
+            text_output = ''
+        else:
+            if instance_data['input_clip_description'] == '': # sample a description for the input clip
+                instance_data['input_clip_description'] = rng.choice(static_video_description)
+            text_input = '<bott_i>' + instance_data['task_description'] + '<eott_i>' + \
+                    '<bots_i>' + instance_data['scene_description'] + '<eots_i>' + \
+                    '<botp_i>' + instance_data['input_clip_description'] + '<eotp_i>'
+            text_output = '<botp_o>' + instance_data['output_clip_description'] + '<eotp_o>'
+
+        if action_before_vision:
+            text_input += '<boa_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_action_tokens']]) + '<eoa_i>' + \
+                    '<bov_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_video_tokens']]) + '<eov_i>'
+            text_output += '<boa_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_action_tokens']]) + '<eoa_o>'
+            if not wo_vision:
+                text_output += '<bov_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_video_tokens']]) + '<eov_o>'
+        else:
+            text_input += '<bov_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_video_tokens']]) + '<eov_i>' + \
+                    '<boa_i>' + ''.join([f'<va{str(x)}>' for x in instance_data['input_action_tokens']]) + '<eoa_i>'
+            if not wo_vision:
+                text_output += '<bov_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_video_tokens']]) + '<eov_o>'
+            text_output += '<boa_o>' + ''.join([f'<va{str(x)}>' for x in instance_data['output_action_tokens']]) + '<eoa_o>'
+        text_output += eos_token
+    except (KeyError, TypeError, IndexError):
+        return None
+
+    if return_info:
+        return {"input": text_input, "output": text_output,
+                "trajectory_id": instance_data['trajectory_id'], "view": instance_data['view'],
+                "gt_actions": np.asarray(instance_data['gt_actions']).tolist()}
+    else:
+        return {"input": text_input, "output": text_output}
+
+def get_VLA_shards(args, split='train', return_roots=False):
+    '''
+    the sorted shard list, with return_roots also the index in data_roots of the root of each shard
+    '''
+    # jsonl shards may be compressed
+    suffixes = {'binary': [BINARY_SHARD_SUFFIX], 'trajectory': [TRAJECTORY_STORE_SUFFIX]}.get(args.shard_format, JSONL_SHARD_SUFFIXES)
     if args.data_root is not None:
         root = args.data_root
-        shards = glob.glob(os.path.join(root, split, '*.jsonl'))
+        shards = [(shard, 0) for suffix in suffixes for shard in glob.glob(os.path.join(root, split, '*' + suffix))]
     elif args.data_roots is not None:
         shards = []
-        for root in args.data_roots:
-            shards.extend(glob.glob(os.path.join(root, split, '*.jsonl')))
+        for root_idx, root in enumerate(args.data_roots):
+            shards.extend((shard, root_idx) for suffix in suffixes for shard in glob.glob(os.path.join(root, split, '*' + suffix)))
     else:
         assert False, 'data_root or data_roots must be provided'
     shards = sorted(shards)
+    if return_roots:
+        return [shard for shard, _ in shards], [root for _, root in shards]
+    return [shard for shard, _ in shards]
+
+def get_VLA_dataset(args, eos_token, split='train', return_info=False, encoder=None):
+    set_json_backend(args.json_backend)
+    shards, shard_roots = get_VLA_shards(args, split, return_roots=True)
     if args.data_debug:
-        shards = shards[:1]
+        shards, shard_roots = shards[:1], shard_roots[:1]
+    # only `shards` may be a list: datasets splits every list in gen_kwargs into contiguous groups,
+    # one per process (from_generator with num_proc) or per dataloader worker (IterableDataset)
+    gen_kwargs = {"shards": shards,
+                  "eos_token": eos_token,
+                  "static_video_description": tuple(args.static_video_description),
+                  "return_info": return_info,
+                  "action_before_vision": args.action_before_vision,
+                  "wo_text": args.wo_text,
+                  "wo_vision": args.wo_vision,
+                  "encoder": encoder
+                  }
+    format_kwargs = {k: v for k, v in gen_kwargs.items() if k != 'shards'}
+    if args.prefetch_shards > 0:
+        gen_kwargs.update({"prefetch_shards": args.prefetch_shards, "prefetch_max_mb": args.prefetch_max_mb})
+    if args.data_root_weights is not None:
+        if args.data_roots is None or len(args.data_root_weights) != len(args.data_roots):
+            raise ValueError('data_root_weights must have one weight per entry of data_roots')
+        # a root with a weight of 0 is never drawn, so never exhausted, and mixture_exhaustion='cycle' would never end
+        if not all(math.isfinite(weight) and weight > 0 for weight in args.data_root_weights):
+            raise ValueError(f'data_root_weights must be finite and positive, got {args.data_root_weights}, '
+                             'remove a data root from data_roots to leave it out of the mixture')
+        if args.dataset_type == 'indexed_dataset':
+            logger.warning('data_root_weights is ignored by indexed_dataset, which exposes every line of the shards')
+        # shard_roots is a list parallel to shards, so it is split together with it
+        gen_kwargs.update({"shard_roots": shard_roots,
+                           "root_weights": tuple(args.data_root_weights),
+                           "root_names": tuple(args.data_roots),
+                           "mixture_exhaustion": args.mixture_exhaustion})
     if args.dataset_type == 'dataset':
-        ds = Dataset.from_generator(VLA_dataset_generator, gen_kwargs={"shards": shards, 
-                                                            "eos_token": eos_token,
-                                                            "static_video_description": args.static_video_description,
-                                                            "return_info": return_info,
-                                                            "action_before_vision": args.action_before_vision,
-                                                            "wo_text": args.wo_text,
-                                                            "wo_vision": args.wo_vision
-                                                            })
+        num_proc = args.dataset_num_proc if args.dataset_num_proc is not None and args.dataset_num_proc > 1 else None
+        def build_fn(cache_dir=None):
+            if num_proc is None:
+                return Dataset.from_generator(VLA_dataset_generator, gen_kwargs=gen_kwargs, cache_dir=cache_dir)
+            # the line counters of the generator processes are merged here
+            with collect_shard_stats():
+                ds = Dataset.from_generator(VLA_dataset_generator, gen_kwargs=gen_kwargs, num_proc=num_proc, cache_dir=cache_dir)
+            log_shard_stats(shards)
+            return ds
+        if args.dataset_cache_dir is not None:
+            ds = load_or_build_VLA_dataset(args.dataset_cache_dir, get_VLA_cache_key(split, gen_kwargs), build_fn,
+                                           max_size_gb=args.dataset_cache_max_gb)
+        elif args.dataset_share_on_node: # built by one local rank, memory-mapped by the others
+            ds = share_VLA_dataset_on_node(args.dataset_share_dir, get_VLA_cache_key(split, gen_kwargs), build_fn,
+                                           keep=args.dataset_share_keep)
+        else:
+            ds = build_fn()
+    elif args.dataset_type == 'indexed_dataset': # random access through the per-shard line-offset indexes
+        ds = VLAIndexedDataset(shards, format_kwargs, start_idx=args.start_idx, end_idx=args.end_idx, index_dir=args.shard_index_dir)
+    elif args.streaming_shard_by_rank: # iterable dataset, disjoint shards per rank and dataloader worker, resumable
+        if encoder is None:
+            raise ValueError('streaming_shard_by_rank yields tokenized samples and requires tokenizer_free')
+        ds = VLAStreamingDataset(shards, format_kwargs, index_dir=args.shard_index_dir, num_open_shards=args.shuffle_open_shards,
+                                 shuffle_buffer_size=args.shuffle_buffer_size, shuffle_seed=args.shuffle_seed,
+                                 shard_roots=shard_roots if args.data_root_weights is not None else None,
+                                 root_weights=args.data_root_weights, root_names=args.data_roots,
+                                 mixture_exhaustion=args.mixture_exhaustion, prefetch_shards=args.prefetch_shards,
+                                 prefetch_max_mb=args.prefetch_max_mb)
     else: # iterable dataset
-        ds = IterableDataset.from_generator(VLA_dataset_generator, gen_kwargs={"shards": shards, 
-                                                                "eos_token": eos_token,
-                                                                "static_video_description": args.static_video_description,
-                                                                "return_info": return_info,
-                                                                "action_before_vision": args.action_before_vision,
-                                                                "wo_text": args.wo_text,
-                                                                "wo_vision": args.wo_vision
-                                                                })
+        gen_kwargs.update({"num_open_shards": args.shuffle_open_shards, "shuffle_seed": args.shuffle_seed})
+        ds = IterableDataset.from_generator(VLA_dataset_generator, gen_kwargs=gen_kwargs)
+        if args.shuffle_buffer_size > 1:
+            # shuffles the shard order and draws from a buffer, reseeded with seed + epoch by set_epoch
+            ds = ds.shuffle(seed=args.shuffle_seed, buffer_size=args.shuffle_buffer_size)
         # ds.column_names = ['text']
-    return ds
\ No newline at end of file
+    return ds
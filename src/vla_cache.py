@@ -0,0 +1,189 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from datasets import load_from_disk
+from filelock import FileLock
+
+'''
+content-addressed on-disk cache of the datasets built by get_VLA_dataset
+
+the key hashes the shard paths with their sizes / mtimes together with every option that changes the generated samples,
+so a rebuilt or re-tokenized shard, or a different action_before_vision / wo_text / wo_vision setting, misses the cache
+- hits are opened with load_from_disk, i.e. memory-mapped arrow files
+- on a miss, the first process to take the lock of the key builds and saves the dataset, the others wait on the lock
+- entries are evicted in least-recently-used order once the cache exceeds its size budget
+
+share_VLA_dataset_on_node uses the same mechanism on a node-local tmpfs (/dev/shm) without a persistent cache: one
+local rank parses the shards and publishes the dataset, the other local ranks memory-map the same arrow files
+read-only, so a node holds a single copy of the decoded data and parses the shards once instead of once per GPU.
+The processes using a shared entry are registered in <entry>.users, the last one to exit removes it
+
+build_fn receives a scratch cache_dir for the arrow files written while building (Dataset.from_generator), it is
+removed once the entry is saved, so the data is not stored a second time in the HF datasets cache
+'''
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+_COMPLETE_MARKER = 'vla_cache_complete.json'
+_LAST_USED_MARKER = 'vla_cache_last_used'
+_USERS_SUFFIX = '.users'
+
+
+def shard_signature(shard):
+    '''
+    [path, size, mtime] of a shard, which changes when the shard is rewritten
+    binary shards are directories, the size of their files is summed and the newest mtime is used
+    '''
+    if os.path.isdir(shard):
+        stats = [os.stat(os.path.join(shard, name)) for name in sorted(os.listdir(shard))]
+        return [shard, sum(s.st_size for s in stats), max((s.st_mtime_ns for s in stats), default=0)]
+    stat = os.stat(shard)
+    return [shard, stat.st_size, stat.st_mtime_ns]
+
+
+def _encoder_signature(encoder):
+    if encoder is None:
+        return None
+    tokenizer = encoder.tokenizer
+    return [tokenizer.name_or_path, len(tokenizer), encoder.va_base, encoder.max_seq_length]
+
+
+def get_VLA_cache_key(split, gen_kwargs):
+    '''
+    gen_kwargs are the keyword arguments of VLA_dataset_generator
+    '''
+    payload = {'version': CACHE_VERSION, 'split': split,
+               'shards': [shard_signature(shard) for shard in gen_kwargs['shards']],
+               'encoder': _encoder_signature(gen_kwargs.get('encoder'))}
+    for k, v in gen_kwargs.items():
+        # the prefetch options do not change the samples
+        if k not in ['shards', 'encoder', 'prefetch_shards', 'prefetch_max_mb']:
+            payload[k] = list(v) if isinstance(v, tuple) else v
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+
+def _entry_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def _touch(path):
+    with open(os.path.join(path, _LAST_USED_MARKER), 'w') as f:
+        f.write(str(time.time()))
+
+
+def evict_VLA_cache(cache_dir, max_size_gb, keep=None):
+    '''
+    remove the least recently used complete entries until the cache fits in max_size_gb, `keep` is never removed
+    '''
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.exists(os.path.join(path, _COMPLETE_MARKER)):
+            continue
+        marker = os.path.join(path, _LAST_USED_MARKER)
+        last_used = os.path.getmtime(marker) if os.path.exists(marker) else 0
+        entries.append((last_used, name, _entry_size(path)))
+    total_size = sum(size for _, _, size in entries)
+    budget = max_size_gb * 1024 ** 3
+    for _, name, size in sorted(entries):
+        if total_size <= budget:
+            break
+        if name == keep:
+            continue
+        logger.info(f'Evicting {name} ({size / 1024 ** 3:.2f} GB) from the dataset cache {cache_dir}')
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total_size -= size
+
+
+def load_or_build_VLA_dataset(cache_dir, key, build_fn, max_size_gb=None):
+    '''
+    return the cached dataset of `key`, building it with `build_fn(cache_dir)` if it is missing
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key)
+    # a single process builds on a miss, the other (local) ranks block here until the entry is complete
+    with FileLock(path + '.lock'):
+        if os.path.exists(os.path.join(path, _COMPLETE_MARKER)):
+            logger.info(f'Loading the dataset from the cache {path}')
+        else:
+            logger.info(f'Dataset cache miss, building {path}')
+            tmp_path = path + '.tmp'
+            build_dir = path + '.build'
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                ds = build_fn(build_dir)
+                ds.save_to_disk(tmp_path)
+                with open(os.path.join(tmp_path, _COMPLETE_MARKER), 'w') as f:
+                    json.dump({'num_rows': len(ds), 'created': time.time()}, f)
+                del ds
+                os.rename(tmp_path, path)
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        _touch(path)
+        if max_size_gb is not None:
+            evict_VLA_cache(cache_dir, max_size_gb, keep=key)
+    return load_from_disk(path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _update_users(path, add=None, remove=None):
+    '''
+    add / remove a pid from the users of a shared entry, the pids of dead processes are dropped
+    returns the remaining users, called with the lock of the entry held
+    '''
+    users_path = path + _USERS_SUFFIX
+    users = set()
+    if os.path.exists(users_path):
+        with open(users_path) as f:
+            users = {int(line) for line in f if line.strip()}
+    users = {pid for pid in users if pid != remove and _pid_alive(pid)}
+    if add is not None:
+        users.add(add)
+    with open(users_path, 'w') as f:
+        f.write(''.join(f'{pid}\n' for pid in sorted(users)))
+    return users
+
+
+def _release_shared_entry(path):
+    with FileLock(path + '.lock'):
+        if not _update_users(path, remove=os.getpid()):
+            logger.info(f'Removing the shared dataset {path}')
+            shutil.rmtree(path, ignore_errors=True)
+            os.remove(path + _USERS_SUFFIX)
+
+
+def share_VLA_dataset_on_node(share_dir, key, build_fn, keep=False):
+    '''
+    return the dataset of `key` published in the node-local share_dir, the first local process builds it and the
+    others block until it is published. Unless `keep`, the entry is removed when the last process using it exits
+    (a relaunch on the node reuses a kept entry)
+    '''
+    path = os.path.join(share_dir, key)
+    if not keep:
+        # registered before loading, so an exiting process never removes an entry that is about to be mapped
+        os.makedirs(share_dir, exist_ok=True)
+        with FileLock(path + '.lock'):
+            _update_users(path, add=os.getpid())
+        atexit.register(_release_shared_entry, path)
+    return load_or_build_VLA_dataset(share_dir, key, build_fn)
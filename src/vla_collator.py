@@ -0,0 +1,78 @@
+import torch
+from torch.utils.data import get_worker_info
+
+from .vla_encoder import IGNORE_INDEX
+
+'''
+completion-only collator for the VLA layout
+
+the prompt always ends with the closing token of its last segment, <eoa_i> for vision-first and <eov_i> for
+action_before_vision (prompt_end_token), and the response starts right after it. So the labels are masked by position:
+- from the labels of the samples when they have them (tokenizer_free, masked by the encoder)
+- from a precomputed boundary, the `prompt_length` of the samples
+- otherwise from the first prompt_end_token of every row, found for the whole batch at once with an argmax
+
+trl's DataCollatorForCompletionOnlyLM searches <eoa_i> in Python sample by sample. With action_before_vision, <eoa_i> is
+in the middle of the prompt, so it trains on the input video tokens. A row truncated before its boundary holds no
+response and is fully masked here.
+'''
+
+
+class VLACompletionCollator:
+    '''
+    Args:
+        pad_token_id: the id used to pad the rows
+        prompt_end_token_id: the id of the last token of the prompt, see prompt_end_token
+        padding_side: 'right' or 'left'
+        pin_memory: pin the batch when collating in the main process, in dataloader workers the DataLoader pins it
+    '''
+    def __init__(self, pad_token_id, prompt_end_token_id, padding_side='right', pad_to_multiple_of=None, pin_memory=True):
+        if padding_side not in ['right', 'left']:
+            raise ValueError(f'Unknown padding side {padding_side}')
+        self.pad_token_id = pad_token_id
+        self.prompt_end_token_id = prompt_end_token_id
+        self.padding_side = padding_side
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.pin_memory = pin_memory
+
+    def _pad(self, sequences, length, value):
+        batch = torch.full((len(sequences), length), value, dtype=torch.long)
+        for i, sequence in enumerate(sequences):
+            if len(sequence) == 0:
+                continue
+            if self.padding_side == 'right':
+                batch[i, :len(sequence)] = torch.as_tensor(sequence, dtype=torch.long)
+            else:
+                batch[i, length - len(sequence):] = torch.as_tensor(sequence, dtype=torch.long)
+        return batch
+
+    def __call__(self, features):
+        lengths = torch.tensor([len(feature['input_ids']) for feature in features])
+        length = int(lengths.max())
+        if self.pad_to_multiple_of is not None:
+            length = (length + self.pad_to_multiple_of - 1) // self.pad_to_multiple_of * self.pad_to_multiple_of
+        input_ids = self._pad([feature['input_ids'] for feature in features], length, self.pad_token_id)
+        positions = torch.arange(length)[None, :]
+        # the offset of the first token of every row
+        offsets = torch.zeros_like(lengths) if self.padding_side == 'right' else length - lengths
+        attention_mask = (positions >= offsets[:, None]) & (positions < (offsets + lengths)[:, None])
+
+        if all('labels' in feature for feature in features):
+            labels = self._pad([feature['labels'] for feature in features], length, IGNORE_INDEX)
+        else:
+            if all('prompt_length' in feature for feature in features):
+                boundaries = offsets + torch.tensor([feature['prompt_length'] for feature in features])
+            else:
+                is_end = (input_ids == self.prompt_end_token_id) & attention_mask
+                # rows without the token (truncated inside the prompt) are masked entirely
+                boundaries = torch.where(is_end.any(dim=1), is_end.int().argmax(dim=1) + 1, torch.full_like(lengths, length))
+            labels = input_ids.masked_fill((positions < boundaries[:, None]) | ~attention_mask, IGNORE_INDEX)
+
+        batch = {'input_ids': input_ids, 'attention_mask': attention_mask.long(), 'labels': labels}
+        if self.pin_memory and torch.cuda.is_available() and get_worker_info() is None:
+            batch = {k: v.pin_memory() for k, v in batch.items()}
+        return batch
+
+
+def prompt_end_token(action_before_vision):
+    return '<eov_i>' if action_before_vision else '<eoa_i>'
@@ -0,0 +1,178 @@
+import gzip
+import io
+import os
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+compressed jsonl shards, <name>.jsonl.zst (zstandard) and <name>.jsonl.gz
+
+the shards are mostly digits and compress several times, which cuts the bytes read from network storage per epoch.
+open_jsonl_shard returns the decompressed bytes of a shard as a binary file:
+- the file is decompressed as a stream, never as a whole
+- the decompression runs in a background thread a few chunks ahead of the reader (zstd and zlib release the GIL),
+  so it overlaps with the json parsing of the lines
+- plain .jsonl shards are opened as they are
+
+compressed shards cannot seek: a line is reached by decompressing and skipping the preceding ones, their line-offset
+indexes (vla_index.py) hold the offsets in the decompressed stream and are only used to count the lines
+scripts/compress_shards.py recompresses the shards of a dataset in parallel
+'''
+
+COMPRESSED_SUFFIXES = ['.zst', '.gz']
+JSONL_SHARD_SUFFIXES = ['.jsonl'] + ['.jsonl' + suffix for suffix in COMPRESSED_SUFFIXES]
+
+_CHUNK_SIZE = 1 << 20
+
+
+def shard_compression(shard):
+    '''
+    the compression suffix of a shard, None for a plain shard
+    '''
+    for suffix in COMPRESSED_SUFFIXES:
+        if shard.endswith(suffix):
+            return suffix
+    return None
+
+
+def jsonl_shard_name(shard):
+    '''
+    the file name of a jsonl shard without its .jsonl[.zst|.gz] suffix
+    '''
+    name = os.path.basename(shard)
+    for suffix in sorted(JSONL_SHARD_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError('.zst shards require the zstandard package, install it with `pip install zstandard`')
+
+
+class _ReadAheadStream(io.RawIOBase):
+    '''
+    the chunks of a decompressing file, read by a background thread into a bounded queue
+    '''
+    def __init__(self, raw, num_chunks=4):
+        self._raw = raw
+        self._queue = queue.Queue(maxsize=num_chunks)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._done = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self):
+        try:
+            while True:
+                chunk = self._raw.read(_CHUNK_SIZE)
+                if not chunk or not self._put(chunk):
+                    break
+            self._put(None)
+        except Exception as e: # raised in the reader
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk:
+            if self._done:
+                return 0
+            item = self._queue.get()
+            if item is None:
+                self._done = True
+                return 0
+            if isinstance(item, Exception):
+                self._done = True
+                raise item
+            self._chunk = memoryview(item)
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._raw.close()
+        super().close()
+
+
+class _GzipShard(gzip.GzipFile):
+    '''
+    a gzip reader that closes the file it reads from
+    '''
+    def __init__(self, fileobj):
+        super().__init__(fileobj=fileobj, mode='rb')
+        self._shard_file = fileobj
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._shard_file.close()
+
+
+def open_jsonl_shard(shard, read_ahead_chunks=4, fileobj=None):
+    '''
+    open a jsonl shard for reading in binary mode, decompressing .zst / .gz shards in a background thread
+    read_ahead_chunks: the number of decompressed 1MB chunks kept ahead of the reader, 0 decompresses in the reader
+    fileobj: the raw bytes of the shard when they are not read from the file (see vla_prefetch.py), closed with the shard
+    '''
+    compression = shard_compression(shard)
+    if compression == '.zst':
+        _require_zstandard()
+    f = open(shard, 'rb') if fileobj is None else fileobj
+    if compression is None:
+        return f
+    if compression == '.zst':
+        raw = zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    else:
+        raw = _GzipShard(f)
+    if read_ahead_chunks <= 0:
+        return io.BufferedReader(raw, buffer_size=_CHUNK_SIZE)
+    return io.BufferedReader(_ReadAheadStream(raw, read_ahead_chunks), buffer_size=_CHUNK_SIZE)
+
+
+def compress_jsonl_shard(jsonl_path, output_path, level=None, threads=0):
+    '''
+    compress one jsonl shard (plain or compressed) into output_path, its suffix gives the compression
+    the file is written next to output_path and renamed once complete, returns the number of lines
+    level: the compression level, defaults to 10 for zstd and 6 for gzip
+    threads: zstd only, the number of compression threads of this shard
+    '''
+    compression = shard_compression(output_path)
+    if compression is None:
+        raise ValueError(f'{output_path} must end with one of {COMPRESSED_SUFFIXES}')
+    tmp_path = output_path + '.tmp'
+    num_lines = 0
+    with open_jsonl_shard(jsonl_path) as f, open(tmp_path, 'wb') as out:
+        if compression == '.zst':
+            _require_zstandard()
+            writer = zstandard.ZstdCompressor(level=10 if level is None else level, threads=threads).stream_writer(out, closefd=False)
+        else:
+            writer = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6 if level is None else level)
+        with writer:
+            for line in f:
+                writer.write(line)
+                num_lines += 1
+    os.replace(tmp_path, output_path)
+    return num_lines
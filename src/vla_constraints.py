@@ -0,0 +1,263 @@
+import logging
+
+import torch
+from transformers import LogitsProcessor
+
+'''
+constrained decoding of the VLA output layout
+
+the output of a clip is a fixed sequence of segments, laid out as VLAEncoder.encode_segments lays out the response:
+- <botp_o> text <eotp_o>, unless wo_text
+- <bov_o> exactly output_video_length <va*> tokens <eov_o>, unless wo_vision
+- <boa_o> exactly output_action_length <va*> tokens <eoa_o>
+the video and action segments are swapped with action_before_vision, and the output ends with eos
+
+VLAGrammarState follows one row through the segments and gives the tokens legal at its position: the opening token of
+the next segment, <va*> tokens until the segment is full and then its closing token, free text (any token that is not a
+VLA special token, a <va*> token or a special token of the tokenizer) for at most max_text_tokens tokens, then eos.
+VLAGrammarLogitsProcessor masks the scores of every row to these tokens, so the outputs always parse. It follows the
+rows of the batch one to one, for greedy search and sampling (num_beams=1).
+
+the grammar also fixes the length of the output, VLAOutputGrammar.max_length is the exact max_new_tokens of the
+constrained outputs. A free output may have a longer description than max_text_tokens, free_max_new_tokens adds
+free_text_slack_tokens to the description of the same layout (no grammar, so no encoder is needed). It also fixes some of its tokens: the
+closing token of a full <va*> segment, the opening token of the next one, eos. generate_fast_forward
+is a greedy decoding loop that appends these forced tokens to the sampled one and feeds them in the same forward pass,
+instead of spending a decode step on each of them (the first forward pass takes the prompt and the forced opening token).
+
+with action_only the output ends with <eoa_o>: the segments after the action segment and eos are not generated, and
+stop_token_id is <eoa_o>. This is what closed-loop control needs from an action_before_vision checkpoint, the output
+video of a vision-first layout is still generated before the actions.
+'''
+
+logger = logging.getLogger(__name__)
+
+_TEXT = 'text'
+_TOKENS = 'tokens'
+
+
+class VLAOutputGrammar:
+    '''
+    Args:
+        encoder: a VLAEncoder, for the ids of the segment and <va*> tokens and the layout flags
+        output_video_length, output_action_length: the number of <va*> tokens of the output video / action segments
+        max_text_tokens: the length limit of the output clip description
+        action_only: stop the output after the action segment
+    '''
+    def __init__(self, encoder, output_video_length=768, output_action_length=42, max_text_tokens=128, action_only=False):
+        t = encoder.token_ids
+        self.va_range = (encoder.va_base, encoder.va_base + encoder.num_visual_action_tokens)
+        self.eos_token_id = encoder.tokenizer.eos_token_id
+        self.max_text_tokens = max_text_tokens
+        video = (t['<bov_o>'], t['<eov_o>'], _TOKENS, output_video_length)
+        action = (t['<boa_o>'], t['<eoa_o>'], _TOKENS, output_action_length)
+        # (opening id, closing id, kind, length) of every segment, in order
+        self.segments = [] if encoder.wo_text else [(t['<botp_o>'], t['<eotp_o>'], _TEXT, max_text_tokens)]
+        if encoder.action_before_vision:
+            self.segments += [action] + ([video] if not encoder.wo_vision else [])
+        else:
+            self.segments += ([video] if not encoder.wo_vision else []) + [action]
+        # the output video is generated before the actions
+        self.vision_first = not encoder.wo_vision and not encoder.action_before_vision
+        self.action_only = action_only
+        if action_only:
+            self.segments = self.segments[:self.segments.index(action) + 1]
+        # the token that ends the output
+        self.stop_token_id = t['<eoa_o>'] if action_only else self.eos_token_id
+        # the ids a description may not use
+        self.non_text_ids = sorted(set(t.values()) | set(encoder.tokenizer.all_special_ids))
+        self.vocab_size = len(encoder.tokenizer)
+        self._text_mask = None
+
+    @property
+    def max_length(self):
+        '''
+        the length of the longest output allowed by the grammar, its stop token included
+        '''
+        return sum(2 + length for _, _, _, length in self.segments) + int(not self.action_only)
+
+    def state(self):
+        return VLAGrammarState(self)
+
+    def text_mask(self, vocab_size, device):
+        '''
+        the tokens legal in a description, the rows of a padded embedding matrix are not tokens
+        '''
+        key = (vocab_size, str(device))
+        if self._text_mask is None or self._text_mask[0] != key:
+            mask = torch.ones(vocab_size, dtype=torch.bool, device=device)
+            mask[self.vocab_size:] = False
+            mask[self.va_range[0]:self.va_range[1]] = False
+            mask[[i for i in self.non_text_ids if i < vocab_size]] = False
+            self._text_mask = (key, mask)
+        return self._text_mask[1]
+
+    def mask_scores(self, states, scores):
+        '''
+        scores (one row per state) with the tokens that are not legal in the state of their row set to -inf
+        '''
+        allowed = torch.zeros_like(scores, dtype=torch.bool)
+        for row, state in enumerate(states):
+            kind, token_id = state.allowed()
+            if kind == 'va':
+                allowed[row, self.va_range[0]:self.va_range[1]] = True
+            elif kind == 'text':
+                allowed[row] = self.text_mask(scores.shape[-1], scores.device)
+            allowed[row, token_id] = True
+        return scores.masked_fill(~allowed, float('-inf'))
+
+    def logits_processor(self):
+        '''
+        a new processor, for one call of generate
+        '''
+        return VLAGrammarLogitsProcessor(self)
+
+
+class VLAGrammarState:
+    '''
+    the position of one output in the segments of a VLAOutputGrammar
+    '''
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.segment = 0
+        self.opened = False
+        self.count = 0
+        self.done = False
+
+    def allowed(self):
+        '''
+        (kind, token_id): with kind 'token', token_id is the only legal token, with kind 'va' / 'text' the <va*> / text
+        tokens are legal as well as token_id, the closing token of the segment
+        '''
+        g = self.grammar
+        if self.done or self.segment == len(g.segments):
+            return 'token', g.eos_token_id
+        begin, end, kind, length = g.segments[self.segment]
+        if not self.opened:
+            return 'token', begin
+        if self.count >= length:
+            return 'token', end
+        return ('va', end) if kind == _TOKENS else ('text', end)
+
+    def advance(self, token_id):
+        g = self.grammar
+        if self.done:
+            return
+        if self.segment == len(g.segments):
+            self.done = token_id == g.eos_token_id
+            return
+        begin, end, kind, length = g.segments[self.segment]
+        if not self.opened:
+            self.opened = token_id == begin
+        elif token_id == end:
+            self.segment += 1
+            self.opened = False
+            self.count = 0
+            self.done = g.action_only and self.segment == len(g.segments)
+        else:
+            self.count += 1
+
+
+class VLAGrammarLogitsProcessor(LogitsProcessor):
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.states = None
+        self.prompt_width = None
+
+    def __call__(self, input_ids, scores):
+        if self.states is None:
+            self.states = [self.grammar.state() for _ in range(input_ids.shape[0])]
+            self.prompt_width = input_ids.shape[1]
+        elif input_ids.shape[1] > self.prompt_width:
+            for state, token_id in zip(self.states, input_ids[:, -1].tolist()):
+                state.advance(token_id)
+        return self.grammar.mask_scores(self.states, scores)
+
+
+def free_max_new_tokens(data_args):
+    '''
+    the max_new_tokens of a free output: the max_length of the grammar of data_args, with free_text_slack_tokens more
+    description tokens
+    '''
+    video = 0 if data_args.wo_vision else 2 + data_args.output_video_length
+    action = 2 + data_args.output_action_length
+    text = 0 if data_args.wo_text else 2 + data_args.max_output_text_tokens + data_args.free_text_slack_tokens
+    if data_args.action_only_decoding: # the output ends with <eoa_o>
+        return text + action + (video if not data_args.action_before_vision else 0)
+    return text + video + action + 1
+
+
+def output_stop_token_id(tokenizer, data_args):
+    '''
+    the token that ends an output, VLAOutputGrammar.stop_token_id without the grammar
+    '''
+    return tokenizer.convert_tokens_to_ids('<eoa_o>') if data_args.action_only_decoding else tokenizer.eos_token_id
+
+
+def output_grammar(tokenizer, data_args, encoder=None):
+    '''
+    the VLAOutputGrammar of the layout set by data_args
+    '''
+    from .vla_encoder import VLAEncoder
+    grammar = VLAOutputGrammar(encoder if encoder is not None else VLAEncoder(tokenizer, data_args),
+                               output_video_length=data_args.output_video_length, output_action_length=data_args.output_action_length,
+                               max_text_tokens=data_args.max_output_text_tokens, action_only=data_args.action_only_decoding)
+    if grammar.action_only and grammar.vision_first:
+        action_length = data_args.output_action_length + 2
+        logger.warning(f'action_only_decoding: the layout puts the output video before the actions, every clip generates up to '
+                       f'{grammar.max_length} tokens until <eoa_o> for the {action_length} tokens of the action segment '
+                       f'({grammar.max_length / action_length:.1f}x), action_before_vision checkpoints stop after the actions')
+    return grammar
+
+
+@torch.no_grad()
+def generate_fast_forward(model, input_ids, attention_mask, grammar, pad_token_id, max_new_tokens=None, past_key_values=None):
+    '''
+    greedy decoding constrained by grammar, the tokens forced by the layout are fed with the previous token in one forward pass
+    input_ids, attention_mask: the left-padded prompts
+    past_key_values: the key / value states of the first columns of input_ids (see vla_prefix_cache.py), only the
+    following columns are prefilled
+    returns the generated ids of every row (up to its eos) and the number of forward passes
+    '''
+    max_new_tokens = grammar.max_length if max_new_tokens is None else max_new_tokens
+    states = [grammar.state() for _ in range(input_ids.shape[0])]
+    outputs = [[] for _ in states]
+    past_length = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+    new_ids, logits = input_ids[:, past_length:], None
+    num_forward = 0
+    while True:
+        chunks = []
+        if logits is not None:
+            logits = grammar.mask_scores(states, logits)
+        for row, state in enumerate(states):
+            chunk = []
+            if logits is not None and not state.done and len(outputs[row]) < max_new_tokens:
+                chunk.append(int(logits[row].argmax()))
+                state.advance(chunk[-1])
+            while not state.done and len(outputs[row]) + len(chunk) < max_new_tokens:
+                kind, token_id = state.allowed()
+                if kind != 'token':
+                    break
+                chunk.append(token_id)
+                state.advance(token_id)
+            outputs[row].extend(chunk)
+            chunks.append(chunk)
+        if all(state.done or len(output) >= max_new_tokens for state, output in zip(states, outputs)):
+            return outputs, num_forward
+        # the chunks of the rows are left-padded to the same width, the padding is masked out
+        width = max(len(chunk) for chunk in chunks)
+        chunk_ids = torch.full((len(chunks), width), pad_token_id, dtype=torch.long, device=input_ids.device)
+        chunk_mask = torch.zeros((len(chunks), width), dtype=attention_mask.dtype, device=input_ids.device)
+        for row, chunk in enumerate(chunks):
+            if chunk:
+                chunk_ids[row, width - len(chunk):] = torch.tensor(chunk, dtype=torch.long)
+                chunk_mask[row, width - len(chunk):] = 1
+        new_ids = torch.cat([new_ids, chunk_ids], dim=1)
+        attention_mask = torch.cat([attention_mask, chunk_mask], dim=1)
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, -new_ids.shape[1]:]
+        output = model(input_ids=new_ids, attention_mask=attention_mask, position_ids=position_ids,
+                       past_key_values=past_key_values, use_cache=True)
+        past_key_values = output.past_key_values
+        logits = output.logits[:, -1, :].float()
+        new_ids = new_ids[:, :0]
+        num_forward += 1
@@ -0,0 +1,167 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+decoding of the shard lines
+
+- the json backend: orjson when it is installed (json_backend='auto'), the standard json module otherwise,
+  both raise a ValueError on a malformed line, a valid json value that is not an object is malformed as well
+- selective extraction: only the fields used by the current mode (VLA_required_fields) are kept, so the unused
+  descriptions and the gt_actions array are not converted or held in the shuffle buffers, and the unused columns
+  of a binary shard are not read at all
+- VLAShardStats counts the decoded, malformed (not valid json) and skipped (valid json, missing / bad fields) lines
+  of every shard, the counts of the shards read by this process are kept in VLA_SHARD_STATS. The processes of
+  Dataset.from_generator(num_proc=...) dump their counts under collect_shard_stats, which merges them into the parent
+'''
+
+logger = logging.getLogger(__name__)
+
+JSON_BACKENDS = ['auto', 'json', 'orjson']
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+RAW_INFO_FIELDS = ['task_description', 'scene_description', 'input_clip_description', 'output_clip_description',
+                   'input_video_tokens', 'output_video_tokens', 'input_action_tokens', 'output_action_tokens']
+
+
+def set_json_backend(backend='auto'):
+    '''
+    select the json backend of this process (and of the processes forked from it)
+    '''
+    global _json_loads
+    if backend not in JSON_BACKENDS:
+        raise ValueError(f'Unknown json backend {backend}, expected one of {JSON_BACKENDS}')
+    if backend == 'orjson' and orjson is None:
+        raise ImportError('json_backend=orjson requires the orjson package, install it with `pip install orjson`')
+    _json_loads = json.loads if backend == 'json' or orjson is None else orjson.loads
+
+
+def decode_VLA_line(line, fields=None):
+    '''
+    decode one line (str or bytes) of a jsonl shard, keeping only `fields` when given
+    raises ValueError if the line is not a valid json object
+    '''
+    instance_data = _json_loads(line)
+    if not isinstance(instance_data, dict):
+        raise ValueError(f'Expected a json object, got {type(instance_data).__name__}')
+    if fields is None:
+        return instance_data
+    return {k: v for k, v in instance_data.items() if k in fields}
+
+
+def VLA_required_fields(return_info, action_before_vision, wo_text, wo_vision, **kwargs):
+    '''
+    the fields of a shard line read by format_VLA_instance, the arguments are those of VLA_dataset_generator
+    '''
+    fields = {'task_description', 'input_video_tokens', 'input_action_tokens', 'output_action_tokens'}
+    if not wo_text:
+        fields.update(['scene_description', 'input_clip_description', 'output_clip_description'])
+    if not wo_vision:
+        fields.add('output_video_tokens')
+    if return_info:
+        fields.update(RAW_INFO_FIELDS + ['trajectory_id', 'view', 'gt_actions'])
+    return frozenset(fields)
+
+
+class VLAShardStats:
+    '''
+    line counters of one shard
+    '''
+    def __init__(self, shard):
+        self.shard = shard
+        self.decoded = 0
+        self.malformed = 0
+        self.skipped = 0
+
+    @property
+    def lost(self):
+        return self.malformed + self.skipped
+
+    def as_dict(self):
+        return {'decoded': self.decoded, 'malformed': self.malformed, 'skipped': self.skipped}
+
+    def log(self):
+        if self.lost > 0:
+            logger.warning(f'{self.shard}: {self.malformed} malformed and {self.skipped} skipped lines '
+                           f'out of {self.decoded + self.malformed}')
+        else:
+            logger.debug(f'{self.shard}: {self.decoded} lines')
+
+
+VLA_SHARD_STATS = {}
+
+# set by collect_shard_stats, inherited by the processes it spawns, and not part of the gen_kwargs fingerprint
+SHARD_STATS_DIR_ENV = 'VLA_SHARD_STATS_DIR'
+
+
+def get_shard_stats(shard):
+    '''
+    the counters of a shard in this process, accumulated over every pass over the shard
+    '''
+    if shard not in VLA_SHARD_STATS:
+        VLA_SHARD_STATS[shard] = VLAShardStats(shard)
+    return VLA_SHARD_STATS[shard]
+
+
+def log_shard_stats(shards=None):
+    '''
+    log a summary of the counters of `shards` (all the shards read by this process by default), returns the totals
+    '''
+    stats = [VLA_SHARD_STATS[shard] for shard in (shards if shards is not None else VLA_SHARD_STATS) if shard in VLA_SHARD_STATS]
+    totals = {k: sum(s.as_dict()[k] for s in stats) for k in ['decoded', 'malformed', 'skipped']}
+    lossy = [s for s in stats if s.lost > 0]
+    if lossy:
+        logger.warning(f'{totals["malformed"]} malformed and {totals["skipped"]} skipped lines in {len(lossy)} of {len(stats)} shards: '
+                       + ', '.join(f'{s.shard} ({s.malformed}/{s.skipped})' for s in lossy))
+    elif stats:
+        logger.info(f'Decoded {totals["decoded"]} lines from {len(stats)} shards, no malformed or skipped lines')
+    return totals
+
+
+def dump_shard_stats(shards):
+    '''
+    write the counters of `shards` to the directory of collect_shard_stats, if any
+    '''
+    stats_dir = os.environ.get(SHARD_STATS_DIR_ENV)
+    if stats_dir is None:
+        return
+    name = hashlib.sha1('\n'.join(shards).encode()).hexdigest()[:16]
+    with open(os.path.join(stats_dir, f'{os.getpid()}-{name}.json'), 'w') as f:
+        json.dump({'pid': os.getpid(), 'stats': {shard: VLA_SHARD_STATS[shard].as_dict() for shard in shards if shard in VLA_SHARD_STATS}}, f)
+
+
+@contextlib.contextmanager
+def collect_shard_stats():
+    '''
+    add the counters dumped by the child processes started in the block to VLA_SHARD_STATS
+    '''
+    stats_dir = tempfile.mkdtemp(prefix='vla_shard_stats_')
+    previous = os.environ.get(SHARD_STATS_DIR_ENV)
+    os.environ[SHARD_STATS_DIR_ENV] = stats_dir
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ[SHARD_STATS_DIR_ENV]
+        else:
+            os.environ[SHARD_STATS_DIR_ENV] = previous
+        for name in os.listdir(stats_dir):
+            with open(os.path.join(stats_dir, name)) as f:
+                dumped = json.load(f)
+            if dumped['pid'] == os.getpid(): # generated in this process, already counted
+                continue
+            for shard, counts in dumped['stats'].items():
+                stats = get_shard_stats(shard)
+                for k, v in counts.items():
+                    setattr(stats, k, getattr(stats, k) + v)
+        shutil.rmtree(stats_dir, ignore_errors=True)
@@ -0,0 +1,183 @@
+import random
+from collections import OrderedDict
+
+import numpy as np
+
+'''
+tokenizer-free encoding of the VLA clips
+
+the string built by VLA_dataset_generator is made of special segment tokens, <va{x}> tokens and a few free-text fields,
+so instead of formatting it and running the tokenizer over 1,600+ <va{x}> strings, the input_ids are assembled directly:
+- <va{x}> is added to the tokenizer as one contiguous block, so its id is va_base + x
+- the segment tokens (<bov_i>, <eoa_i>, ...) are looked up once
+- only task_description, scene_description, input_clip_description and output_clip_description are tokenized
+
+the free-text fields are tokenized on their own (add_special_tokens=False), for sentencepiece tokenizers this may differ
+from the string path in the leading-space marker of a description, use check_against_tokenizer to compare on a sample
+
+task_description is shared by all the clips of a trajectory and scene_description by all the clips of a trajectory / view,
+their ids are memoized in a bounded LRU cache (DescriptionTokenCache), one per process
+'''
+
+IGNORE_INDEX = -100
+
+VLA_SPECIAL_TOKENS = ['<bott_i>', '<eott_i>', # task text
+                      '<bots_i>', '<eots_i>', # scene text
+                      '<botp_i>', '<eotp_i>', # policy text
+                      '<bov_i>', '<eov_i>', '<boa_i>', '<eoa_i>', # vision and action tokens
+                      '<botp_o>', '<eotp_o>', # output policy text
+                      '<bov_o>', '<eov_o>', '<boa_o>', '<eoa_o>'] # output vision and action tokens
+
+
+class DescriptionTokenCache:
+    '''
+    bounded LRU cache from a description to its token ids, the cached lists must not be modified
+    '''
+    def __init__(self, tokenize, maxsize=65536):
+        self.tokenize = tokenize
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, text):
+        ids = self._cache.get(text)
+        if ids is not None:
+            self._cache.move_to_end(text)
+            self.hits += 1
+            return ids
+        self.misses += 1
+        ids = self.tokenize(text)
+        if self.maxsize > 0:
+            self._cache[text] = ids
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return ids
+
+    def __getstate__(self):
+        # the cache is per process, and its content must not change the hash of the encoder (datasets fingerprints)
+        state = self.__dict__.copy()
+        state.update({'_cache': OrderedDict(), 'hits': 0, 'misses': 0})
+        return state
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache),
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
+
+
+class VLAEncoder:
+    def __init__(self, tokenizer, data_args, max_seq_length=None):
+        self.tokenizer = tokenizer
+        self.num_visual_action_tokens = data_args.num_visual_action_tokens
+        self.static_video_description = list(data_args.static_video_description)
+        self.action_before_vision = data_args.action_before_vision
+        self.wo_text = data_args.wo_text
+        self.wo_vision = data_args.wo_vision
+        self.max_seq_length = max_seq_length
+
+        # the <va{x}> tokens must form a contiguous id range for the offset to be valid
+        self.va_base = tokenizer.convert_tokens_to_ids('<va0>')
+        va_last = tokenizer.convert_tokens_to_ids(f'<va{self.num_visual_action_tokens - 1}>')
+        if va_last - self.va_base != self.num_visual_action_tokens - 1:
+            raise ValueError(f'The <va*> tokens are not contiguous in the tokenizer vocabulary ({self.va_base}, {va_last})')
+        self.token_ids = {token: tokenizer.convert_tokens_to_ids(token) for token in VLA_SPECIAL_TOKENS}
+        if tokenizer.unk_token_id is not None and tokenizer.unk_token_id in self.token_ids.values():
+            raise ValueError('The VLA special tokens have not been added to the tokenizer')
+        self.bos_ids = [tokenizer.bos_token_id] if getattr(tokenizer, 'add_bos_token', False) and tokenizer.bos_token_id is not None else []
+        self.eos_ids = [tokenizer.eos_token_id]
+        self.description_cache = DescriptionTokenCache(self._text, maxsize=getattr(data_args, 'description_cache_size', 65536))
+
+    def _text(self, text):
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def _tokens(self, tokens):
+        return (np.asarray(tokens, dtype=np.int64) + self.va_base).tolist()
+
+    def _segment(self, name, ids):
+        return [self.token_ids[f'<bo{name}>']] + ids + [self.token_ids[f'<eo{name}>']]
+
+    def encode_segments(self, instance_data, rng=random):
+        '''
+        returns (prompt_ids, response_ids), laid out exactly as the input / output strings of VLA_dataset_generator
+        '''
+        prompt_ids = list(self.bos_ids)
+        response_ids = []
+        if self.wo_text:
+            prompt_ids += self._segment('tt_i', self.description_cache(instance_data['task_description']))
+        else:
+            input_clip_description = instance_data['input_clip_description']
+            if input_clip_description == '': # sample a description for the input clip
+                input_clip_description = rng.choice(self.static_video_description)
+            prompt_ids += self._segment('tt_i', self.description_cache(instance_data['task_description'])) + \
+                    self._segment('ts_i', self.description_cache(instance_data['scene_description'])) + \
+                    self._segment('tp_i', self._text(input_clip_description))
+            response_ids += self._segment('tp_o', self._text(instance_data['output_clip_description']))
+
+        input_video = self._segment('v_i', self._tokens(instance_data['input_video_tokens']))
+        input_action = self._segment('a_i', self._tokens(instance_data['input_action_tokens']))
+        output_video = self._segment('v_o', self._tokens(instance_data['output_video_tokens'])) if not self.wo_vision else []
+        output_action = self._segment('a_o', self._tokens(instance_data['output_action_tokens']))
+        if self.action_before_vision:
+            prompt_ids += input_action + input_video
+            response_ids += output_action + output_video
+        else:
+            prompt_ids += input_video + input_action
+            response_ids += output_video + output_action
+        response_ids += self.eos_ids
+        return prompt_ids, response_ids
+
+    def encode(self, instance_data, rng=random):
+        '''
+        returns input_ids, attention_mask and completion-only labels (the prompt is set to IGNORE_INDEX),
+        prompt_length is the index of the first response token
+        '''
+        prompt_ids, response_ids = self.encode_segments(instance_data, rng=rng)
+        input_ids = prompt_ids + response_ids
+        labels = [IGNORE_INDEX] * len(prompt_ids) + response_ids
+        if self.max_seq_length is not None:
+            input_ids = input_ids[:self.max_seq_length]
+            labels = labels[:self.max_seq_length]
+        return {'input_ids': input_ids, 'attention_mask': [1] * len(input_ids), 'labels': labels,
+                'prompt_length': min(len(prompt_ids), len(input_ids))}
+
+    def encode_prompt(self, instance_data, rng=random):
+        return self.encode_segments(instance_data, rng=rng)[0]
+
+    def decode_output(self, output_ids):
+        '''
+        split generated ids into the output clip description and the output video / action tokens,
+        replaces the string parsing of '<va{x}>' in the predict scripts
+        '''
+        t = self.token_ids
+        segments = {t['<botp_o>']: 'output_clip_description', t['<bov_o>']: 'output_video_tokens', t['<boa_o>']: 'output_action_tokens'}
+        ends = {t['<eotp_o>'], t['<eov_o>'], t['<eoa_o>']}
+        ret = {'output_clip_description': [], 'output_video_tokens': [], 'output_action_tokens': []}
+        segment = None
+        for token_id in output_ids:
+            token_id = int(token_id)
+            if token_id in segments:
+                segment = segments[token_id]
+                ret[segment] = []
+            elif token_id in ends:
+                segment = None
+            elif segment == 'output_clip_description':
+                ret[segment].append(token_id)
+            elif segment is not None and 0 <= token_id - self.va_base < self.num_visual_action_tokens:
+                ret[segment].append(token_id - self.va_base)
+        ret['output_clip_description'] = self.tokenizer.decode(ret['output_clip_description'])
+        return ret
+
+    def check_against_tokenizer(self, text_input, text_output, instance_data):
+        '''
+        compare the assembled ids with tokenizing the strings of VLA_dataset_generator,
+        returns the index of the first mismatch or None
+        '''
+        prompt_ids, response_ids = self.encode_segments(instance_data)
+        reference_ids = self.tokenizer(text_input + text_output).input_ids
+        for i, (a, b) in enumerate(zip(prompt_ids + response_ids, reference_ids)):
+            if a != b:
+                return i
+        if len(prompt_ids) + len(response_ids) != len(reference_ids):
+            return min(len(prompt_ids) + len(response_ids), len(reference_ids))
+        return None
@@ -0,0 +1,268 @@
+import hashlib
+import logging
+import os
+import random
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from .vla_compression import open_jsonl_shard, shard_compression
+from .vla_decode import VLA_required_fields, decode_VLA_line, get_shard_stats, log_shard_stats
+from .vla_shards import is_array_shard, open_array_shard
+
+'''
+random access over the jsonl shards
+
+each shard gets a line-offset index (the byte offset of every line), built once by scanning the file for newlines
+and saved as <shard>.idx.npz next to the shard (or under index_dir when given) together with the size / mtime of the shard,
+so that a modified shard is re-indexed. Binary shards are random-access already and need no index.
+The index of a compressed shard holds the offsets in the decompressed stream, it cannot seek there and is only used
+to count its lines: VLAIndexedDataset rejects compressed shards.
+
+VLAIndexedDataset stacks the per-shard counts into a global cumulative count, so item i is read by a single seek
+in the right shard without reading the preceding lines. Malformed lines are counted in the shard stats like in
+VLA_dataset_generator: iterating the view skips them, reading item i of a malformed line raises a ValueError (a malformed
+line is never replaced by another sample, which would count that sample twice in an epoch).
+The shard files are opened once per process (a forked dataloader worker reopens them) and closed by close().
+'''
+
+logger = logging.getLogger(__name__)
+
+_INDEX_CHUNK_SIZE = 1 << 24
+
+
+def _index_path(shard, index_dir=None):
+    if index_dir is None:
+        return shard + '.idx.npz'
+    return os.path.join(index_dir, hashlib.sha1(os.path.abspath(shard).encode('utf-8')).hexdigest() + '.idx.npz')
+
+
+def build_shard_index(shard):
+    '''
+    returns the byte offset of the start of every line of a jsonl shard, with the file size appended as the end of the last line
+    '''
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open_jsonl_shard(shard) as f:
+        while True:
+            chunk = f.read(_INDEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            offsets.append(newlines.astype(np.int64) + position + 1)
+            position += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position: # the last line has no trailing newline
+        offsets = np.append(offsets, position)
+    return offsets
+
+
+def load_shard_index(shard, index_dir=None):
+    '''
+    load the offset index of a shard, building (and saving) it if it is missing or stale
+    '''
+    stat = os.stat(shard)
+    signature = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    path = _index_path(shard, index_dir)
+    if os.path.exists(path):
+        with np.load(path) as index:
+            if np.array_equal(index['signature'], signature):
+                return index['offsets']
+    offsets = build_shard_index(shard)
+    try:
+        if index_dir is not None:
+            os.makedirs(index_dir, exist_ok=True)
+        tmp_path = path + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, offsets=offsets, signature=signature)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f'Could not save the offset index of {shard} to {path}: {e}')
+    return offsets
+
+
+def read_VLA_line(shard, offsets, line_idx, fields=None):
+    '''
+    read a single json object of a shard with one seek, returns None if the line is malformed
+    compressed shards cannot be seeked, read their lines with read_VLA_lines
+    '''
+    if offsets is None:
+        return open_array_shard(shard).read(line_idx, fields)
+    if shard_compression(shard) is not None:
+        raise ValueError(f'{shard} is compressed, its lines cannot be read by a seek')
+    with open(shard, 'rb') as f:
+        f.seek(int(offsets[line_idx]))
+        try:
+            return decode_VLA_line(f.read(int(offsets[line_idx + 1] - offsets[line_idx])), fields)
+        except ValueError:
+            return None
+
+
+def read_VLA_lines(shard, offsets, line_ids, fields=None):
+    '''
+    read several json objects of a shard, {line: object, None if the line is malformed}
+    a compressed shard is decompressed once, up to its last requested line
+    '''
+    if offsets is None or shard_compression(shard) is None:
+        return {line_idx: read_VLA_line(shard, offsets, line_idx, fields) for line_idx in line_ids}
+    wanted = set(line_ids)
+    instances = {}
+    with open_jsonl_shard(shard) as f:
+        for line_idx, line in enumerate(f):
+            if len(instances) == len(wanted):
+                break
+            if line_idx in wanted:
+                try:
+                    instances[line_idx] = decode_VLA_line(line, fields)
+                except ValueError:
+                    instances[line_idx] = None
+    return instances
+
+
+class VLAIndexedDataset(Dataset):
+    '''
+    random-access view over the shards, items are formatted exactly as the samples of VLA_dataset_generator
+
+    Args:
+        shards: the sorted shard list
+        format_kwargs: the keyword arguments of VLA_dataset_generator except `shards`
+        start_idx, end_idx: the global [start_idx, end_idx) range exposed by the view
+    '''
+    def __init__(self, shards, format_kwargs, start_idx=0, end_idx=None, index_dir=None):
+        self.shards = shards
+        self.format_kwargs = format_kwargs
+        self.fields = VLA_required_fields(**format_kwargs)
+        self.index_dir = index_dir
+        self.offsets = []
+        counts = []
+        for shard in shards:
+            if is_array_shard(shard):
+                self.offsets.append(None)
+                counts.append(len(open_array_shard(shard)))
+            elif shard_compression(shard) is not None:
+                raise ValueError(f'{shard} is compressed and cannot be read at random, use dataset_type=dataset / iterable_dataset '
+                                 'or the uncompressed shards with indexed_dataset')
+            else:
+                offsets = load_shard_index(shard, index_dir)
+                self.offsets.append(offsets)
+                counts.append(len(offsets) - 1)
+        self.cumulative_counts = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+        total = int(self.cumulative_counts[-1])
+        self.start_idx = min(start_idx or 0, total)
+        self.end_idx = total if end_idx is None else max(min(end_idx, total), self.start_idx)
+        self._files = {}
+        self._binary_shards = {}
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # open file handles are not shared with dataloader workers
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        state['_binary_shards'] = {}
+        return state
+
+    def close(self):
+        '''
+        close the shard files opened by this process, they are reopened on the next read
+        '''
+        if self._pid == os.getpid():
+            for f in self._files.values():
+                f.close()
+        self._files = {}
+        self._binary_shards = {}
+        self._pid = os.getpid()
+
+    def __del__(self):
+        if '_files' in self.__dict__:
+            self.close()
+
+    def __len__(self):
+        return self.end_idx - self.start_idx
+
+    @property
+    def num_lines(self):
+        return int(self.cumulative_counts[-1])
+
+    def locate(self, idx):
+        '''
+        map an index of the view to (shard index, line index within the shard)
+        '''
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'Index {idx} out of range for a view of length {len(self)}')
+        global_idx = self.start_idx + idx
+        shard_idx = int(np.searchsorted(self.cumulative_counts, global_idx, side='right')) - 1
+        return shard_idx, global_idx - int(self.cumulative_counts[shard_idx])
+
+    def read_instance(self, shard_idx, line_idx):
+        shard = self.shards[shard_idx]
+        if self.offsets[shard_idx] is None:
+            if shard not in self._binary_shards:
+                self._binary_shards[shard] = open_array_shard(shard)
+            return self._binary_shards[shard].read(line_idx, self.fields)
+        if self._pid != os.getpid():
+            # forked: the inherited files share their position with the parent process
+            self._files = {}
+            self._binary_shards = {}
+            self._pid = os.getpid()
+        if shard not in self._files:
+            self._files[shard] = open(shard, 'rb')
+        f = self._files[shard]
+        start, end = self.offsets[shard_idx][line_idx], self.offsets[shard_idx][line_idx + 1]
+        f.seek(start)
+        return decode_VLA_line(f.read(end - start), self.fields)
+
+    def _example(self, idx):
+        '''
+        the sample of item idx, None (counted in the shard stats) if its line is malformed
+        '''
+        # local import, load_dataset_VLA imports this module
+        from .load_dataset_VLA import format_VLA_instance
+        shard_idx, line_idx = self.locate(idx)
+        stats = get_shard_stats(self.shards[shard_idx])
+        # seeded per line so that a sample is identical however it is accessed
+        rng = random.Random(f'{self.shards[shard_idx]}:{line_idx}')
+        try:
+            instance_data = self.read_instance(shard_idx, line_idx)
+        except ValueError: # not valid json
+            stats.malformed += 1
+            return None
+        stats.decoded += 1
+        example = format_VLA_instance(instance_data, rng, **self.format_kwargs)
+        if example is None:
+            stats.skipped += 1
+        return example
+
+    def __getitem__(self, idx):
+        example = self._example(idx)
+        if example is None:
+            shard_idx, line_idx = self.locate(idx)
+            raise ValueError(f'Line {line_idx} of {self.shards[shard_idx]} is malformed')
+        return example
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            example = self._example(idx)
+            if example is not None:
+                yield example
+        log_shard_stats(self.shards)
+
+    def subset(self, start_idx, end_idx):
+        '''
+        a view over [start_idx, end_idx) of this view, sharing the offset indexes
+        '''
+        view = object.__new__(VLAIndexedDataset)
+        view.__dict__.update(self.__getstate__())
+        view.start_idx = self.start_idx + max(0, min(start_idx, len(self)))
+        view.end_idx = self.start_idx + max(0, min(end_idx, len(self)))
+        view.end_idx = max(view.end_idx, view.start_idx)
+        return view
+
+    def shard_range(self, rank, world_size):
+        '''
+        the contiguous, disjoint part of the view claimed by worker `rank` out of `world_size`
+        '''
+        per_rank, remainder = divmod(len(self), world_size)
+        start = rank * per_rank + min(rank, remainder)
+        end = start + per_rank + (1 if rank < remainder else 0)
+        return self.subset(start, end)
@@ -0,0 +1,129 @@
+import torch
+
+from .vla_encoder import IGNORE_INDEX
+
+'''
+sequence packing for the short layouts (wo_text, wo_vision, action_before_vision)
+
+VLAPackingCollator packs the samples of a batch into as few rows of max_seq_length tokens as possible
+(first-fit decreasing), instead of padding every sample to the longest one. per_device_train_batch_size then counts
+samples, not rows, and should be raised until the rows are full.
+- every sample keeps its own positions: position_ids restart at 0 at the start of each sample
+- every sample keeps its own completion-only labels: the labels of the encoder (tokenizer_free), or, on the text path,
+  the tokens after the first occurrence of the response template (the last token of the prompt, see prompt_end_token)
+  in that sample. The first label of every sample is ignored, so that the last token of a sample is not trained to
+  predict the first token of the next one. Empty samples are dropped
+- attention='block': a 4D block-diagonal causal mask keeps the samples of a row from attending to each other. The eager
+  attention of transformers 4.41 takes it as a 1 / 0 mask and inverts it, the sdpa attention only takes it already
+  inverted (0 where attended, the dtype minimum elsewhere), so the mask is built for attn_implementation
+  (model.config._attn_implementation, see scripts/train.py)
+- attention='position_ids' only resets the positions, the samples of a row attend to each other. The flash attention 2
+  of transformers 4.41 does not derive varlen boundaries from the positions and ignores 4D masks, so packing is
+  rejected with flash attention 2 (see scripts/train.py)
+'''
+
+PACKING_ATTENTION = ['block', 'position_ids']
+
+
+def pack_lengths(lengths, capacity):
+    '''
+    first-fit decreasing bin packing, returns the rows as lists of indices into lengths
+    '''
+    rows = []
+    free = []
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for row, space in enumerate(free):
+            if lengths[idx] <= space:
+                rows[row].append(idx)
+                free[row] -= lengths[idx]
+                break
+        else:
+            rows.append([idx])
+            free.append(capacity - lengths[idx])
+    # keep the samples of a row in batch order
+    return [sorted(row) for row in rows]
+
+
+def completion_labels(input_ids, response_template):
+    '''
+    labels of one sample masked up to the end of the first occurrence of response_template, all masked if it is absent
+    '''
+    n = len(response_template)
+    for i in range(len(input_ids) - n + 1):
+        if input_ids[i:i + n] == response_template:
+            return [IGNORE_INDEX] * (i + n) + list(input_ids[i + n:])
+    return [IGNORE_INDEX] * len(input_ids)
+
+
+class VLAPackingCollator:
+    '''
+    Args:
+        pad_token_id: the id used to pad the rows
+        max_seq_length: the length of a packed row, longer samples are truncated
+        response_template: the template ids masking the prompt of samples without labels (the text path)
+        attention: 'block' or 'position_ids', see above
+        mask_dtype: the dtype of the 4D attention mask, the dtype of the model
+        attn_implementation: the attention of the model, 'eager' or 'sdpa', which read the 4D mask in different forms
+    '''
+    def __init__(self, pad_token_id, max_seq_length, response_template=None, attention='block', mask_dtype=torch.float32,
+                 attn_implementation='sdpa'):
+        if attention not in PACKING_ATTENTION:
+            raise ValueError(f'Unknown packing attention {attention}, expected one of {PACKING_ATTENTION}')
+        if attention == 'block' and attn_implementation not in ['eager', 'sdpa']:
+            raise ValueError(f'The block packing mask is not supported by the {attn_implementation} attention, use eager or sdpa')
+        self.pad_token_id = pad_token_id
+        self.max_seq_length = max_seq_length
+        self.response_template = list(response_template) if response_template is not None else None
+        self.attention = attention
+        self.mask_dtype = mask_dtype
+        self.attn_implementation = attn_implementation
+
+    def _sample(self, feature):
+        input_ids = list(feature['input_ids'])[:self.max_seq_length]
+        if 'labels' in feature:
+            labels = list(feature['labels'])[:self.max_seq_length]
+        elif self.response_template is not None:
+            labels = completion_labels(input_ids, self.response_template)
+        else:
+            labels = list(input_ids)
+        if labels:
+            labels[0] = IGNORE_INDEX
+        return input_ids, labels
+
+    def __call__(self, features):
+        samples = [sample for sample in map(self._sample, features) if sample[0]]
+        # a batch of empty samples gives a single row of padding
+        rows = pack_lengths([len(input_ids) for input_ids, _ in samples], self.max_seq_length) or [[]]
+        row_length = max(1, max(sum(len(samples[idx][0]) for idx in row) for row in rows))
+
+        input_ids = torch.full((len(rows), row_length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(rows), row_length), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((len(rows), row_length), dtype=torch.long)
+        # the sample of every token of a row, -1 for padding
+        segment_ids = torch.full((len(rows), row_length), -1, dtype=torch.long)
+        for r, row in enumerate(rows):
+            start = 0
+            for segment, idx in enumerate(row):
+                sample_ids, sample_labels = samples[idx]
+                end = start + len(sample_ids)
+                input_ids[r, start:end] = torch.tensor(sample_ids, dtype=torch.long)
+                labels[r, start:end] = torch.tensor(sample_labels, dtype=torch.long)
+                position_ids[r, start:end] = torch.arange(len(sample_ids))
+                segment_ids[r, start:end] = segment
+                start = end
+
+        batch = {'input_ids': input_ids, 'labels': labels, 'position_ids': position_ids}
+        if self.attention == 'position_ids':
+            batch['attention_mask'] = (segment_ids >= 0).long()
+        else:
+            same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+            causal = torch.ones((row_length, row_length), dtype=torch.bool).tril()
+            # padding tokens attend to themselves only, a fully masked row would give NaN in the softmax
+            padding = torch.eye(row_length, dtype=torch.bool) & (segment_ids < 0)[:, :, None]
+            mask = (same_segment & causal & (segment_ids >= 0)[:, :, None]) | padding
+            if self.attn_implementation == 'eager':
+                batch['attention_mask'] = mask[:, None].to(self.mask_dtype)
+            else: # inverted, additive
+                inverted = torch.full(mask.shape, torch.finfo(self.mask_dtype).min, dtype=self.mask_dtype)
+                batch['attention_mask'] = inverted.masked_fill(mask, 0)[:, None]
+        return batch
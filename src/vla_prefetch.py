@@ -0,0 +1,189 @@
+import io
+import logging
+import threading
+import time
+from collections import deque
+
+from .vla_compression import open_jsonl_shard
+
+'''
+background read-ahead of the jsonl shards on network storage
+
+while a shard is parsed, VLAShardPrefetcher reads the next shards (the raw, possibly compressed, bytes) into memory
+on background threads, so that opening a shard and reading its cold blocks do not stall the parsing
+- the shards are read in the order the reader will open them: every sequence of shards (the shard list, or the shards
+  of each data root of a mixture) prefetches the `num_ahead` shards following the shard being opened
+- each shard is read by its own thread in chunks of chunk_size bytes, the chunks not yet parsed count against
+  max_bytes. A shard being parsed may go over max_bytes by one chunk when it has nothing buffered, so it is never
+  starved by the shards read ahead of it
+- stalls are measured: the time the parser waits for a chunk, reported with the other counters by stats()
+binary shards and trajectory stores are memory-mapped and not prefetched
+'''
+
+logger = logging.getLogger(__name__)
+
+
+class _ShardBuffer:
+    def __init__(self, shard):
+        self.shard = shard
+        self.chunks = deque()
+        self.done = False
+        self.error = None
+        self.current = False # opened by the reader
+        self.cancelled = False
+
+
+class _PrefetchedStream(io.RawIOBase):
+    '''
+    the raw bytes of a shard, from the chunks of its _ShardBuffer
+    '''
+    def __init__(self, prefetcher, buffer):
+        self._prefetcher = prefetcher
+        self._buffer = buffer
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, out):
+        if not self._chunk:
+            chunk = self._prefetcher._next_chunk(self._buffer)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        n = min(len(out), len(self._chunk))
+        out[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._prefetcher._release(self._buffer)
+        super().close()
+
+
+class VLAShardPrefetcher:
+    '''
+    Args:
+        sequences: lists of shards, each read in order
+        num_ahead: the number of shards of a sequence read ahead of the one being opened
+        max_bytes: the memory cap of the chunks read ahead
+        chunk_size: the size of the reads
+    '''
+    def __init__(self, sequences, num_ahead=2, max_bytes=1 << 30, chunk_size=8 << 20):
+        from .vla_shards import is_array_shard
+        self.num_ahead = num_ahead
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._sequences = [[shard for shard in sequence if not is_array_shard(shard)] for sequence in sequences]
+        self._positions = {}
+        for seq_idx, sequence in enumerate(self._sequences):
+            for pos, shard in enumerate(sequence):
+                self._positions.setdefault(shard, (seq_idx, pos))
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._buffered = 0
+        # counters
+        self.opened = 0
+        self.hits = 0
+        self.stall_time = 0.0
+        self.prefetched_bytes = 0
+        self.peak_buffered = 0
+
+    def _schedule(self, shard):
+        # called with the lock held
+        if shard in self._pending:
+            return self._pending[shard]
+        buffer = self._pending[shard] = _ShardBuffer(shard)
+        threading.Thread(target=self._read, args=(buffer,), daemon=True, name='vla-prefetch').start()
+        return buffer
+
+    def _read(self, buffer):
+        try:
+            with open(buffer.shard, 'rb') as f:
+                while True:
+                    with self._cond:
+                        while not buffer.cancelled and self._buffered + self.chunk_size > self.max_bytes \
+                                and not (buffer.current and not buffer.chunks):
+                            self._cond.wait()
+                        if buffer.cancelled:
+                            return
+                    chunk = f.read(self.chunk_size)
+                    with self._cond:
+                        if not chunk:
+                            buffer.done = True
+                        elif not buffer.cancelled:
+                            buffer.chunks.append(chunk)
+                            self._buffered += len(chunk)
+                            self.prefetched_bytes += len(chunk)
+                            self.peak_buffered = max(self.peak_buffered, self._buffered)
+                        self._cond.notify_all()
+                    if not chunk:
+                        return
+        except OSError as e:
+            with self._cond:
+                buffer.error = e
+                buffer.done = True
+                self._cond.notify_all()
+
+    def _next_chunk(self, buffer):
+        with self._cond:
+            if not buffer.chunks and not buffer.done:
+                start = time.perf_counter()
+                while not buffer.chunks and not buffer.done:
+                    self._cond.wait()
+                self.stall_time += time.perf_counter() - start
+            if buffer.chunks:
+                chunk = buffer.chunks.popleft()
+                self._buffered -= len(chunk)
+                self._cond.notify_all()
+                return chunk
+            if buffer.error is not None:
+                raise buffer.error
+            return None
+
+    def _release(self, buffer):
+        with self._cond:
+            buffer.cancelled = True
+            self._buffered -= sum(len(chunk) for chunk in buffer.chunks)
+            buffer.chunks.clear()
+            if self._pending.get(buffer.shard) is buffer:
+                del self._pending[buffer.shard]
+            self._cond.notify_all()
+
+    def open(self, shard):
+        '''
+        open a jsonl shard from its prefetched bytes (see open_jsonl_shard), and start reading the next shards
+        '''
+        with self._cond:
+            self.opened += 1
+            self.hits += int(shard in self._pending)
+            buffer = self._schedule(shard)
+            # a shard reopened later (next epoch) is prefetched again
+            del self._pending[shard]
+            buffer.current = True
+            self._cond.notify_all()
+            if shard in self._positions:
+                seq_idx, pos = self._positions[shard]
+                for next_shard in self._sequences[seq_idx][pos + 1:pos + 1 + self.num_ahead]:
+                    self._schedule(next_shard)
+        return open_jsonl_shard(shard, fileobj=io.BufferedReader(_PrefetchedStream(self, buffer), buffer_size=self.chunk_size))
+
+    def cancel(self, shard):
+        '''
+        drop the prefetched bytes of a shard that is opened directly (to seek in it)
+        '''
+        with self._cond:
+            buffer = self._pending.get(shard)
+        if buffer is not None:
+            self._release(buffer)
+
+    def close(self):
+        with self._cond:
+            buffers = list(self._pending.values())
+        for buffer in buffers:
+            self._release(buffer)
+
+    def stats(self):
+        return {'opened': self.opened, 'prefetched': self.hits, 'stall_seconds': round(self.stall_time, 3),
+                'prefetched_mb': round(self.prefetched_bytes / 1024 ** 2, 1), 'peak_buffered_mb': round(self.peak_buffered / 1024 ** 2, 1)}
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+
+import torch
+
+'''
+reuse of the key / value states of the prompt prefix shared by the clips of a trajectory, see scripts/predict.py
+
+the prompts of the clips of a trajectory / view start with the same <bott_i>task<eott_i><bots_i>scene<eots_i> prefix
+(<bott_i>task<eott_i> with wo_text). VLAPrefixCache keeps the key / value states of these prefixes, keyed by their
+token ids, in an LRU cache under a memory budget. VLAPrefixCache.prepare lays out a batch of prompts for generation:
+- the prefixes of the batch are looked up, the missing ones are prefilled together in one forward pass (right-padded,
+  the states of a row are cut to its prefix) and cached. Rows with the same prefix share one entry
+- the cached states are left-padded into the states of the batch, and the suffixes are left-padded after them, so a row
+  reads [padding, prefix, padding, suffix]. The padding is masked out and the position ids count the attended tokens
+  (as generate and generate_fast_forward compute them), a prefix keeps the positions it was prefilled with
+- generation is called with the whole ids, the mask and the states of the batch, and only prefills the suffixes
+the entries are the legacy tuples of (key, value) per layer with batch size 1, they are never modified
+'''
+
+
+def _legacy_states(past_key_values):
+    return past_key_values.to_legacy_cache() if hasattr(past_key_values, 'to_legacy_cache') else past_key_values
+
+
+class VLAPrefixCache:
+    '''
+    Args:
+        boundary_id: the id of the token that ends the shared prefix (<eots_i>, <eott_i> with wo_text)
+        max_bytes: the memory budget of the cached states, the least recently used prefixes are evicted beyond it
+    '''
+    def __init__(self, boundary_id, max_bytes):
+        self.boundary_id = boundary_id
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._bytes = 0
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0 # prefix tokens of the rows that were not prefilled
+
+    def prefix_length(self, ids):
+        '''
+        the length of the shared prefix of a prompt, 0 when the prompt has no prefix or nothing after it
+        '''
+        if self.boundary_id not in ids:
+            return 0
+        length = ids.index(self.boundary_id) + 1
+        return length if length < len(ids) else 0
+
+    def get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, states):
+        size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in states)
+        if key in self._cache or size > self.max_bytes:
+            return
+        self._cache[key] = (states, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._cache.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    @torch.no_grad()
+    def prepare(self, model, prompts, pad_token_id, device):
+        '''
+        the input ids, attention mask and key / value states (legacy tuples, None when no prompt has a prefix) of a batch of
+        prompts (lists of ids), the states cover the first columns of the ids
+        '''
+        lengths = [self.prefix_length(prompt) for prompt in prompts]
+        keys = [tuple(prompt[:length]) for prompt, length in zip(prompts, lengths)]
+        states = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            if not key:
+                continue
+            cached = self.get(key)
+            if cached is None:
+                missing.append(key)
+            else:
+                states[key] = cached
+        self.reused_tokens += sum(lengths) - sum(len(key) for key in missing)
+        if missing:
+            width = max(len(key) for key in missing)
+            prefix_ids = torch.full((len(missing), width), pad_token_id, dtype=torch.long)
+            prefix_mask = torch.zeros((len(missing), width), dtype=torch.long)
+            for i, key in enumerate(missing):
+                prefix_ids[i, :len(key)] = torch.tensor(key, dtype=torch.long)
+                prefix_mask[i, :len(key)] = 1
+            output = model(input_ids=prefix_ids.to(device), attention_mask=prefix_mask.to(device), use_cache=True)
+            for i, key in enumerate(missing):
+                # copies, a view would keep the states of the whole batch alive
+                states[key] = tuple((k[i:i + 1, :, :len(key)].clone(), v[i:i + 1, :, :len(key)].clone())
+                                    for k, v in _legacy_states(output.past_key_values))
+                self.put(key, states[key])
+
+        prefix_width = max(lengths)
+        suffix_width = max(len(prompt) - length for prompt, length in zip(prompts, lengths))
+        input_ids = torch.full((len(prompts), prefix_width + suffix_width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), prefix_width + suffix_width), dtype=torch.long)
+        for row, (prompt, length) in enumerate(zip(prompts, lengths)):
+            input_ids[row, prefix_width - length:prefix_width] = torch.tensor(prompt[:length], dtype=torch.long)
+            input_ids[row, input_ids.shape[1] - len(prompt) + length:] = torch.tensor(prompt[length:], dtype=torch.long)
+            attention_mask[row, prefix_width - length:prefix_width] = 1
+            attention_mask[row, input_ids.shape[1] - len(prompt) + length:] = 1
+        if prefix_width == 0:
+            return input_ids.to(device), attention_mask.to(device), None
+
+        past_key_values = []
+        reference = next(iter(states.values()))
+        for layer, (k, v) in enumerate(reference):
+            layer_k = k.new_zeros((len(prompts), k.shape[1], prefix_width, k.shape[3]))
+            layer_v = v.new_zeros((len(prompts), v.shape[1], prefix_width, v.shape[3]))
+            for row, (key, length) in enumerate(zip(keys, lengths)):
+                if length:
+                    layer_k[row, :, prefix_width - length:] = states[key][layer][0][0]
+                    layer_v[row, :, prefix_width - length:] = states[key][layer][1][0]
+            past_key_values.append((layer_k, layer_v))
+        return input_ids.to(device), attention_mask.to(device), tuple(past_key_values)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._cache),
+                'cached_mb': round(self._bytes / 1024 ** 2, 1), 'reused_tokens': self.reused_tokens,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
@@ -0,0 +1,181 @@
+import logging
+import random
+
+import datasets
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers import TrainerCallback
+
+'''
+token-budget batching: batches are formed under a maximum number of (padded) tokens instead of a fixed batch size,
+from samples of similar length, so short samples (wo_text / wo_vision) are batched many at a time and long ones
+a few at a time, with little padding
+
+- map-style datasets: TokenBudgetBatchSampler, from the precomputed length of every sample (get_VLA_lengths).
+  every rank builds the same batches from the same seed and takes one batch of every group of num_replicas
+  consecutive (similar length) batches, so all ranks run the same number of steps with similar token counts.
+  The number of groups depends on the shuffle, every epoch is trimmed / padded (with its first groups) to the
+  number of groups of epoch 0, so len() is the same for every epoch
+- streaming datasets: VLATokenBudgetStream batches the samples of a buffer of bucket_size samples sorted by length,
+  inside each dataloader worker. With num_batches, every rank yields exactly that many batches per pass, restarting
+  its stream if it runs out, so the ranks stay in step without communicating
+
+the cost of a batch is its padded size, len(batch) * the length of its longest sample. A sample longer than max_tokens
+is batched alone, so max_tokens should be at least max_seq_length
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def get_VLA_lengths(dataset, num_proc=None):
+    '''
+    the number of tokens of every sample of a tokenized map-style dataset
+    '''
+    if isinstance(dataset, datasets.Dataset):
+        lengths = dataset.map(lambda batch: {'length': [len(ids) for ids in batch['input_ids']]}, batched=True,
+                              remove_columns=dataset.column_names, num_proc=num_proc, desc="Computing the sample lengths")
+        return lengths['length']
+    logger.warning(f'Computing the length of the {len(dataset)} samples of {type(dataset).__name__} one by one')
+    return [len(dataset[idx]['input_ids']) for idx in range(len(dataset))]
+
+
+def budget_batches(indices, lengths, max_tokens):
+    '''
+    split `indices`, sorted by length, into consecutive batches whose padded size fits in max_tokens
+    '''
+    batches = []
+    batch = []
+    longest = 0
+    for idx in indices:
+        length = lengths[idx]
+        if batch and max(longest, length) * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch, longest = [], 0
+        batch.append(idx)
+        longest = max(longest, length)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class TokenBudgetBatchSampler:
+    '''
+    Args:
+        lengths: the number of tokens of every sample
+        max_tokens: the padded size budget of a batch
+        bucket_size: the samples are shuffled, then sorted by length within consecutive buckets of bucket_size samples
+        num_replicas, rank: the data-parallel layout, each rank gets the same number of batches
+    '''
+    def __init__(self, lengths, max_tokens, bucket_size=1024, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._num_groups = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _groups(self, epoch):
+        rng = random.Random(f'{self.seed}:{epoch}')
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        groups = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start:start + self.bucket_size], key=lambda i: self.lengths[i])
+            batches = budget_batches(bucket, self.lengths, self.max_tokens)
+            # num_replicas consecutive batches of similar length make one step of all the ranks,
+            # the last incomplete group of the bucket is dropped for the ranks to stay in lockstep
+            groups.extend(batches[i:i + self.num_replicas] for i in range(0, len(batches) - self.num_replicas + 1, self.num_replicas))
+        if self.shuffle:
+            rng.shuffle(groups)
+        return groups
+
+    def _batches(self, epoch):
+        groups = self._groups(epoch)
+        if not groups:
+            raise ValueError(f'The {len(self.lengths)} samples do not make one batch per rank of {self.num_replicas} ranks')
+        # the same number of groups on every epoch, the epoch 0 count is computed identically on every rank
+        groups = [groups[i % len(groups)] for i in range(len(self))]
+        return [group[self.rank] for group in groups]
+
+    def __iter__(self):
+        yield from self._batches(self.epoch)
+
+    def __len__(self):
+        if self._num_groups is None:
+            self._num_groups = len(self._groups(0))
+        return self._num_groups
+
+
+class TokenBudgetEpochCallback(TrainerCallback):
+    '''
+    reshuffle the batches of a TokenBudgetBatchSampler at every epoch, the Trainer only does it for its own samplers
+    '''
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.batch_sampler.set_epoch(int(state.epoch))
+
+
+class VLATokenBudgetStream(IterableDataset):
+    '''
+    batches the samples of an iterable dataset under a token budget, yields lists of samples (use batch_size=None)
+
+    Args:
+        num_batches: the number of batches of a pass over the stream (split over the dataloader workers), the same on
+            every rank, the stream is restarted when it runs out before. None yields the batches until the stream ends
+    '''
+    def __init__(self, dataset, max_tokens, bucket_size=1024, seed=0, num_batches=None):
+        self.dataset = dataset
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.num_batches = num_batches
+
+    def __len__(self):
+        if self.num_batches is None:
+            raise TypeError('The number of batches of a VLATokenBudgetStream without num_batches is unknown')
+        return self.num_batches
+
+    def _flush(self, buffer, rng):
+        buffer.sort(key=lambda example: len(example['input_ids']))
+        batches = budget_batches(range(len(buffer)), [len(example['input_ids']) for example in buffer], self.max_tokens)
+        rng.shuffle(batches)
+        for batch in batches:
+            yield [buffer[idx] for idx in batch]
+
+    def _pass(self, rng):
+        buffer = []
+        for example in self.dataset:
+            buffer.append(example)
+            if len(buffer) == self.bucket_size:
+                yield from self._flush(buffer, rng)
+                buffer = []
+        if buffer:
+            yield from self._flush(buffer, rng)
+
+    def __iter__(self):
+        rng = random.Random(self.seed)
+        if self.num_batches is None:
+            yield from self._pass(rng)
+            return
+        # the dataloader takes the batches from its workers in turn, worker i yields batches i, i + num_workers, ...
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        remaining = len(range(worker_id, self.num_batches, num_workers))
+        while remaining > 0:
+            yielded = 0
+            for batch in self._pass(rng):
+                yield batch
+                yielded += 1
+                if yielded == remaining:
+                    return
+            if yielded == 0:
+                raise ValueError(f'The stream of dataloader worker {worker_id} is empty')
+            remaining -= yielded
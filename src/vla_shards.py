@@ -0,0 +1,419 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .vla_compression import open_jsonl_shard
+
+'''
+binary shard format for the tokenized VLA clips
+
+a binary shard is a directory named <shard>.vla that mirrors one jsonl shard:
+- meta.json: number of rows and dtype / row shape of every array column
+- <column>.bin: one raw fixed-width column per array field, row-major, readable with np.memmap
+    input_video_tokens, output_video_tokens, input_action_tokens, output_action_tokens: uint16
+    gt_actions (optional, only in splits that provide it): float32
+- text.jsonl: the side table, one json object per row with the remaining (text / id) fields
+    trajectory_id, view, start_frame, task_description, scene_description,
+    input_clip_description, output_clip_description
+
+the token columns are stored as uint16, which covers num_visual_action_tokens up to 65536
+
+trajectory store (<shard>.vlt), for the stacked shards whose overlapping clips repeat the same token blocks:
+- video_blocks.bin / action_blocks.bin: the distinct video / action token blocks of the shard, each stored once
+  (the input of a clip is usually the output of an earlier clip of the same trajectory / view, and the start_frame=-1
+  clip of duplicated first frames is one more block)
+- clips.bin: int32 per clip, the row of its trajectory / view in trajectories.jsonl and the blocks of its
+  input_video_tokens, output_video_tokens, input_action_tokens, output_action_tokens
+- trajectories.jsonl: trajectory_id, view, task_description, scene_description, once per trajectory / view
+- clips.jsonl: the remaining per-clip fields (start_frame, clip descriptions), gt_actions.bin (optional): float32
+the clips are assembled from their blocks when they are read, with the same fields as the jsonl lines
+'''
+
+BINARY_SHARD_SUFFIX = '.vla'
+BINARY_SHARD_VERSION = 1
+TRAJECTORY_STORE_SUFFIX = '.vlt'
+TRAJECTORY_STORE_VERSION = 1
+
+TOKEN_COLUMNS = ['input_video_tokens', 'output_video_tokens', 'input_action_tokens', 'output_action_tokens']
+FLOAT_COLUMNS = ['gt_actions']
+TOKEN_DTYPE = np.uint16
+FLOAT_DTYPE = np.float32
+
+
+TRAJECTORY_FIELDS = ['trajectory_id', 'view', 'task_description', 'scene_description']
+# the block pool of every token column of a trajectory store
+BLOCK_POOLS = {'input_video_tokens': 'video', 'output_video_tokens': 'video', 'input_action_tokens': 'action', 'output_action_tokens': 'action'}
+
+
+def _check_array(name, value, dtype):
+    '''
+    the array of a column value, raises ValueError if it cannot be stored with dtype
+    '''
+    try:
+        array = np.asarray(value)
+    except ValueError: # ragged nested lists
+        raise ValueError(f'Column {name} is not a rectangular array')
+    kinds = 'iu' if dtype == TOKEN_DTYPE else 'iuf'
+    if array.size > 0 and array.dtype.kind not in kinds:
+        raise ValueError(f'Column {name} has {array.dtype} values, expected numbers')
+    if dtype == TOKEN_DTYPE and array.size > 0 and (array.min() < 0 or array.max() > np.iinfo(TOKEN_DTYPE).max):
+        raise ValueError(f'Column {name} has token ids out of the {np.dtype(TOKEN_DTYPE).name} range')
+    return array
+
+
+def is_binary_shard(path):
+    return path.endswith(BINARY_SHARD_SUFFIX) and os.path.isdir(path)
+
+
+def is_trajectory_store(path):
+    return path.endswith(TRAJECTORY_STORE_SUFFIX) and os.path.isdir(path)
+
+
+def is_array_shard(path):
+    '''
+    a binary shard or a trajectory store, random-access without a line-offset index
+    '''
+    return is_binary_shard(path) or is_trajectory_store(path)
+
+
+def open_array_shard(path):
+    return VLATrajectoryStore(path) if is_trajectory_store(path) else VLABinaryShard(path)
+
+
+class VLABinaryShard:
+    '''
+    read-only view over a binary shard, the array columns are memory-mapped and
+    each row is returned as numpy views into the mapping (no copy, no parsing)
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != BINARY_SHARD_VERSION:
+            raise ValueError(f"Unsupported binary shard version {self.meta['version']} in {path}")
+        self.num_rows = self.meta['num_rows']
+        self.columns = {}
+        for name, info in self.meta['columns'].items():
+            shape = (self.num_rows, *info['shape'])
+            if self.num_rows == 0:
+                self.columns[name] = np.zeros(shape, dtype=info['dtype'])
+            else:
+                self.columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=info['dtype'], mode='r', shape=shape)
+        self._text = None
+
+    @property
+    def text(self):
+        # the side table is small, load it lazily on first access
+        if self._text is None:
+            with open(os.path.join(self.path, 'text.jsonl'), 'r') as f:
+                self._text = [json.loads(line) for line in f]
+        return self._text
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx):
+        return self.read(idx)
+
+    def read(self, idx, fields=None):
+        '''
+        row idx, restricted to `fields` when given, the other columns are not read
+        '''
+        instance_data = {k: v for k, v in self.text[idx].items() if fields is None or k in fields}
+        for name, column in self.columns.items():
+            if fields is None or name in fields:
+                instance_data[name] = column[idx]
+        return instance_data
+
+    def __iter__(self):
+        for idx in range(self.num_rows):
+            yield self[idx]
+
+
+class VLABinaryShardWriter:
+    '''
+    write a binary shard row by row, the row shape of each array column is fixed by the first row
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        # left over by an interrupted conversion
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.num_rows = 0
+        self.column_files = {}
+        self.column_shapes = {}
+        self.text_file = open(os.path.join(self.tmp_path, 'text.jsonl'), 'w')
+
+    def check(self, instance_data):
+        '''
+        raises ValueError if the row cannot be written, nothing is written for a row that fails the check
+        '''
+        if not isinstance(instance_data, dict):
+            raise ValueError(f'Expected a json object, got {type(instance_data).__name__}')
+        for name in TOKEN_COLUMNS + FLOAT_COLUMNS:
+            if name not in instance_data:
+                if name in TOKEN_COLUMNS or name in self.column_files:
+                    raise ValueError(f'Column {name} is missing in row {self.num_rows} of {self.path}')
+                continue
+            array = _check_array(name, instance_data[name], TOKEN_DTYPE if name in TOKEN_COLUMNS else FLOAT_DTYPE)
+            if name not in self.column_files:
+                if self.num_rows > 0:
+                    raise ValueError(f'Column {name} is missing in the first {self.num_rows} rows of {self.path}')
+            elif list(array.shape) != self.column_shapes[name]:
+                raise ValueError(f'Column {name} has shape {list(array.shape)}, expected {self.column_shapes[name]}')
+
+    def _write_column(self, name, value, dtype):
+        array = np.asarray(value)
+        if name not in self.column_files:
+            self.column_files[name] = open(os.path.join(self.tmp_path, name + '.bin'), 'wb')
+            self.column_shapes[name] = list(array.shape)
+        self.column_files[name].write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+
+    def write(self, instance_data):
+        self.check(instance_data)
+        for name in TOKEN_COLUMNS:
+            self._write_column(name, instance_data[name], TOKEN_DTYPE)
+        for name in FLOAT_COLUMNS:
+            if name in instance_data:
+                self._write_column(name, instance_data[name], FLOAT_DTYPE)
+        text_data = {k: v for k, v in instance_data.items() if k not in TOKEN_COLUMNS and k not in FLOAT_COLUMNS}
+        self.text_file.write(json.dumps(text_data) + '\n')
+        self.num_rows += 1
+
+    def close(self):
+        for f in self.column_files.values():
+            f.close()
+        self.text_file.close()
+        meta = {'version': BINARY_SHARD_VERSION, 'num_rows': self.num_rows, 'columns': {}}
+        for name, shape in self.column_shapes.items():
+            dtype = TOKEN_DTYPE if name in TOKEN_COLUMNS else FLOAT_DTYPE
+            meta['columns'][name] = {'dtype': np.dtype(dtype).name, 'shape': shape}
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        # publish the shard only once it is complete
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        '''
+        drop the partially written shard
+        '''
+        for f in self.column_files.values():
+            f.close()
+        self.text_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class VLATrajectoryStore:
+    '''
+    read-only view over a trajectory store, rows are assembled from the memory-mapped blocks on access
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != TRAJECTORY_STORE_VERSION:
+            raise ValueError(f"Unsupported trajectory store version {self.meta['version']} in {path}")
+        self.num_rows = self.meta['num_rows']
+        self.arrays = {}
+        for name, info in self.meta['arrays'].items():
+            shape = (info['num_rows'], *info['shape'])
+            if info['num_rows'] == 0:
+                self.arrays[name] = np.zeros(shape, dtype=info['dtype'])
+            else:
+                self.arrays[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=info['dtype'], mode='r', shape=shape)
+        self._trajectories = None
+        self._clips = None
+
+    def _load(self, name):
+        with open(os.path.join(self.path, name), 'r') as f:
+            return [json.loads(line) for line in f]
+
+    @property
+    def trajectories(self):
+        if self._trajectories is None:
+            self._trajectories = self._load('trajectories.jsonl')
+        return self._trajectories
+
+    @property
+    def clips(self):
+        if self._clips is None:
+            self._clips = self._load('clips.jsonl')
+        return self._clips
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, idx):
+        return self.read(idx)
+
+    def read(self, idx, fields=None):
+        '''
+        row idx, restricted to `fields` when given, with the same fields as the original jsonl line
+        '''
+        refs = self.arrays['clips'][idx]
+        instance_data = {k: v for k, v in self.trajectories[refs[0]].items() if fields is None or k in fields}
+        instance_data.update({k: v for k, v in self.clips[idx].items() if fields is None or k in fields})
+        for column, ref in zip(BLOCK_POOLS, refs[1:]):
+            if fields is None or column in fields:
+                instance_data[column] = self.arrays[BLOCK_POOLS[column] + '_blocks'][ref]
+        if 'gt_actions' in self.arrays and (fields is None or 'gt_actions' in fields):
+            instance_data['gt_actions'] = self.arrays['gt_actions'][idx]
+        return instance_data
+
+    def __iter__(self):
+        for idx in range(self.num_rows):
+            yield self[idx]
+
+
+class VLATrajectoryStoreWriter:
+    '''
+    write a trajectory store row by row, every token block is stored once per shard (deduplicated by content)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.num_rows = 0
+        self.block_files = {pool: open(os.path.join(self.tmp_path, pool + '_blocks.bin'), 'wb') for pool in set(BLOCK_POOLS.values())}
+        self.block_shapes = {}
+        self.block_ids = {pool: {} for pool in self.block_files}
+        self.trajectory_ids = {}
+        self.clips_file = open(os.path.join(self.tmp_path, 'clips.bin'), 'wb')
+        self.gt_actions_file = None
+        self.gt_actions_shape = None
+        self.trajectories_file = open(os.path.join(self.tmp_path, 'trajectories.jsonl'), 'w')
+        self.clip_text_file = open(os.path.join(self.tmp_path, 'clips.jsonl'), 'w')
+        self.num_blocks_written = 0
+
+    def check(self, instance_data):
+        '''
+        raises ValueError if the row cannot be written, nothing is written for a row that fails the check
+        '''
+        if not isinstance(instance_data, dict):
+            raise ValueError(f'Expected a json object, got {type(instance_data).__name__}')
+        block_shapes = dict(self.block_shapes)
+        for column, pool in BLOCK_POOLS.items():
+            if column not in instance_data:
+                raise ValueError(f'Column {column} is missing in row {self.num_rows} of {self.path}')
+            shape = list(_check_array(column, instance_data[column], TOKEN_DTYPE).shape)
+            if block_shapes.setdefault(pool, shape) != shape:
+                raise ValueError(f'Column {column} has shape {shape}, the {pool} blocks of {self.path} have shape '
+                                 f'{block_shapes[pool]}, use a binary shard instead')
+        if 'gt_actions' in instance_data:
+            shape = list(_check_array('gt_actions', instance_data['gt_actions'], FLOAT_DTYPE).shape)
+            if self.gt_actions_file is None and self.num_rows > 0:
+                raise ValueError(f'Column gt_actions is missing in the first {self.num_rows} rows of {self.path}')
+            if self.gt_actions_file is not None and shape != self.gt_actions_shape:
+                raise ValueError(f'Column gt_actions has shape {shape}, expected {self.gt_actions_shape}')
+        elif self.gt_actions_file is not None:
+            raise ValueError(f'Column gt_actions is missing in row {self.num_rows} of {self.path}')
+
+    def _block(self, column, value):
+        pool = BLOCK_POOLS[column]
+        array = np.ascontiguousarray(value, dtype=TOKEN_DTYPE)
+        self.block_shapes.setdefault(pool, list(array.shape))
+        self.num_blocks_written += 1
+        data = array.tobytes()
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        if key not in self.block_ids[pool]:
+            self.block_ids[pool][key] = len(self.block_ids[pool])
+            self.block_files[pool].write(data)
+        return self.block_ids[pool][key]
+
+    def write(self, instance_data):
+        self.check(instance_data)
+        trajectory = {k: instance_data[k] for k in TRAJECTORY_FIELDS if k in instance_data}
+        key = json.dumps(trajectory, sort_keys=True)
+        if key not in self.trajectory_ids:
+            self.trajectory_ids[key] = len(self.trajectory_ids)
+            self.trajectories_file.write(json.dumps(trajectory) + '\n')
+        refs = [self.trajectory_ids[key]] + [self._block(column, instance_data[column]) for column in BLOCK_POOLS]
+        self.clips_file.write(np.asarray(refs, dtype=np.int32).tobytes())
+        if 'gt_actions' in instance_data:
+            array = np.ascontiguousarray(instance_data['gt_actions'], dtype=FLOAT_DTYPE)
+            if self.gt_actions_file is None:
+                self.gt_actions_file = open(os.path.join(self.tmp_path, 'gt_actions.bin'), 'wb')
+                self.gt_actions_shape = list(array.shape)
+            self.gt_actions_file.write(array.tobytes())
+        clip_text = {k: v for k, v in instance_data.items() if k not in TRAJECTORY_FIELDS and k not in BLOCK_POOLS and k != 'gt_actions'}
+        self.clip_text_file.write(json.dumps(clip_text) + '\n')
+        self.num_rows += 1
+
+    @property
+    def num_blocks(self):
+        return sum(len(ids) for ids in self.block_ids.values())
+
+    def close(self):
+        for f in [*self.block_files.values(), self.clips_file, self.trajectories_file, self.clip_text_file]:
+            f.close()
+        arrays = {'clips': {'dtype': 'int32', 'shape': [1 + len(BLOCK_POOLS)], 'num_rows': self.num_rows}}
+        for pool, ids in self.block_ids.items():
+            arrays[pool + '_blocks'] = {'dtype': np.dtype(TOKEN_DTYPE).name, 'shape': self.block_shapes.get(pool, [0]), 'num_rows': len(ids)}
+        if self.gt_actions_file is not None:
+            self.gt_actions_file.close()
+            arrays['gt_actions'] = {'dtype': np.dtype(FLOAT_DTYPE).name, 'shape': self.gt_actions_shape, 'num_rows': self.num_rows}
+        meta = {'version': TRAJECTORY_STORE_VERSION, 'num_rows': self.num_rows, 'num_trajectories': len(self.trajectory_ids),
+                'arrays': arrays}
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        '''
+        drop the partially written store
+        '''
+        for f in [*self.block_files.values(), self.clips_file, self.trajectories_file, self.clip_text_file]:
+            f.close()
+        if self.gt_actions_file is not None:
+            self.gt_actions_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def convert_jsonl_shard(jsonl_path, binary_path):
+    '''
+    convert one jsonl shard into a binary shard, or a trajectory store if binary_path ends with .vlt,
+    lines that fail to parse or do not fit the columns of the shard (writer.check) are skipped,
+    the partial <binary_path>.tmp directory is removed if the conversion fails
+    returns (number of converted rows, number of skipped lines)
+    '''
+    num_skipped = 0
+    writer_class = VLATrajectoryStoreWriter if binary_path.endswith(TRAJECTORY_STORE_SUFFIX) else VLABinaryShardWriter
+    writer = writer_class(binary_path)
+    try:
+        with open_jsonl_shard(jsonl_path) as f:
+            for line in f:
+                try:
+                    instance_data = json.loads(line)
+                    writer.check(instance_data)
+                except ValueError: # JSONDecodeError is a ValueError
+                    num_skipped += 1
+                    continue
+                writer.write(instance_data)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.num_rows, num_skipped
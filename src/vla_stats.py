@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+
+from .load_dataset_VLA import iter_VLA_instances
+from .vla_cache import shard_signature
+from .vla_decode import VLAShardStats
+
+'''
+statistics and validation of the shards, see scripts/scan_shards.py
+
+every shard is read with the parsing code of VLA_dataset_generator (iter_VLA_instances) and summarized into
+- the number of clips, the trajectory ids and the views, a view being a (trajectory id, view name) pair: the same
+  view name in two trajectories is two views
+- the histogram of the sequence length of every layout variant (wo_text / wo_vision, action_before_vision only
+  reorders the segments), counted as the tokenizer-free encoder lays the sequence out (VLAEncoder.encode_segments)
+- the token ids out of [0, num_visual_action_tokens), the empty descriptions, the malformed and skipped lines
+the summary of a shard is cached in <shard>.stats.json (or under cache_dir) with the size / mtime of the shard and the
+scan options, so a re-scan only reads the new or modified shards
+'''
+
+logger = logging.getLogger(__name__)
+
+STATS_VERSION = 2
+
+LAYOUT_VARIANTS = {'full': (False, False), 'wo_text': (True, False), 'wo_vision': (False, True), 'wo_text+wo_vision': (True, True)}
+TOKEN_FIELDS = ['input_video_tokens', 'output_video_tokens', 'input_action_tokens', 'output_action_tokens']
+DESCRIPTION_FIELDS = ['task_description', 'scene_description', 'input_clip_description', 'output_clip_description']
+
+
+def _stats_path(shard, cache_dir=None):
+    if cache_dir is None:
+        return shard.rstrip('/') + '.stats.json'
+    return os.path.join(cache_dir, hashlib.sha1(os.path.abspath(shard).encode('utf-8')).hexdigest() + '.stats.json')
+
+
+class VLALengthCounter:
+    '''
+    the sequence length of a shard line under every layout variant, descriptions are counted with `tokenize`
+    (token ids of a string without special tokens) or not at all when it is None
+    '''
+    def __init__(self, tokenize=None, static_video_description=('',), num_bos=1):
+        self.tokenize = tokenize
+        self.num_bos = num_bos
+        # an empty input clip description is replaced by a random static description, count the longest one
+        self.static_length = max(self._text(text) for text in static_video_description)
+
+    def _text(self, text):
+        return len(self.tokenize(text)) if self.tokenize is not None and text else 0
+
+    def __call__(self, instance_data):
+        # bos, the 4 token segments with their 2 delimiters each, the task segment and eos
+        base = self.num_bos + 2 + self._text(instance_data['task_description']) + 1
+        tokens = {k: int(np.asarray(instance_data[k]).size) for k in TOKEN_FIELDS}
+        text = 6 + self._text(instance_data['scene_description']) + self._text(instance_data['output_clip_description'])
+        if instance_data['input_clip_description'] == '':
+            text += self.static_length
+        else:
+            text += self._text(instance_data['input_clip_description'])
+        lengths = {}
+        for variant, (wo_text, wo_vision) in LAYOUT_VARIANTS.items():
+            length = base + 6 + tokens['input_video_tokens'] + tokens['input_action_tokens'] + tokens['output_action_tokens']
+            if not wo_text:
+                length += text
+            if not wo_vision:
+                length += 2 + tokens['output_video_tokens']
+            lengths[variant] = length
+        return lengths
+
+
+def scan_VLA_shard(shard, num_visual_action_tokens, length_counter):
+    '''
+    summary of one shard, json-serializable
+    '''
+    stats = VLAShardStats(shard)
+    lengths = {variant: Counter() for variant in LAYOUT_VARIANTS}
+    out_of_range = Counter()
+    empty = Counter()
+    trajectories, views = set(), set()
+    max_token_id = -1
+    for instance_data in iter_VLA_instances(shard, stats=stats):
+        try:
+            sample_lengths = length_counter(instance_data)
+            clip_out_of_range = False
+            for k in TOKEN_FIELDS:
+                tokens = np.asarray(instance_data[k])
+                if tokens.size == 0:
+                    continue
+                max_token_id = max(max_token_id, int(tokens.max()))
+                num_bad = int(((tokens < 0) | (tokens >= num_visual_action_tokens)).sum())
+                if num_bad > 0:
+                    out_of_range[k] += num_bad
+                    clip_out_of_range = True
+            out_of_range['clips'] += int(clip_out_of_range)
+            for k in DESCRIPTION_FIELDS:
+                if instance_data[k] == '':
+                    empty[k] += 1
+        except (KeyError, TypeError, ValueError):
+            stats.skipped += 1
+            continue
+        for variant, length in sample_lengths.items():
+            lengths[variant][length] += 1
+        trajectories.add(instance_data.get('trajectory_id'))
+        if instance_data.get('view') is not None:
+            views.add((instance_data.get('trajectory_id'), instance_data['view']))
+    return {'clips': stats.decoded - stats.skipped, 'malformed': stats.malformed, 'skipped': stats.skipped,
+            'trajectories': sorted(trajectories - {None}, key=str),
+            'views': [list(view) for view in sorted(views, key=lambda view: (str(view[0]), str(view[1])))],
+            'lengths': {variant: {str(k): v for k, v in sorted(counter.items())} for variant, counter in lengths.items()},
+            'out_of_range': dict(out_of_range), 'max_token_id': max_token_id, 'empty_descriptions': dict(empty)}
+
+
+def load_or_scan_VLA_shard(shard, options, scan_fn, cache_dir=None):
+    '''
+    the cached summary of a shard if it was scanned with the same options and has not changed since, scanned otherwise
+    returns (summary, cached)
+    '''
+    signature = {'version': STATS_VERSION, 'shard': shard_signature(shard), 'options': options}
+    path = _stats_path(shard, cache_dir)
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached['signature'] == json.loads(json.dumps(signature)):
+                return cached['summary'], True
+        except (OSError, ValueError, KeyError):
+            pass
+    summary = scan_fn(shard)
+    try:
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'signature': signature, 'summary': summary}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f'Could not save the statistics of {shard} to {path}: {e}')
+    return summary, False
+
+
+def merge_VLA_stats(summaries):
+    '''
+    merge the summaries of the shards of a split
+    '''
+    merged = {'shards': len(summaries), 'clips': 0, 'malformed': 0, 'skipped': 0, 'max_token_id': -1,
+              'lengths': {variant: Counter() for variant in LAYOUT_VARIANTS}, 'out_of_range': Counter(), 'empty_descriptions': Counter()}
+    trajectories, views = set(), set()
+    for summary in summaries:
+        for k in ['clips', 'malformed', 'skipped']:
+            merged[k] += summary[k]
+        merged['max_token_id'] = max(merged['max_token_id'], summary['max_token_id'])
+        for variant, counts in summary['lengths'].items():
+            merged['lengths'][variant].update({int(k): v for k, v in counts.items()})
+        merged['out_of_range'].update(summary['out_of_range'])
+        merged['empty_descriptions'].update(summary['empty_descriptions'])
+        trajectories.update(map(str, summary['trajectories']))
+        views.update((str(trajectory), str(view)) for trajectory, view in summary['views'])
+    merged['trajectories'] = len(trajectories)
+    # the (trajectory, view) pairs, and the distinct view names
+    merged['views'] = len(views)
+    merged['view_names'] = len({view for _, view in views})
+    merged['views_per_trajectory'] = len(views) / len(trajectories) if trajectories else 0.0
+    return merged
+
+
+def length_percentiles(counts, percentiles=(50, 90, 99, 100)):
+    '''
+    percentiles of a {length: count} histogram
+    '''
+    if not counts:
+        return {}
+    lengths = np.array(sorted(counts))
+    cumulative = np.cumsum([counts[length] for length in lengths])
+    return {p: int(lengths[np.searchsorted(cumulative, p / 100 * cumulative[-1])]) for p in percentiles}
+
+
+def recommended_max_seq_length(counts, multiple_of=8):
+    '''
+    the smallest max_seq_length (a multiple of multiple_of) that does not truncate any sample
+    '''
+    if not counts:
+        return None
+    return -(-max(counts) // multiple_of) * multiple_of
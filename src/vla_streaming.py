@@ -0,0 +1,461 @@
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import random
+
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers import TrainerCallback
+
+from .vla_decode import VLA_required_fields, get_shard_stats, log_shard_stats
+from .vla_index import load_shard_index, read_VLA_lines
+from .vla_prefetch import VLAShardPrefetcher
+from .vla_shards import is_array_shard, open_array_shard
+
+'''
+rank-aware, resumable streaming over the shards (dataset_type=iterable_dataset with streaming_shard_by_rank)
+
+every (rank, dataloader worker) pair is a slot, slot = rank * num_workers + worker_id, and slot s reads the shards
+s, s + num_slots, s + 2 * num_slots, ... of the sorted shard list, so no two processes read the same shard.
+each slot cycles over its shards forever (training is bounded by max_steps), which keeps the ranks in lockstep
+even when the slots hold different numbers of clips.
+
+the shards are indexed lazily, a rank only reads the line-offset indexes of the shards of its slots.
+
+the dataloader fetches batch k from worker k % num_workers, each batch being the next batch_size samples of that
+worker's stream (the workers are renumbered on resume so that k counts the batches since the start of training). After each batch it produces, a worker records the position of its stream (the epoch and the lines,
+or the shuffled stream items, read so far, malformed and skipped lines included) in memory shared with the main
+process (track_cursor). VLAStreamingCursorCallback saves, per rank, the position of every slot after the batches the
+rank consumed, and load_cursor resumes every slot there, with one seek through the line-offset index. A checkpoint
+without these positions (or saved with another layout) falls back to an approximate position derived from the step.
+
+shuffling (num_open_shards > 1 or shuffle_buffer_size > 1) keeps num_open_shards shards open, draws each sample from
+one of them at random and passes the samples through a shuffle buffer, the shard order and the draws are seeded by
+(shuffle_seed, epoch). The draws only depend on the line counts, so on resume they are replayed over (shard, line)
+references without reading anything, and only the lines still in the buffer are read back with a seek.
+
+with root_weights, the shards of the slot are grouped by data root and every sample is first drawn from a root with
+these weights (weighted_interleave), then from the open shards of that root. An epoch then ends when a root runs out
+('stop') or once every root has run out ('cycle'), its length depends on the draws and resuming replays whole epochs.
+'''
+
+logger = logging.getLogger(__name__)
+
+CURSOR_FILE = 'data_cursor.json'
+# the positions of the slots of a rank
+SLOT_CURSOR_FILE = 'data_cursor_rank{rank}.json'
+# the number of batches of each worker whose position is kept, more than a dataloader fetches ahead
+CURSOR_HISTORY = 64
+
+_UNREAD = object()
+
+
+def interleave_streams(open_fns, num_open, rng):
+    '''
+    keep num_open of the streams open and yield from a randomly drawn one at each step,
+    open_fns are called lazily, in order, to open the next stream when one is exhausted
+    '''
+    pending = list(reversed(open_fns))
+    active = []
+    while pending and len(active) < num_open:
+        active.append(pending.pop()())
+    while active:
+        i = rng.randrange(len(active))
+        try:
+            yield next(active[i])
+        except StopIteration:
+            if pending:
+                active[i] = pending.pop()()
+            else:
+                active.pop(i)
+
+
+def weighted_interleave(open_fns, weights, rng, exhaustion='stop', realized=None):
+    '''
+    draw each item from source i with probability weights[i] / sum(weights), without materializing the sources
+    exhaustion: 'stop' ends at the first exhausted source,
+        'cycle' reopens exhausted sources until every source has been exhausted at least once
+    realized: optional list counting the items drawn from each source
+    '''
+    iterators = [open_fn() for open_fn in open_fns]
+    exhausted = [False] * len(open_fns)
+    sources = list(range(len(open_fns)))
+    while True:
+        i = rng.choices(sources, weights=weights)[0]
+        try:
+            item = next(iterators[i])
+        except StopIteration:
+            exhausted[i] = True
+            if exhaustion == 'stop' or all(exhausted):
+                return
+            iterators[i] = open_fns[i]()
+            try:
+                item = next(iterators[i])
+            except StopIteration: # empty source
+                return
+        if realized is not None:
+            realized[i] += 1
+        yield item
+
+
+def format_mixture(names, realized):
+    total = max(sum(realized), 1)
+    return ', '.join(f'{name}: {count} ({count / total:.3f})' for name, count in zip(names, realized))
+
+
+def shuffle_buffer(iterable, buffer_size, rng):
+    '''
+    bounded-memory shuffle: once the buffer is full, every new item replaces a random item of the buffer, which is yielded
+    '''
+    if buffer_size <= 1:
+        yield from iterable
+        return
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class VLAStreamingDataset(IterableDataset):
+    '''
+    Args:
+        shards: the sorted shard list
+        format_kwargs: the keyword arguments of VLA_dataset_generator except `shards`, must include an encoder
+        rank, world_size: default to the RANK / WORLD_SIZE environment variables
+        shard_roots, root_weights, root_names: the data root index of each shard, and the weight / name of each root,
+            to draw the samples from a weighted mixture of the roots
+        prefetch_shards, prefetch_max_mb: read the next shards of the slot ahead in the background (see vla_prefetch.py),
+            only when the shards are read one after the other (no shuffle)
+    '''
+    def __init__(self, shards, format_kwargs, rank=None, world_size=None, index_dir=None, num_open_shards=1, shuffle_buffer_size=0, shuffle_seed=0,
+                 shard_roots=None, root_weights=None, root_names=None, mixture_exhaustion='stop', prefetch_shards=0, prefetch_max_mb=1024):
+        self.shards = shards
+        self.format_kwargs = format_kwargs
+        self.fields = VLA_required_fields(**format_kwargs)
+        self.shard_roots = shard_roots
+        self.root_weights = root_weights
+        self.root_names = root_names
+        self.mixture_exhaustion = mixture_exhaustion
+        self.num_open_shards = num_open_shards
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.shuffle_seed = shuffle_seed
+        self.prefetch_shards = prefetch_shards
+        self.prefetch_max_mb = prefetch_max_mb
+        if prefetch_shards > 0 and self._shuffled():
+            logger.warning('prefetch_shards is ignored by the shuffled stream, which reads the lines of several shards at once')
+        self.rank = int(os.getenv('RANK', '0')) if rank is None else rank
+        self.world_size = int(os.getenv('WORLD_SIZE', '1')) if world_size is None else world_size
+        self.index_dir = index_dir
+        # filled lazily with the shards of the slots read by this process
+        self._offsets = {}
+        self._counts = {}
+        self.consumed_batches = 0
+        self.batch_size = None
+        self.num_workers = None
+        self.slot_cursors = {}
+        self._history = None
+
+    def _index(self, shard_idx):
+        '''
+        the line offsets (None for binary shards) and the number of lines of a shard
+        '''
+        if shard_idx not in self._counts:
+            shard = self.shards[shard_idx]
+            if is_array_shard(shard):
+                self._offsets[shard_idx] = None
+                self._counts[shard_idx] = len(open_array_shard(shard))
+            else:
+                self._offsets[shard_idx] = load_shard_index(shard, self.index_dir)
+                self._counts[shard_idx] = len(self._offsets[shard_idx]) - 1
+        return self._offsets[shard_idx], self._counts[shard_idx]
+
+    def _count(self, shard_idx):
+        return self._index(shard_idx)[1]
+
+    def track_cursor(self, num_workers, batch_size):
+        '''
+        record the position of the stream of every dataloader worker after each batch, in memory shared with this
+        process, must be called before the dataloader starts its workers
+        '''
+        self.num_workers = max(1, num_workers)
+        self.batch_size = batch_size
+        # (batches produced + 1, epoch, position) per worker and batch, indexed by batches produced % CURSOR_HISTORY
+        self._history = multiprocessing.RawArray('q', self.num_workers * CURSOR_HISTORY * 3)
+
+    def _record(self, worker_id, batches, epoch, position):
+        i = (worker_id * CURSOR_HISTORY + batches % CURSOR_HISTORY) * 3
+        self._history[i + 1], self._history[i + 2] = epoch, position
+        self._history[i] = batches + 1
+
+    def slot_positions(self, consumed_batches):
+        '''
+        {slot: [epoch, position, batches]} of the slots of this rank after it consumed consumed_batches batches,
+        the slots whose position is no longer (or not yet) recorded are left out
+        '''
+        positions = {}
+        for worker_id in range(self.num_workers):
+            batches = max(0, (consumed_batches - worker_id + self.num_workers - 1) // self.num_workers)
+            i = (worker_id * CURSOR_HISTORY + batches % CURSOR_HISTORY) * 3
+            if self._history[i] == batches + 1:
+                positions[self.rank * self.num_workers + worker_id] = [self._history[i + 1], self._history[i + 2], batches]
+        return positions
+
+    def load_cursor(self, checkpoint_dir, batch_size, gradient_accumulation_steps=1):
+        '''
+        resume the stream after the batches consumed up to the checkpoint, returns False if it has no cursor
+        '''
+        path = os.path.join(checkpoint_dir, CURSOR_FILE)
+        if not os.path.exists(path):
+            logger.warning(f'No data cursor in {checkpoint_dir}, the stream restarts from the beginning')
+            return False
+        with open(path, 'r') as f:
+            cursor = json.load(f)
+        self.consumed_batches = cursor['global_step'] * gradient_accumulation_steps
+        self.batch_size = batch_size
+        slot_path = os.path.join(checkpoint_dir, SLOT_CURSOR_FILE.format(rank=self.rank))
+        layout = {'world_size': self.world_size, 'num_shards': len(self.shards), 'batch_size': batch_size,
+                  'num_workers': self.num_workers if self.num_workers is not None else 1}
+        if os.path.exists(slot_path):
+            with open(slot_path, 'r') as f:
+                slot_cursor = json.load(f)
+            if all(slot_cursor[k] == v for k, v in layout.items()):
+                self.slot_cursors = {int(slot): position for slot, position in slot_cursor['slots'].items()}
+                return True
+        logger.warning(f'No slot positions for this data layout ({layout}) in {checkpoint_dir}, '
+                       'the resumed position is derived from the step and is approximate')
+        return True
+
+    def _slot(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        # the dataloader fetches the first batch from its worker 0, which continues the stream of the worker that the
+        # next batch came from before the resume: batch k (counted since the start of training) is read by worker k % num_workers
+        worker_id = (worker_id + self.consumed_batches) % num_workers
+        num_slots = self.world_size * num_workers
+        slot = self.rank * num_workers + worker_id
+        shard_ids = list(range(slot, len(self.shards), num_slots))
+        if not shard_ids:
+            raise ValueError(f'{len(self.shards)} shards cannot be split over {self.world_size} ranks x {num_workers} dataloader workers, '
+                             'use fewer dataloader workers or more shards')
+        return shard_ids, slot, worker_id, num_workers
+
+    def _start(self, shard_ids, slot, worker_id, num_workers):
+        '''
+        the (epoch, position, batches produced) the slot resumes from
+        '''
+        if slot in self.slot_cursors:
+            return tuple(self.slot_cursors[slot])
+        # batches fetched from this worker so far: batch k comes from worker k % num_workers
+        batches = max(0, (self.consumed_batches - worker_id + num_workers - 1) // num_workers)
+        # approximate: counts the samples as lines, the malformed and skipped lines make it lag behind
+        skip = batches * self.batch_size if self.batch_size is not None else 0
+        if self.root_weights is None:
+            return (*divmod(skip, sum(self._count(i) for i in shard_ids)), batches)
+        # the epochs of a mixture differ in length, skip them one by one
+        epoch, position = 0, skip
+        epoch_length = self._epoch_length(shard_ids, epoch)
+        while 0 < epoch_length <= position:
+            position -= epoch_length
+            epoch += 1
+            epoch_length = self._epoch_length(shard_ids, epoch)
+        return epoch, position, batches
+
+    def _shuffled(self):
+        return self.num_open_shards > 1 or self.shuffle_buffer_size > 1 or self.root_weights is not None
+
+    def _iter_epoch(self, shard_ids, epoch, position, prefetcher=None):
+        '''
+        yields (example, the lines of the epoch read so far) from the line `position` of the epoch
+        '''
+        from .load_dataset_VLA import format_VLA_instance, iter_VLA_instances
+        lines = 0
+        for shard_idx in shard_ids:
+            offsets, count = self._index(shard_idx)
+            if position >= lines + count:
+                lines += count
+                continue
+            shard = self.shards[shard_idx]
+            rng = random.Random(f'{shard}:{epoch}')
+            stats = get_shard_stats(shard)
+            start_line = max(0, position - lines)
+            for line_idx, instance_data in enumerate(iter_VLA_instances(shard, start_line=start_line, offsets=offsets, skip_malformed=False,
+                                                                        fields=self.fields, stats=stats, prefetcher=prefetcher), start_line + 1):
+                if instance_data is None:
+                    continue
+                example = format_VLA_instance(instance_data, rng, **self.format_kwargs)
+                if example is None:
+                    stats.skipped += 1
+                    continue
+                yield example, lines + line_idx
+            lines += count
+        log_shard_stats([self.shards[i] for i in shard_ids])
+
+    def _shard_lines(self, shard_idx):
+        return ((shard_idx, line_idx) for line_idx in range(self._count(shard_idx)))
+
+    def _read_lines(self, refs, reader_state):
+        '''
+        attach the json object to each (shard, line) reference, reading every open shard sequentially,
+        while reader_state['dry'] is set nothing is read and the objects are left _UNREAD
+        '''
+        from .load_dataset_VLA import iter_VLA_instances
+        readers = {}
+        for shard_idx, line_idx in refs:
+            if reader_state['dry']:
+                reader_state['unread'].add((shard_idx, line_idx))
+                yield (shard_idx, line_idx), _UNREAD
+                continue
+            reader = readers.get(shard_idx)
+            offsets, count = self._index(shard_idx)
+            if reader is None or reader[1] != line_idx:
+                reader = readers[shard_idx] = [iter_VLA_instances(self.shards[shard_idx], start_line=line_idx, offsets=offsets,
+                                                                  skip_malformed=False, fields=self.fields,
+                                                                  stats=get_shard_stats(self.shards[shard_idx])), line_idx]
+            instance_data = next(reader[0], None)
+            reader[1] += 1
+            if reader[1] == count:
+                del readers[shard_idx]
+            yield (shard_idx, line_idx), instance_data
+
+    def _interleave_shards(self, shard_ids, rng):
+        order = list(shard_ids)
+        rng.shuffle(order)
+        return interleave_streams([functools.partial(self._shard_lines, shard_idx) for shard_idx in order], self.num_open_shards, rng)
+
+    def _slot_roots(self, shard_ids):
+        return sorted(set(self.shard_roots[i] for i in shard_ids))
+
+    def _epoch_refs(self, shard_ids, epoch, realized=None):
+        '''
+        the (shard, line) references of an epoch of the slot, and the rng of the shuffle buffer
+        '''
+        # seeded per slot (its first shard) and epoch
+        rng = random.Random(f'{self.shuffle_seed}:{shard_ids[0]}:{epoch}')
+        if self.root_weights is None:
+            return self._interleave_shards(shard_ids, rng), rng
+        roots = self._slot_roots(shard_ids)
+        groups = [[i for i in shard_ids if self.shard_roots[i] == root] for root in roots]
+        # the draws do not share their rng with the shuffle buffer, so that _epoch_length can replay them alone,
+        # and a root reopened by 'cycle' gets a new shard order from its own rng
+        mixture_rng = random.Random(f'{self.shuffle_seed}:{shard_ids[0]}:{epoch}:mixture')
+        root_rngs = [random.Random(f'{self.shuffle_seed}:{shard_ids[0]}:{epoch}:{root}') for root in roots]
+        refs = weighted_interleave([functools.partial(self._interleave_shards, group, root_rng) for group, root_rng in zip(groups, root_rngs)],
+                                   [self.root_weights[root] for root in roots], mixture_rng, exhaustion=self.mixture_exhaustion, realized=realized)
+        return refs, rng
+
+    def _epoch_length(self, shard_ids, epoch):
+        return sum(1 for _ in self._epoch_refs(shard_ids, epoch)[0])
+
+    def _iter_shuffled_epoch(self, shard_ids, epoch, position):
+        '''
+        yields (example, the items of the shuffled stream of the epoch consumed so far) after the first `position` items
+        '''
+        from .load_dataset_VLA import format_VLA_instance
+        format_rng = random.Random(f'{self.shuffle_seed}:{shard_ids[0]}:{epoch}:format')
+        reader_state = {'dry': position > 0, 'unread': set()}
+        unread = None
+        roots = self._slot_roots(shard_ids) if self.root_weights is not None else []
+        realized = [0] * len(roots) if self.root_weights is not None else None
+        refs, rng = self._epoch_refs(shard_ids, epoch, realized)
+        stream = shuffle_buffer(self._read_lines(refs, reader_state), self.shuffle_buffer_size, rng)
+        consumed = 0
+        for (shard_idx, line_idx), instance_data in stream:
+            consumed += 1
+            if consumed <= position:
+                # replaying the items consumed before the checkpoint
+                reader_state['dry'] = consumed < position
+                reader_state['unread'].discard((shard_idx, line_idx))
+                continue
+            if instance_data is _UNREAD: # still in the shuffle buffer when the stream was resumed
+                if unread is None:
+                    # the whole buffer is read at once, a compressed shard is decompressed once
+                    unread = {}
+                    for i in sorted({ref[0] for ref in reader_state['unread']}):
+                        lines = read_VLA_lines(self.shards[i], self._index(i)[0],
+                                               [ref[1] for ref in reader_state['unread'] if ref[0] == i], self.fields)
+                        unread.update(((i, line), obj) for line, obj in lines.items())
+                instance_data = unread.pop((shard_idx, line_idx))
+                if instance_data is None:
+                    get_shard_stats(self.shards[shard_idx]).malformed += 1
+            if instance_data is None:
+                continue
+            example = format_VLA_instance(instance_data, format_rng, **self.format_kwargs)
+            if example is None:
+                get_shard_stats(self.shards[shard_idx]).skipped += 1
+                continue
+            yield example, consumed
+        log_shard_stats([self.shards[i] for i in shard_ids])
+        if realized is not None:
+            names = [self.root_names[root] if self.root_names is not None else f'root {root}' for root in roots]
+            logger.info(f'Realized mixture of epoch {epoch} (rank {self.rank}, shards {shard_ids}): ' + format_mixture(names, realized))
+
+    def __iter__(self):
+        shard_ids, slot, worker_id, num_workers = self._slot()
+        if sum(self._count(i) for i in shard_ids) == 0:
+            raise ValueError(f'The shards {[self.shards[i] for i in shard_ids]} are empty')
+        epoch, position, batches = self._start(shard_ids, slot, worker_id, num_workers)
+        produced = batches * self.batch_size if self.batch_size is not None else 0
+        track = self._history is not None and num_workers == self.num_workers
+        if track:
+            self._record(worker_id, batches, epoch, position)
+        shuffle = self._shuffled()
+        prefetcher = None
+        if self.prefetch_shards > 0 and not shuffle:
+            prefetcher = VLAShardPrefetcher([[self.shards[i] for i in shard_ids]], num_ahead=self.prefetch_shards,
+                                            max_bytes=self.prefetch_max_mb * 1024 ** 2)
+        try:
+            while True:
+                if shuffle:
+                    stream = self._iter_shuffled_epoch(shard_ids, epoch, position)
+                else:
+                    stream = self._iter_epoch(shard_ids, epoch, position, prefetcher)
+                for example, position in stream:
+                    produced += 1
+                    # recorded before the batch is handed to the dataloader
+                    if track and produced % self.batch_size == 0:
+                        self._record(worker_id, produced // self.batch_size, epoch, position)
+                    yield example
+                if prefetcher is not None:
+                    logger.info(f'Shard prefetch after epoch {epoch} (rank {self.rank}, shards {shard_ids}): {prefetcher.stats()}')
+                epoch += 1
+                position = 0
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+
+class VLAStreamingCursorCallback(TrainerCallback):
+    '''
+    save the data cursor of VLAStreamingDataset in every checkpoint, created before the dataloader starts its workers
+    '''
+    def __init__(self, dataset, num_workers, batch_size):
+        self.dataset = dataset
+        dataset.track_cursor(num_workers, batch_size)
+
+    def on_save(self, args, state, control, **kwargs):
+        checkpoint_dir = os.path.join(args.output_dir, f'checkpoint-{state.global_step}')
+        if not os.path.isdir(checkpoint_dir):
+            return
+        # every rank saves the positions of its slots
+        slot_cursor = {'world_size': self.dataset.world_size, 'num_shards': len(self.dataset.shards),
+                       'batch_size': self.dataset.batch_size, 'num_workers': self.dataset.num_workers,
+                       'slots': self.dataset.slot_positions(state.global_step * args.gradient_accumulation_steps)}
+        with open(os.path.join(checkpoint_dir, SLOT_CURSOR_FILE.format(rank=self.dataset.rank)), 'w') as f:
+            json.dump(slot_cursor, f)
+        if not state.is_world_process_zero:
+            return
+        cursor = {'global_step': state.global_step,
+                  'batch_size': args.per_device_train_batch_size,
+                  'gradient_accumulation_steps': args.gradient_accumulation_steps,
+                  'world_size': self.dataset.world_size,
+                  'num_workers': args.dataloader_num_workers,
+                  'num_shards': len(self.dataset.shards)}
+        with open(os.path.join(checkpoint_dir, CURSOR_FILE), 'w') as f:
+            json.dump(cursor, f)